@@ -1,6 +1,6 @@
 #!/bin/bash
 
-sudo apt install -y python3-pip
+sudo apt install -y python3-pip python3-numpy
 
 sudo apt install --no-install-recommends -y libprotobuf-dev libprotobuf-c-dev protobuf-c-compiler protobuf-compiler python3-protobuf pkg-config libbsd-dev iproute2 libcap-dev libnl-3-dev libnet-dev libaio-dev asciidoc
 # Missing python-ipaddress
@@ -0,0 +1,129 @@
+#!/bin/bash
+
+# Runs the executable with the new libraries under gdb and stores the synthetic execution
+# artifacts (synthetic_mappings.txt, memory_dump_1.bin, then one memory_dump_N.bin per library)
+# in the cache, so that the upgrade of any process running the same executable and libraries reuses them.
+EXE_FILE=$1        # e.g., "/home/user/zlib_experiment/build/zlib_example"
+shift
+# Followed by pairs of:
+#   old library file, e.g., "/home/user/zlib-1.2.12/libz.so.1.2.12", full path to the library being replaced
+#   new library file, e.g., "/home/user/zlib-1.3.1/libz.so.1.3.1", full path to the new library
+FORCE=0
+LIB_ARGS=()
+for arg in "$@"; do
+  if [ "$arg" == "--force" ]; then
+    FORCE=1
+  else
+    LIB_ARGS+=("$arg")
+  fi
+done
+if [ -z "$EXE_FILE" ] || [ ${#LIB_ARGS[@]} -eq 0 ] || [ $(( ${#LIB_ARGS[@]} % 2 )) -ne 0 ]; then
+  echo "Usage: $0 <exe_file> <old_lib_file> <new_lib_file> [<old_lib_file> <new_lib_file> ...] [--force]" >&2
+  exit 1
+fi
+
+for file in "$EXE_FILE" "${LIB_ARGS[@]}"; do
+  if [ ! -f "$file" ]; then
+    echo "File does not exist: $file" >&2
+    exit 1
+  fi
+done
+EXE_FILE=$(readlink -f "$EXE_FILE")
+EXE_NAME=$(basename "$EXE_FILE")
+
+OLD_LIB_FILES=()
+NEW_LIB_FILES=()
+NEW_LIB_FOLDERS_TO_PRELOAD=""
+for (( i = 0; i < ${#LIB_ARGS[@]}; i += 2 )); do
+  # The new library appears under its resolved path in the mappings of the synthetic execution
+  LIB_ARGS[i + 1]=$(readlink -f "${LIB_ARGS[i + 1]}")
+  OLD_LIB_FILES+=("${LIB_ARGS[i]}")
+  NEW_LIB_FILES+=("${LIB_ARGS[i + 1]}")
+  NEW_LIB_FOLDERS_TO_PRELOAD+=$(dirname "${LIB_ARGS[i + 1]}"):
+done
+
+# If not defined, set the path to the configuration file
+if [ -z "$UPDATE_CONFIG_FILE" ]; then
+  UPDATE_CONFIG_FILE="$(dirname "$0")/update.conf"
+fi
+if [ ! -f "$UPDATE_CONFIG_FILE" ]; then
+  echo "Error: Configuration file not found: $UPDATE_CONFIG_FILE" >&2
+  exit 1
+fi
+source "$UPDATE_CONFIG_FILE"
+export SYNTHETIC_CACHE_DIR SYNTHETIC_CACHE_MAX_SIZE SYMBOL_TABLE_CACHE_DIR
+
+###############################################
+
+# The heap fixup translates the pointers into the old libraries symbol by symbol, the tables
+# are cached per pair of build IDs and shared by every process using the same libraries
+if [[ "$HEAP_POINTER_FIXUP" == "1" ]]; then
+  for i in "${!OLD_LIB_FILES[@]}"; do
+    python3 $SYMBOL_TABLE "${OLD_LIB_FILES[i]}" "${NEW_LIB_FILES[i]}"
+    if [ $? -ne 0 ]; then
+      echo "Could not build the symbol table of ${OLD_LIB_FILES[i]} and ${NEW_LIB_FILES[i]}" >&2
+      exit 1
+    fi
+  done
+fi
+
+if [ $FORCE -eq 0 ]; then
+  python3 $SYNTHETIC_CACHE has "$EXE_FILE" "${LIB_ARGS[@]}"
+  if [ $? -eq 0 ]; then
+    exit 0
+  fi
+fi
+
+WORK_DIR=$(mktemp -d)
+trap 'rm -rf "$WORK_DIR"' EXIT
+
+# Every library is dumped from the same synthetic run, the gdb commands are built per library
+GDB_LIB_ARGS=()
+for i in "${!NEW_LIB_FILES[@]}"; do
+  ELF_VARIABLES=$(python3 $ELF_INFO "$EXE_FILE" "${OLD_LIB_FILES[i]}" "${NEW_LIB_FILES[i]}")
+  if [[ $? -ne 0 ]]; then
+      echo "Could not read the ELF information of the executable and the libraries" >&2
+      exit 1
+  fi
+  eval "$ELF_VARIABLES"
+
+  printf 'set $lib_base_addr = ' > "$WORK_DIR/.gdbtmp_lib_$i"
+  GDB_LIB_ARGS+=(
+    -ex "pipe info proc mappings | grep -m 1 '${NEW_LIB_FILES[i]}' | awk '{print \$1 }' >> .gdbtmp_lib_$i"
+    -ex "source .gdbtmp_lib_$i"
+    -ex "set \$second_page_elf_start = $SECOND_PAGE_ELF_START"
+    -ex "set \$second_page_start = \$lib_base_addr + \$second_page_elf_start"
+    -ex "set \$second_page_elf_size = $SECOND_PAGE_ELF_SIZE"
+    -ex "set \$second_page_end = \$second_page_start + \$second_page_elf_size"
+    -ex "dump binary memory memory_dump_$(( i + 2 )).bin \$second_page_start \$second_page_end"
+  )
+done
+
+if [[ "$EXE_ELF_TYPE" == "EXEC" ]]; then
+  EXE_BASE_TO_ADD=""
+else  # DYN
+  EXE_BASE_TO_ADD="\$exe_base_addr +"
+fi
+
+cd "$WORK_DIR" || exit 1
+
+# Gathering information for the new execution, starting a new process with GDB to dump the memory
+printf 'set $exe_base_addr = ' > .gdbtmp1
+LD_LIBRARY_PATH=$NEW_LIB_FOLDERS_TO_PRELOAD$LD_LIBRARY_PATH gdb "$EXE_FILE" -batch \
+-ex "break main" -ex "run" \
+-ex "pipe info proc mappings | tail -n +5 | head -n -1 > synthetic_mappings.txt" \
+-ex "pipe info proc mappings | grep -m 1 $EXE_NAME | awk '{print \$1 }' >> .gdbtmp1" \
+-ex "source .gdbtmp1" \
+-ex "set \$first_page_elf_start = $FIRST_PAGE_ELF_START" \
+-ex "set \$first_page_start = $EXE_BASE_TO_ADD \$first_page_elf_start" \
+-ex "set \$first_page_elf_end = $FIRST_PAGE_ELF_END" \
+-ex "set \$first_page_end = $EXE_BASE_TO_ADD \$first_page_elf_end" \
+-ex "dump binary memory memory_dump_1.bin \$first_page_start \$first_page_end" \
+"${GDB_LIB_ARGS[@]}" \
+-ex "quit"
+
+python3 $SYNTHETIC_CACHE store "$EXE_FILE" "${LIB_ARGS[@]}" --directory "$WORK_DIR"
+if [ $? -ne 0 ]; then
+  echo "Error storing the synthetic execution artifacts" >&2
+  exit 1
+fi
@@ -0,0 +1,34 @@
+import os
+import subprocess
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools'))
+
+from upgrade_fleet import parse_manifest
+
+UPDATE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'update.sh')
+
+def run_update(manifest_file, cwd):
+    # update.sh stops at the missing configuration file, right after checking the libraries
+    env = dict(os.environ, UPDATE_CONFIG_FILE=os.path.join(cwd, 'missing.conf'))
+    return subprocess.run(['bash', UPDATE_SCRIPT, str(os.getpid()), '--manifest', manifest_file],
+                          cwd=cwd, env=env, capture_output=True, text=True)
+
+def test_relative_library_of_a_manifest(tmp_path):
+    # The old library name only has to appear in the mappings of the process
+    (tmp_path / 'manifests' / 'libs').mkdir(parents=True)
+    (tmp_path / 'manifests' / 'libs' / 'libnew.so').write_bytes(b'')
+    (tmp_path / 'elsewhere').mkdir()
+    manifest_file = tmp_path / 'manifests' / 'upgrade.manifest'
+    manifest_file.write_text('# old new\nlibc.so libs/libnew.so\n')
+
+    assert parse_manifest(str(manifest_file)) == [('libc.so', str(tmp_path / 'manifests' / 'libs' / 'libnew.so'))]
+
+    result = run_update(str(manifest_file), str(tmp_path / 'elsewhere'))
+    assert 'Configuration file not found' in result.stderr, result.stderr
+
+    manifest_file.write_text('libc.so elsewhere/libnew.so\n')
+    (tmp_path / 'elsewhere' / 'elsewhere').mkdir()
+    (tmp_path / 'elsewhere' / 'elsewhere' / 'libnew.so').write_bytes(b'')
+    result = run_update(str(manifest_file), str(tmp_path / 'elsewhere'))
+    assert 'New library file does not exist' in result.stderr, result.stderr
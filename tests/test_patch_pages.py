@@ -0,0 +1,93 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools'))
+
+import pytest
+
+from criu_image import PE_PARENT, PE_PRESENT, PagemapEntry, write_pagemap_file
+from patch_pages import resolve_patches, write_patches
+from translate_addresses import PAGE_SIZE, PARENT_LINK, load_pagemap_chain
+
+def make_image_set(directory, pages_id, entries, parent=None):
+    """Write a pagemap and a pages image whose pages are filled with their page number in the image."""
+    os.makedirs(directory)
+    write_pagemap_file(os.path.join(directory, 'pagemap-1.img'), pages_id,
+                       [PagemapEntry(vaddr, nr_pages, flags) for vaddr, nr_pages, flags in entries])
+    stored = sum(nr_pages for _, nr_pages, flags in entries if flags == PE_PRESENT)
+    with open(os.path.join(directory, f'pages-{pages_id}.img'), 'wb') as f:
+        f.write(b''.join(bytes([page]) * PAGE_SIZE for page in range(stored)))
+    if parent:
+        os.symlink(os.path.relpath(parent, directory), os.path.join(directory, PARENT_LINK))
+    return os.path.join(directory, f'pages-{pages_id}.img')
+
+@pytest.fixture
+def chain(tmp_path):
+    """
+    Two pre-dumps and the final dump: 0x10000 and 0x12000 are stored in the final dump,
+    0x11000 in the second pre-dump and 0x13000 in the first one.
+    """
+    first = make_image_set(tmp_path / 'predump' / '1', 1, [(0x10000, 4, PE_PRESENT)])
+    second = make_image_set(tmp_path / 'predump' / '2', 2,
+                            [(0x10000, 1, PE_PARENT), (0x11000, 2, PE_PRESENT), (0x13000, 1, PE_PARENT)],
+                            parent=tmp_path / 'predump' / '1')
+    final = make_image_set(tmp_path / 'checkpoint', 3,
+                           [(0x10000, 1, PE_PRESENT), (0x11000, 1, PE_PARENT),
+                            (0x12000, 1, PE_PRESENT), (0x13000, 1, PE_PARENT)],
+                           parent=tmp_path / 'predump' / '2')
+    return load_pagemap_chain(str(tmp_path / 'checkpoint'), use_cache=False), first, second, final
+
+def test_patch_written_in_place(tmp_path):
+    pages_file = make_image_set(tmp_path / 'checkpoint', 1, [(0x10000, 2, PE_PRESENT), (0x20000, 1, PE_PRESENT)])
+    page_chain = load_pagemap_chain(str(tmp_path / 'checkpoint'), use_cache=False)
+
+    resolved = resolve_patches([(0x20010, b'ab'), (0x10ff0, b'cd' * 16)], page_chain)
+    assert [(offset, vaddr) for _, offset, vaddr, _ in resolved] == [(0xff0, 0x10ff0), (0x2010, 0x20010)]
+    write_patches(resolved)
+
+    with open(pages_file, 'rb') as f:
+        pages = f.read()
+    assert pages[0xff0:0x1010] == b'cd' * 16
+    assert pages[0x2010:0x2012] == b'ab'
+    assert pages[0x2012] == 2 and pages[0xfef] == 0
+
+def test_patch_of_pages_not_dumped(tmp_path):
+    make_image_set(tmp_path / 'checkpoint', 1, [(0x10000, 1, PE_PRESENT), (0x11000, 1, 0)])
+    page_chain = load_pagemap_chain(str(tmp_path / 'checkpoint'), use_cache=False)
+
+    with pytest.raises(ValueError, match='not dumped'):
+        resolve_patches([(0x20000, b'x')], page_chain)
+    with pytest.raises(ValueError, match='not dumped'):  # Zero pages are not stored either
+        resolve_patches([(0x10ff8, b'x' * 16)], page_chain)
+
+def test_patch_crossing_an_entry(tmp_path):
+    make_image_set(tmp_path / 'checkpoint', 1, [(0x10000, 1, PE_PRESENT), (0x11000, 1, PE_PRESENT)])
+    page_chain = load_pagemap_chain(str(tmp_path / 'checkpoint'), use_cache=False)
+
+    with pytest.raises(ValueError, match='crosses the boundary of the pagemap entry'):
+        resolve_patches([(0x10f00, b'x' * 0x200)], page_chain)
+
+def test_overlapping_patches(tmp_path):
+    make_image_set(tmp_path / 'checkpoint', 1, [(0x10000, 1, PE_PRESENT)])
+    page_chain = load_pagemap_chain(str(tmp_path / 'checkpoint'), use_cache=False)
+
+    with pytest.raises(ValueError, match='overlap'):
+        resolve_patches([(0x10000, b'x' * 16), (0x10008, b'y' * 16)], page_chain)
+
+def test_patch_split_between_image_sets(chain):
+    page_chain, first, _, final = chain
+
+    # The pages of the first pre-dump are reached through checkpoint/parent/parent
+    resolved = resolve_patches([(0x12f00, b'z' * 0x200)], page_chain)
+    assert sorted((os.path.realpath(pages_file), offset, vaddr, len(blob))
+                  for pages_file, offset, vaddr, blob in resolved) == sorted([
+        (os.path.realpath(first), 0x3000, 0x13000, 0x100),
+        (os.path.realpath(final), 0x1f00, 0x12f00, 0x100),
+    ])
+
+def test_patch_crossing_back_into_an_image_set(chain):
+    # Final dump, second pre-dump, then another entry of the final dump
+    page_chain, _, _, _ = chain
+
+    with pytest.raises(ValueError, match='crosses the boundary of the pagemap entry'):
+        resolve_patches([(0x10f00, b'x' * 0x1200)], page_chain)
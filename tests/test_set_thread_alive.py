@@ -0,0 +1,33 @@
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools'))
+
+import pytest
+
+from set_thread_alive import ALIVE_CODE, set_tasks_alive, update_json_files
+
+# Only the core image of the thread group leader has a 'tc', CRIU writes none for the other threads
+LEADER_CORE = {'magic': 'CORE', 'entries': [{'mtype': 'X86_64', 'tc': {'task_state': 3, 'exit_code': 0},
+                                             'thread_core': {'futex_rla_len': 24}}]}
+THREAD_CORE = {'magic': 'CORE', 'entries': [{'mtype': 'X86_64', 'thread_core': {'futex_rla_len': 24}}]}
+
+@pytest.mark.parametrize('stream', [False, True])
+def test_thread_core_without_tc(tmp_path, stream, capsys):
+    leader = tmp_path / 'core-1.json'
+    thread = tmp_path / 'core-2.json'
+    leader.write_text(json.dumps(LEADER_CORE))
+    thread.write_text(json.dumps(THREAD_CORE))
+
+    update_json_files([str(leader), str(thread)], stream)
+
+    assert json.loads(leader.read_text())['entries'][0]['tc']['task_state'] == ALIVE_CODE
+    assert json.loads(thread.read_text()) == THREAD_CORE
+    assert "Successfully updated 1 task(s) to 'Alive' in 2 file(s)" in capsys.readouterr().out
+
+def test_set_tasks_alive_thread_core():
+    # As called by upgrade_api.rewrite_checkpoint on every core-*.img of the checkpoint
+    data = json.loads(json.dumps(THREAD_CORE))
+    assert set_tasks_alive(data) == 0
+    assert data == THREAD_CORE
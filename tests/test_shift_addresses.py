@@ -0,0 +1,72 @@
+import io
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools'))
+
+import pytest
+
+from mapping_index import MemoryMapping
+from shift_addresses import process_file, process_file_vectorized
+
+pytest.importorskip('numpy')
+
+LIBRARY = '/usr/lib/libexample.so.1.2.3'
+
+def mappings(starts, size=0x4000, path=LIBRARY):
+    return [MemoryMapping(start, start + size, 'r--p', 0, path) for start in starts]
+
+def dump(words, address_size, tail=b''):
+    word_size = address_size // 8
+    return b''.join(word.to_bytes(word_size, 'little') for word in words) + tail
+
+def run(engine, data, src_mappings, dst_mappings, address_size, tmp_path):
+    # The vectorized engine memory-maps its input, it needs a real file
+    input_path = tmp_path / 'dump.bin'
+    input_path.write_bytes(data)
+    output = io.BytesIO()
+    with open(input_path, 'rb') as input_file:
+        translated = engine(input_file, output, src_mappings, dst_mappings, address_size)
+    return output.getvalue(), translated
+
+@pytest.mark.parametrize('address_size, src_starts, dst_starts', [
+    (64, [0x7f0000000000, 0x7f0000004000], [0x7e1234560000, 0x7e1234564000]),
+    (64, [0x7e1234560000, 0x7e1234564000], [0x7f0000000000, 0x7f0000004000]),
+    (32, [0x08000000, 0x08004000], [0x10000000, 0x10004000]),
+    (32, [0x10000000, 0x10004000], [0x08000000, 0x08004000]),
+])
+@pytest.mark.parametrize('tail', [b'', b'\x01', b'\x01\x02\x03'])
+def test_engines_identical(tmp_path, address_size, src_starts, dst_starts, tail):
+    rng = random.Random(address_size)
+    limit = (1 << address_size) - 1
+    # Words inside and around the source regions, including both bounds, and random ones
+    words = [start + offset for start in src_starts for offset in (-8, 0, 8, 0x3ff8, 0x4000)]
+    words += [rng.randrange(src_starts[0], src_starts[-1] + 0x4000) for _ in range(1000)]
+    words += [rng.randrange(0, limit) for _ in range(1000)] + [0, limit]
+    data = dump(words, address_size, tail)
+    src_mappings = mappings(src_starts)
+    dst_mappings = mappings(dst_starts)
+
+    legacy = run(process_file, data, src_mappings, dst_mappings, address_size, tmp_path)
+    vectorized = run(process_file_vectorized, data, src_mappings, dst_mappings, address_size, tmp_path)
+    assert vectorized == legacy
+    assert legacy[1] > 1000
+    assert legacy[0].endswith(tail)
+
+@pytest.mark.parametrize('engine', [process_file, process_file_vectorized])
+def test_overflow_32(tmp_path, engine):
+    # A 32-bit word translated into a region above 4 GiB
+    data = dump([0x1234, 0x08001000], 32)
+    with pytest.raises(OverflowError):
+        run(engine, data, mappings([0x08000000]), mappings([0x7f0000000000]), 32, tmp_path)
+
+@pytest.mark.parametrize('engine', [process_file, process_file_vectorized])
+def test_overflow_64(tmp_path, engine):
+    # Special mappings of different sizes are only warned about, the larger source region
+    # translates words past the end of the address space
+    src_mappings = mappings([0x10000], size=0x10000, path='[heap]')
+    dst_mappings = mappings([0xffffffffffff8000], size=0x4000, path='[heap]')
+    data = dump([0x10008, 0x1fff8], 64)
+    with pytest.raises(OverflowError):
+        run(engine, data, src_mappings, dst_mappings, 64, tmp_path)
@@ -0,0 +1,47 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'tools'))
+
+from synthetic_cache import artifacts, evict, fetch, store
+
+NAMES = artifacts(1)
+
+def write_artifacts(directory, content):
+    os.makedirs(directory, exist_ok=True)
+    for name in NAMES:
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(content)
+
+def test_store_of_a_cached_key(tmp_path):
+    write_artifacts(tmp_path / 'first', b'first')
+    write_artifacts(tmp_path / 'second', b'second')
+    cache_dir = str(tmp_path / 'cache')
+
+    assert store(cache_dir, 'key', {}, NAMES, tmp_path / 'first')
+    assert not store(cache_dir, 'key', {}, NAMES, tmp_path / 'second')
+
+    assert fetch(cache_dir, 'key', NAMES, tmp_path)
+    assert (tmp_path / NAMES[0]).read_bytes() == b'first'
+    assert sorted(os.listdir(cache_dir)) == ['.lock', 'key']
+
+def test_store_replaces_an_incomplete_entry(tmp_path):
+    write_artifacts(tmp_path / 'source', b'complete')
+    cache_dir = tmp_path / 'cache'
+    write_artifacts(cache_dir / 'key', b'partial')
+    os.unlink(cache_dir / 'key' / NAMES[-1])
+
+    assert not fetch(str(cache_dir), 'key', NAMES, tmp_path)
+    assert store(str(cache_dir), 'key', {}, NAMES, tmp_path / 'source')
+    assert fetch(str(cache_dir), 'key', NAMES, tmp_path)
+    assert (tmp_path / NAMES[0]).read_bytes() == b'complete'
+    assert sorted(os.listdir(cache_dir)) == ['.lock', 'key']
+
+def test_evict_keeps_the_stored_entry(tmp_path):
+    write_artifacts(tmp_path / 'source', b'x' * 100)
+    cache_dir = str(tmp_path / 'cache')
+    store(cache_dir, 'old', {}, NAMES, tmp_path / 'source')
+    os.utime(os.path.join(cache_dir, 'old'), (0, 0))
+    store(cache_dir, 'new', {}, NAMES, tmp_path / 'source')
+
+    assert evict(cache_dir, 500, keep='new') == ['old']
@@ -0,0 +1,436 @@
+import argparse
+import contextlib
+import fnmatch
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import struct
+import sys
+import time
+from typing import List, Tuple
+
+from upgrade_report import peak_rss_kib
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Everything is generated here, nothing needs CRIU, gdb or root.
+# Generated files are kept in the work directory and reused by later runs with the same parameters.
+
+PAGE_SIZE = 4096
+SRC_BASE = 0x7f0000000000
+DST_BASE = 0x7f8000000000
+REGIONS_PER_LIBRARY = 8
+GENERATE_CHUNK = 16 << 20
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+def parse_size(value: str) -> int:
+    """Parse a byte count with an optional K, M or G suffix."""
+    value = value.strip().upper()
+    if value and value[-1] in SIZE_SUFFIXES:
+        return int(value[:-1]) * SIZE_SUFFIXES[value[-1]]
+    return int(value)
+
+def format_size(size: int) -> str:
+    for suffix in ('G', 'M', 'K'):
+        if size >= SIZE_SUFFIXES[suffix] and size % SIZE_SUFFIXES[suffix] == 0:
+            return f"{size // SIZE_SUFFIXES[suffix]}{suffix}"
+    return str(size)
+
+def parse_list(value: str, parse=int) -> List:
+    return [parse(v) for v in value.split(',') if v.strip()]
+
+# Synthetic inputs
+
+def synthetic_regions(count: int, seed: int = 0) -> List[Tuple[int, int, int, str]]:
+    """
+    Return count (source start, destination start, size, path) regions, grouped in libraries of
+    REGIONS_PER_LIBRARY regions. Every library is shifted by its own amount, like a real reload.
+    """
+    rng = random.Random(seed)
+    regions = []
+    src = SRC_BASE
+    dst = DST_BASE
+    for i in range(count):
+        if i % REGIONS_PER_LIBRARY == 0:
+            dst += rng.randrange(1, 256) * PAGE_SIZE
+        size = rng.randrange(1, 64) * PAGE_SIZE
+        regions.append((src, dst, size, f"/usr/lib/libbench{i // REGIONS_PER_LIBRARY}.so"))
+        gap = PAGE_SIZE * rng.randrange(1, 4)
+        src += size + gap
+        dst += size + gap
+    return regions
+
+def write_mappings(work_dir: str, count: int) -> Tuple[str, str]:
+    """Write the synthetic execution (GDB format) and process (proc format) mappings of count regions."""
+    src_file = os.path.join(work_dir, f"synthetic_mappings_{count}.txt")
+    dst_file = os.path.join(work_dir, f"real_mappings_{count}.txt")
+    if os.path.exists(src_file) and os.path.exists(dst_file):
+        return src_file, dst_file
+    offsets = {}
+    with open(src_file, 'w') as src_f, open(dst_file, 'w') as dst_f:
+        for src, dst, size, path in synthetic_regions(count):
+            offset = offsets.get(path, 0)
+            offsets[path] = offset + size
+            src_f.write(f"{hex(src)} {hex(src + size)} {hex(size)} {hex(offset)} r--p {path}\n")
+            dst_f.write(f"{dst:x}-{dst + size:x} r--p {offset:08x} 08:01 1000 {path}\n")
+    return src_file, dst_file
+
+def write_dump(work_dir: str, kind: str, size: int, regions: int) -> str:
+    """
+    Write a dump of size bytes. 'random' dumps are uniformly random words, almost none of
+    them pointing into the mappings; 'pointers' dumps have half of their words pointing
+    into the source regions, the density of a relocated data segment.
+    """
+    dump_file = os.path.join(work_dir, f"dump_{kind}_{regions}_{format_size(size)}.bin")
+    if os.path.exists(dump_file) and os.path.getsize(dump_file) == size:
+        return dump_file
+    rng = random.Random(size)
+    spans = [(src, src + length) for src, _, length, _ in synthetic_regions(regions)]
+    with open(dump_file + '.tmp', 'wb') as f:
+        for first in range(0, size, GENERATE_CHUNK):
+            length = min(GENERATE_CHUNK, size - first)
+            if kind == 'random':
+                f.write(os.urandom(length))
+                continue
+            words = length // 8
+            if np is not None:
+                generator = np.random.default_rng(first)
+                starts = np.array([s for s, _ in spans], dtype=np.uint64)
+                lengths = np.array([e - s for s, e in spans], dtype=np.uint64)
+                picked = generator.integers(0, len(spans), words)
+                chunk = starts[picked] + (generator.integers(0, 1 << 62, words, dtype=np.uint64) % lengths[picked])
+                noise = generator.integers(0, 2, words).astype(bool)
+                chunk[noise] = generator.integers(0, 1 << 63, int(noise.sum()), dtype=np.uint64)
+                f.write(chunk.astype('<u8').tobytes())
+            else:
+                chunk = bytearray()
+                for _ in range(words):
+                    if rng.random() < 0.5:
+                        start, end = spans[rng.randrange(len(spans))]
+                        chunk += rng.randrange(start, end).to_bytes(8, 'little')
+                    else:
+                        chunk += rng.getrandbits(64).to_bytes(8, 'little')
+                f.write(chunk)
+            f.write(b'\0' * (length - words * 8))
+    os.replace(dump_file + '.tmp', dump_file)
+    return dump_file
+
+def synthetic_pagemap(entries: int, seed: int = 0) -> dict:
+    """Pagemap data as decoded by crit, one entry in ten stored in the parent image set."""
+    rng = random.Random(seed)
+    vaddr = SRC_BASE
+    data = [{'pages_id': 1}]
+    for _ in range(entries):
+        nr_pages = rng.randrange(1, 16)
+        flags = 'PE_PARENT' if rng.random() < 0.1 else 'PE_PRESENT'
+        data.append({'vaddr': hex(vaddr), 'nr_pages': nr_pages, 'flags': flags})
+        vaddr += (nr_pages + rng.randrange(0, 4)) * PAGE_SIZE
+    return {'magic': 'PAGEMAP', 'entries': data}
+
+def write_build_id_elf(path: str):
+    """Minimal ELF64 DYN object whose only content is a GNU build ID note, used as the new library."""
+    desc = bytes(range(20))
+    note = struct.pack('<III', 4, len(desc), 3) + b'GNU\0' + desc
+    phoff = 64
+    note_offset = phoff + 56
+    header = b'\x7fELF' + bytes([2, 1, 1]) + bytes(9)
+    header += struct.pack('<HHIQQQIHHHHHH', 3, 62, 1, 0, phoff, 0, 0, 64, 56, 1, 64, 0, 0)
+    phdr = struct.pack('<IIQQQQQQ', 4, 4, note_offset, 0, 0, len(note), len(note), 4)
+    with open(path, 'wb') as f:
+        f.write(header + phdr + note)
+
+def synthetic_files(entries: int, libraries: int) -> dict:
+    """files.json with entries REG entries, each library appearing in several of them like its mappings do."""
+    data = []
+    for i in range(entries):
+        name = f"/usr/lib/libbench{i // 4 % libraries}.so" if i % 4 == 0 else f"/var/lib/data/file{i}"
+        data.append({'id': i + 1, 'type': 'REG', 'reg': {
+            'id': i + 1, 'flags': 'O_RDONLY', 'pos': 0, 'fown': {'uid': 0, 'euid': 0, 'signum': 0, 'pid_type': 0, 'pid': 0},
+            'name': name, 'size': 4096, 'build_id': ['1', '2', '3', '4', '5'], 'mode': 33261}})
+    return {'magic': 'FILES', 'entries': data}
+
+def synthetic_core(threads: int) -> List[dict]:
+    """One core.json per thread, as decoded from the core-TID.img images of a stopped process."""
+    return [{'magic': 'CORE', 'entries': [{
+        'mtype': 'X86_64',
+        'thread_info': {'clear_tid_addr': 0, 'gpregs': {f"r{i}": hex(i) for i in range(16)}},
+        'tc': {'task_state': 3, 'exit_code': 0, 'personality': 0, 'flags': 0, 'comm': f"worker{tid}"},
+        'thread_core': {'futex_rla': 0, 'futex_rla_len': 24, 'sched_nice': 0}}]} for tid in range(threads)]
+
+# Benchmark cases, each run in its own interpreter so that the peak RSS is its own
+
+def run_shift_addresses(case):
+    from shift_addresses import parse_mappings_file, process_file, process_file_vectorized
+    src_mappings = parse_mappings_file(case['src_maps'], gdb_format=True)
+    dst_mappings = parse_mappings_file(case['dst_maps'])
+    engine = process_file_vectorized if case['engine'] == 'vectorized' else process_file
+    # The output is discarded so that only the translation is measured, not the disk
+    with open(case['dump'], 'rb') as input_file, open(os.devnull, 'wb') as output_file:
+        start = time.perf_counter()
+        translated = engine(input_file, output_file, src_mappings, dst_mappings, 64)
+        seconds = time.perf_counter() - start
+    return seconds, case['size'], {'pointers_rewritten': translated}
+
+def run_translate_addresses(case):
+    from translate_addresses import find_address_inside_page, process_json_data
+    data = synthetic_pagemap(case['entries'])
+    start = time.perf_counter()
+    _, address_mapping = process_json_data(data, True)
+    build_seconds = time.perf_counter() - start
+
+    rng = random.Random(1)
+    first, last = address_mapping.starts[0], address_mapping.lasts[-1]
+    addresses = [rng.randrange(first, last) for _ in range(case['lookups'])]
+    start = time.perf_counter()
+    found = sum(1 for address in addresses if find_address_inside_page(address, address_mapping) is not None)
+    seconds = time.perf_counter() - start
+    return seconds, case['lookups'], {'index_build_seconds': round(build_seconds, 6), 'found': found}
+
+def run_update_files_img(case):
+    from update_files_img import stream_update_files, update_files_data
+    # Every run rewrites a fresh copy, the copy is not timed
+    work_file = case['files_json'] + '.work'
+    shutil.copyfile(case['files_json'], work_file)
+    pairs = [(f"/usr/lib/libbench{i}.so", case['new_lib']) for i in range(case['libraries'])]
+    start = time.perf_counter()
+    if case['mode'] == 'stream':
+        updated = stream_update_files(work_file, pairs)
+    else:
+        with open(work_file, 'r') as f:
+            data = json.load(f)
+        updated = update_files_data(data, pairs)
+        with open(work_file, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+    seconds = time.perf_counter() - start
+    counters = {'entries_updated': sum(count for _, _, count in updated), 'output_bytes': os.path.getsize(work_file)}
+    os.unlink(work_file)
+    return seconds, case['entries'], counters
+
+def run_set_thread_alive(case):
+    from set_thread_alive import set_tasks_alive, stream_json_file
+    work_dir = case['core_dir'] + '.work'
+    shutil.rmtree(work_dir, ignore_errors=True)
+    shutil.copytree(case['core_dir'], work_dir)
+    paths = [os.path.join(work_dir, name) for name in sorted(os.listdir(work_dir))]
+    start = time.perf_counter()
+    updated = 0
+    for path in paths:
+        if case['mode'] == 'stream':
+            updated += stream_json_file(path)
+            continue
+        with open(path, 'r') as f:
+            data = json.load(f)
+        updated += set_tasks_alive(data)
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=4)
+    seconds = time.perf_counter() - start
+    shutil.rmtree(work_dir)
+    return seconds, case['threads'], {'tasks_updated': updated}
+
+RUNNERS = {
+    'shift_addresses': (run_shift_addresses, 'bytes/s'),
+    'translate_addresses': (run_translate_addresses, 'lookups/s'),
+    'update_files_img': (run_update_files_img, 'entries/s'),
+    'set_thread_alive': (run_set_thread_alive, 'threads/s'),
+}
+
+def run_case(case):
+    """Run one case case['repeat'] times in this process, keeping the fastest run."""
+    os.environ.pop('UPGRADE_METRICS_FILE', None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    runner, unit = RUNNERS[case['tool']]
+    rss_before = peak_rss_kib()
+    best = None
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        for _ in range(case['repeat']):
+            seconds, amount, counters = runner(case)
+            if best is None or seconds < best[0]:
+                best = (seconds, amount, counters)
+    seconds, amount, counters = best
+    result = {
+        'seconds': round(seconds, 6),
+        'throughput': amount / seconds if seconds > 0 else None,
+        'unit': unit,
+        # The interpreter and its imports are counted in rss_start_kib
+        'peak_rss_kib': peak_rss_kib(),
+        'rss_start_kib': rss_before,
+    }
+    result.update(counters)
+    return result
+
+def build_cases(args, work_dir: str) -> List[Tuple[str, dict]]:
+    cases = []
+    for regions in args.regions:
+        src_maps, dst_maps = write_mappings(work_dir, regions)
+        for kind in ('random', 'pointers'):
+            for size in args.sizes:
+                for engine in ('vectorized', 'legacy'):
+                    if engine == 'vectorized' and np is None:
+                        continue
+                    if engine == 'legacy' and size > args.legacy_max_size:
+                        continue
+                    name = f"shift_addresses.{engine}/{kind}/regions={regions}/size={format_size(size)}"
+                    cases.append((name, {'tool': 'shift_addresses', 'engine': engine, 'kind': kind,
+                                         'regions': regions, 'size': size,
+                                         'src_maps': src_maps, 'dst_maps': dst_maps}))
+
+    for entries in args.pagemap_entries:
+        cases.append((f"translate_addresses.lookup/entries={entries}",
+                      {'tool': 'translate_addresses', 'entries': entries, 'lookups': args.lookups}))
+
+    new_lib = os.path.join(work_dir, 'libbench_new.so')
+    if not os.path.exists(new_lib):
+        write_build_id_elf(new_lib)
+    for entries in args.files_entries:
+        files_json = os.path.join(work_dir, f"files_{entries}.json")
+        libraries = max(1, min(args.libraries, entries // 4))
+        if not os.path.exists(files_json):
+            with open(files_json, 'w') as f:
+                json.dump(synthetic_files(entries, libraries), f, indent=4)
+        for mode in ('load', 'stream'):
+            cases.append((f"update_files_img.{mode}/entries={entries}/libraries={libraries}",
+                          {'tool': 'update_files_img', 'mode': mode, 'entries': entries, 'libraries': libraries,
+                           'files_json': files_json, 'new_lib': new_lib}))
+
+    for threads in args.threads:
+        core_dir = os.path.join(work_dir, f"core_{threads}")
+        if not os.path.isdir(core_dir):
+            os.makedirs(core_dir + '.tmp', exist_ok=True)
+            for tid, data in enumerate(synthetic_core(threads)):
+                with open(os.path.join(core_dir + '.tmp', f"core-{tid + 1}.json"), 'w') as f:
+                    json.dump(data, f, indent=4)
+            os.replace(core_dir + '.tmp', core_dir)
+        for mode in ('load', 'stream'):
+            cases.append((f"set_thread_alive.{mode}/threads={threads}",
+                          {'tool': 'set_thread_alive', 'mode': mode, 'threads': threads, 'core_dir': core_dir}))
+
+    if args.only:
+        cases = [(name, case) for name, case in cases if any(fnmatch.fnmatch(name, p) for p in args.only)]
+    return cases
+
+def generate_dumps(cases, work_dir: str):
+    for _, case in cases:
+        if case['tool'] == 'shift_addresses':
+            case['dump'] = write_dump(work_dir, case['kind'], case['size'], case['regions'])
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    Compare the results with a baseline, return the regressions: throughput lower or
+    peak RSS higher than the baseline by more than tolerance. Missing cases are ignored.
+    """
+    regressions = []
+    for name, result in results.items():
+        reference = baseline.get(name)
+        if reference is None:
+            continue
+        if reference.get('throughput') and result.get('throughput') is not None:
+            ratio = result['throughput'] / reference['throughput']
+            result['throughput_ratio'] = round(ratio, 3)
+            if ratio < 1 - tolerance:
+                regressions.append(f"{name}: throughput {ratio:.2f}x the baseline")
+        if reference.get('peak_rss_kib'):
+            ratio = result['peak_rss_kib'] / reference['peak_rss_kib']
+            result['peak_rss_ratio'] = round(ratio, 3)
+            if ratio > 1 + tolerance:
+                regressions.append(f"{name}: peak RSS {ratio:.2f}x the baseline")
+    return regressions
+
+def format_throughput(value, unit: str) -> str:
+    if value is None:
+        return '-'
+    if unit == 'bytes/s':
+        return f"{value / (1 << 20):.1f} MiB/s"
+    return f"{value:,.0f} {unit}"
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the address translation and image rewrite hot paths on synthetic inputs, offline.')
+    parser.add_argument('--work-dir', default='bench_data', help='Directory of the generated inputs (default: bench_data)')
+    parser.add_argument('--regions', type=parse_list, default=[10, 1000, 50000],
+                        help='Comma separated numbers of mapped regions (default: 10,1000,50000)')
+    parser.add_argument('--sizes', type=lambda v: parse_list(v, parse_size), default=[1 << 20, 64 << 20],
+                        help='Comma separated dump sizes, K/M/G suffixes allowed, e.g. 1M,64M,4G (default: 1M,64M)')
+    parser.add_argument('--legacy-max-size', type=parse_size, default=16 << 20,
+                        help='Largest dump translated with the legacy engine too (default: 16M)')
+    parser.add_argument('--pagemap-entries', type=parse_list, default=[1000, 100000],
+                        help='Comma separated numbers of pagemap entries (default: 1000,100000)')
+    parser.add_argument('--lookups', type=int, default=1000000, help='Addresses looked up in the pagemap (default: 1000000)')
+    parser.add_argument('--files-entries', type=parse_list, default=[1000, 100000],
+                        help='Comma separated numbers of files.json entries (default: 1000,100000)')
+    parser.add_argument('--libraries', type=int, default=8, help='Libraries rewritten in files.json (default: 8)')
+    parser.add_argument('--threads', type=parse_list, default=[1, 256],
+                        help='Comma separated numbers of threads, one core.json each (default: 1,256)')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of every case, the fastest is kept (default: 3)')
+    parser.add_argument('--only', action='append', metavar='PATTERN',
+                        help='Only run the cases whose name matches the glob pattern, can be repeated')
+    parser.add_argument('--list', action='store_true', help='List the cases and exit')
+    parser.add_argument('--output', default='benchmark_results.json', help='Results file (default: benchmark_results.json)')
+    parser.add_argument('--baseline', help='Results file of a previous run to compare with')
+    parser.add_argument('--save-baseline', metavar='FILE', help='Also store the results as a baseline in FILE')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Relative slowdown or memory growth reported as a regression (default: 0.1)')
+
+    args = parser.parse_args()
+
+    if args.repeat < 1 or args.tolerance < 0:
+        print("Error: --repeat must be positive and --tolerance not negative")
+        sys.exit(1)
+
+    baseline = None
+    if args.baseline:
+        try:
+            with open(args.baseline, 'r') as f:
+                baseline = json.load(f)['results']
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Error: Invalid baseline {args.baseline}: {e}")
+            sys.exit(1)
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    cases = build_cases(args, args.work_dir)
+    if args.list:
+        for name, _ in cases:
+            print(name)
+        return
+    generate_dumps(cases, args.work_dir)
+
+    results = {}
+    context = multiprocessing.get_context('spawn')
+    for name, case in cases:
+        case['repeat'] = args.repeat
+        with context.Pool(1) as pool:
+            result = pool.apply(run_case, (case,))
+        results[name] = result
+        print(f"{name}: {result['seconds']:.6f} s, {format_throughput(result['throughput'], result['unit'])}, "
+              f"peak RSS {result['peak_rss_kib'] / 1024:.1f} MiB")
+
+    regressions = compare(results, baseline, args.tolerance) if baseline is not None else []
+    report = {
+        'created': time.time(),
+        'python': sys.version.split()[0],
+        'numpy': np.__version__ if np is not None else None,
+        'cpu_count': os.cpu_count(),
+        'repeat': args.repeat,
+        'baseline': args.baseline,
+        'regressions': regressions,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=4)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=4)
+    print(f"Results written to {args.output}")
+
+    if regressions:
+        print(f"{len(regressions)} regression(s) against {args.baseline}:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
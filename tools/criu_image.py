@@ -0,0 +1,179 @@
+import struct
+from typing import BinaryIO, Iterable, Iterator, NamedTuple, Tuple
+
+# Image magics, see criu/include/magic.h
+IMG_COMMON_MAGIC = 0x54564319
+IMG_SERVICE_MAGIC = 0x55105940
+PAGEMAP_MAGIC = 0x56084025
+
+# Flags of a pagemap entry, see criu/include/pagemap.h
+PE_PARENT = 1 << 0   # Pages are stored in the parent image set (pre-dump)
+PE_LAZY = 1 << 1     # Pages can be fetched lazily
+PE_PRESENT = 1 << 2  # Pages are stored in this image set
+
+PAGEMAP_FLAG_NAMES = {
+    'PE_PARENT': PE_PARENT,
+    'PE_LAZY': PE_LAZY,
+    'PE_PRESENT': PE_PRESENT,
+}
+
+# Protobuf wire types
+WIRE_VARINT = 0
+WIRE_FIXED64 = 1
+WIRE_LENGTH = 2
+WIRE_FIXED32 = 5
+
+class PagemapEntry(NamedTuple):
+    vaddr: int
+    nr_pages: int
+    flags: int
+
+    @property
+    def in_parent(self) -> bool:
+        return bool(self.flags & PE_PARENT)
+
+    @property
+    def is_zero(self) -> bool:
+        """Neither present nor in the parent: the range only holds zero pages."""
+        return not self.flags & (PE_PRESENT | PE_PARENT)
+
+    @property
+    def has_data(self) -> bool:
+        """Whether the pages of this entry are stored in the pages image of this set."""
+        return bool(self.flags & PE_PRESENT) and not self.flags & PE_PARENT
+
+def parse_pagemap_flags(flags) -> int:
+    """Convert flags as printed by crit ("PE_PRESENT | PE_LAZY") or as a number to an int."""
+    if isinstance(flags, int):
+        return flags
+    value = 0
+    for name in str(flags).split('|'):
+        name = name.strip()
+        if not name:
+            continue
+        if name in PAGEMAP_FLAG_NAMES:
+            value |= PAGEMAP_FLAG_NAMES[name]
+        else:
+            value |= int(name, 0)
+    return value
+
+def normalize_pagemap_flags(flags, in_parent: bool) -> int:
+    """
+    Images written by old CRIU versions have no flags, only in_parent:
+    derive the flags the same way CRIU does when reading them.
+    """
+    if flags is None:
+        return PE_PARENT if in_parent else PE_PRESENT
+    return flags
+
+def read_varint(data: bytes, pos: int) -> Tuple[int, int]:
+    """Decode a protobuf varint at pos, return (value, new position)."""
+    value = 0
+    shift = 0
+    while True:
+        if pos >= len(data):
+            raise ValueError("Truncated varint")
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
+
+def parse_message(data: bytes) -> dict:
+    """Decode the varint fields of a protobuf message into {field number: value}."""
+    fields = {}
+    pos = 0
+    while pos < len(data):
+        key, pos = read_varint(data, pos)
+        field, wire_type = key >> 3, key & 0x7
+        if wire_type == WIRE_VARINT:
+            fields[field], pos = read_varint(data, pos)
+        elif wire_type == WIRE_FIXED64:
+            pos += 8
+        elif wire_type == WIRE_LENGTH:
+            length, pos = read_varint(data, pos)
+            pos += length
+        elif wire_type == WIRE_FIXED32:
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported protobuf wire type {wire_type}")
+    if pos > len(data):
+        raise ValueError("Truncated protobuf message")
+    return fields
+
+def read_image_magic(f: BinaryIO) -> int:
+    """Read the magic at the beginning of an image, skipping the common/service magic."""
+    header = f.read(4)
+    if len(header) != 4:
+        raise ValueError("Image too short to contain a magic")
+    magic, = struct.unpack('<I', header)
+    if magic in (IMG_COMMON_MAGIC, IMG_SERVICE_MAGIC):
+        header = f.read(4)
+        if len(header) != 4:
+            raise ValueError("Image too short to contain a magic")
+        magic, = struct.unpack('<I', header)
+    return magic
+
+def iter_image_messages(f: BinaryIO) -> Iterator[bytes]:
+    """Yield the raw protobuf messages of an image, each preceded by its 32-bit size."""
+    while True:
+        header = f.read(4)
+        if not header:
+            return
+        if len(header) != 4:
+            raise ValueError("Truncated entry size")
+        size, = struct.unpack('<I', header)
+        payload = f.read(size)
+        if len(payload) != size:
+            raise ValueError("Truncated entry")
+        yield payload
+
+def read_pagemap_head(f: BinaryIO) -> int:
+    """Check the magic and read the pagemap head, return the pages image id."""
+    magic = read_image_magic(f)
+    if magic != PAGEMAP_MAGIC:
+        raise ValueError(f"Not a pagemap image (magic {hex(magic)})")
+    for payload in iter_image_messages(f):
+        return parse_message(payload).get(1, 0)
+    raise ValueError("Missing pagemap head")
+
+def iter_pagemap_entries(f: BinaryIO) -> Iterator[PagemapEntry]:
+    """Stream the entries of a pagemap image, to be called after read_pagemap_head."""
+    for payload in iter_image_messages(f):
+        fields = parse_message(payload)
+        if 1 not in fields or 2 not in fields:
+            raise ValueError("Pagemap entry without vaddr or nr_pages")
+        flags = normalize_pagemap_flags(fields.get(4), bool(fields.get(3, 0)))
+        yield PagemapEntry(fields[1], fields[2], flags)
+
+def iter_pagemap_file(path: str) -> Iterator[PagemapEntry]:
+    """Stream the entries of the pagemap image at path."""
+    with open(path, 'rb') as f:
+        read_pagemap_head(f)
+        yield from iter_pagemap_entries(f)
+
+def encode_varint(value: int) -> bytes:
+    """Encode a protobuf varint."""
+    data = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            data.append(byte | 0x80)
+        else:
+            data.append(byte)
+            return bytes(data)
+
+def encode_message(fields: dict) -> bytes:
+    """Encode {field number: value} varint fields, the reverse of parse_message."""
+    return b''.join(encode_varint(field << 3 | WIRE_VARINT) + encode_varint(value)
+                    for field, value in sorted(fields.items()))
+
+def write_pagemap_file(path: str, pages_id: int, entries: Iterable[PagemapEntry]):
+    """Write a pagemap image holding the head and entries, as read back by iter_pagemap_file."""
+    with open(path, 'wb') as f:
+        f.write(struct.pack('<II', IMG_COMMON_MAGIC, PAGEMAP_MAGIC))
+        for payload in [encode_message({1: pages_id})] + [
+                encode_message({1: entry.vaddr, 2: entry.nr_pages, 4: entry.flags}) for entry in entries]:
+            f.write(struct.pack('<I', len(payload)) + payload)
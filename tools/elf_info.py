@@ -0,0 +1,359 @@
+import argparse
+import json
+import mmap
+import shlex
+import struct
+import sys
+from typing import List, NamedTuple, Optional
+
+ELF_MAGIC = b'\x7fELF'
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+ELF_TYPES = {0: 'NONE', 1: 'REL', 2: 'EXEC', 3: 'DYN', 4: 'CORE'}
+
+# Program header types and flags
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_NOTE = 4
+PF_X = 0x1
+PF_W = 0x2
+PF_R = 0x4
+
+# Section header types
+SHT_SYMTAB = 2
+SHT_RELA = 4
+SHT_NOTE = 7
+SHT_NOBITS = 8
+SHT_REL = 9
+SHT_DYNSYM = 11
+SHT_RELR = 19
+SHF_ALLOC = 0x2
+
+# Relocation types filling a pointer-sized slot, same values on x86-64 and i386
+R_X86_64_64 = 1
+R_X86_64_GLOB_DAT = 6
+R_X86_64_JUMP_SLOT = 7
+R_X86_64_RELATIVE = 8
+POINTER_RELOCATIONS = {R_X86_64_64, R_X86_64_GLOB_DAT, R_X86_64_JUMP_SLOT, R_X86_64_RELATIVE}
+
+NT_GNU_BUILD_ID = 3
+
+# Symbol types designating an address in the image
+STT_OBJECT = 1
+STT_FUNC = 2
+SHN_UNDEF = 0
+SHN_ABS = 0xfff1
+
+class Section(NamedTuple):
+    name: str
+    type: int
+    flags: int
+    addr: int
+    offset: int
+    size: int
+    link: int
+    info: int
+    entsize: int
+
+class Relocation(NamedTuple):
+    offset: int
+    type: int
+    symbol: int
+    addend: int
+
+class Symbol(NamedTuple):
+    name: str
+    value: int
+    size: int
+    type: int
+
+class Segment(NamedTuple):
+    type: int
+    flags: int
+    offset: int
+    vaddr: int
+    filesz: int
+    memsz: int
+
+    @property
+    def flags_str(self) -> str:
+        """Flags as printed by readelf, e.g. 'R E' or 'RW '."""
+        return (('R' if self.flags & PF_R else ' ') +
+                ('W' if self.flags & PF_W else ' ') +
+                ('E' if self.flags & PF_X else ' '))
+
+class ElfFile:
+    """
+    Minimal ELF reader working on a memory-mapped file: header, section headers,
+    program headers, notes, symbols and dynamic relocations.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self.data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # Empty file
+            self._file.close()
+            raise ValueError(f"{path} is not an ELF file")
+        try:
+            self._parse_header()
+            self.sections = self._parse_sections()
+            self.segments = self._parse_segments()
+        except (ValueError, struct.error, IndexError):
+            self.close()
+            raise ValueError(f"{path} is not an ELF file")
+
+    def close(self):
+        self.data.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _parse_header(self):
+        ident = self.data[:16]
+        if len(ident) < 16 or ident[:4] != ELF_MAGIC:
+            raise ValueError("Bad ELF magic")
+        self.elf_class = ident[4]
+        if self.elf_class not in (ELFCLASS32, ELFCLASS64):
+            raise ValueError("Bad ELF class")
+        if ident[5] not in (ELFDATA2LSB, ELFDATA2MSB):
+            raise ValueError("Bad ELF data encoding")
+        self.endian = '<' if ident[5] == ELFDATA2LSB else '>'
+        self.is_64 = self.elf_class == ELFCLASS64
+
+        if self.is_64:
+            fmt = self.endian + 'HHIQQQIHHHHHH'
+        else:
+            fmt = self.endian + 'HHIIIIIHHHHHH'
+        (self.e_type, self.e_machine, _, self.e_entry, self.e_phoff, self.e_shoff, _,
+         _, self.e_phentsize, self.e_phnum, self.e_shentsize, self.e_shnum,
+         self.e_shstrndx) = struct.unpack_from(fmt, self.data, 16)
+
+    @property
+    def type(self) -> str:
+        return ELF_TYPES.get(self.e_type, hex(self.e_type))
+
+    def _parse_sections(self) -> List[Section]:
+        if not self.e_shoff or not self.e_shnum:
+            return []
+        if self.is_64:
+            fmt = self.endian + 'IIQQQQIIQQ'
+        else:
+            fmt = self.endian + 'IIIIIIIIII'
+        raw = [struct.unpack_from(fmt, self.data, self.e_shoff + i * self.e_shentsize)
+               for i in range(self.e_shnum)]
+
+        strtab_offset = raw[self.e_shstrndx][4] if self.e_shstrndx < len(raw) else None
+        sections = []
+        for (name, sh_type, flags, addr, offset, size, link, info, _, entsize) in raw:
+            sections.append(Section(self._string_at(strtab_offset, name) if strtab_offset is not None else '',
+                                    sh_type, flags, addr, offset, size, link, info, entsize))
+        return sections
+
+    def _parse_segments(self) -> List[Segment]:
+        segments = []
+        for i in range(self.e_phnum):
+            offset = self.e_phoff + i * self.e_phentsize
+            if self.is_64:
+                p_type, p_flags, p_offset, p_vaddr, _, p_filesz, p_memsz, _ = \
+                    struct.unpack_from(self.endian + 'IIQQQQQQ', self.data, offset)
+            else:
+                p_type, p_offset, p_vaddr, _, p_filesz, p_memsz, p_flags, _ = \
+                    struct.unpack_from(self.endian + 'IIIIIIII', self.data, offset)
+            segments.append(Segment(p_type, p_flags, p_offset, p_vaddr, p_filesz, p_memsz))
+        return segments
+
+    def _string_at(self, table_offset: int, offset: int) -> str:
+        start = table_offset + offset
+        end = self.data.find(b'\0', start)
+        return self.data[start:end if end >= 0 else len(self.data)].decode(errors='replace')
+
+    def section(self, name: str) -> Optional[Section]:
+        for section in self.sections:
+            if section.name == name:
+                return section
+        return None
+
+    def segments_of_type(self, p_type: int) -> List[Segment]:
+        return [s for s in self.segments if s.type == p_type]
+
+    def rw_load_segment(self) -> Optional[Segment]:
+        """First LOAD segment mapped read-write and not executable."""
+        for segment in self.segments_of_type(PT_LOAD):
+            if segment.flags_str == 'RW ':
+                return segment
+        return None
+
+    def relocations(self) -> List[Relocation]:
+        """Dynamic relocations of the REL, RELA and RELR sections (.rela.dyn, .rela.plt, ...)."""
+        word = 8 if self.is_64 else 4
+        word_fmt = self.endian + ('Q' if self.is_64 else 'I')
+        relocations = []
+        for section in self.sections:
+            if not section.flags & SHF_ALLOC:  # Static relocations, not applied at load time
+                continue
+            if section.type in (SHT_REL, SHT_RELA):
+                is_rela = section.type == SHT_RELA
+                entry_size = section.entsize or word * (3 if is_rela else 2)
+                fmt = self.endian + ('QQq' if self.is_64 else 'IIi')[:3 if is_rela else 2]
+                for pos in range(section.offset, section.offset + section.size - entry_size + 1, entry_size):
+                    fields = struct.unpack_from(fmt, self.data, pos)
+                    info = fields[1]
+                    if self.is_64:
+                        r_type, r_sym = info & 0xffffffff, info >> 32
+                    else:
+                        r_type, r_sym = info & 0xff, info >> 8
+                    relocations.append(Relocation(fields[0], r_type, r_sym, fields[2] if is_rela else 0))
+            elif section.type == SHT_RELR:
+                # Relative relocations packed as an address followed by bitmaps of the next slots
+                where = 0
+                for pos in range(section.offset, section.offset + section.size - word + 1, word):
+                    entry, = struct.unpack_from(word_fmt, self.data, pos)
+                    if not entry & 1:
+                        relocations.append(Relocation(entry, R_X86_64_RELATIVE, 0, 0))
+                        where = entry + word
+                    else:
+                        bitmap = entry >> 1
+                        slot = where
+                        while bitmap:
+                            if bitmap & 1:
+                                relocations.append(Relocation(slot, R_X86_64_RELATIVE, 0, 0))
+                            bitmap >>= 1
+                            slot += word
+                        where += word * (8 * word - 1)
+        return relocations
+
+    def pointer_slots(self) -> List[int]:
+        """Sorted addresses of the pointer-sized slots written by the dynamic linker."""
+        return sorted({r.offset for r in self.relocations() if r.type in POINTER_RELOCATIONS})
+
+    def symbols(self) -> List[Symbol]:
+        """
+        Functions and objects defined by the file, from .symtab and .dynsym,
+        sorted by address.
+        """
+        fmt = self.endian + ('IBBHQQ' if self.is_64 else 'IIIBBH')
+        entry_size = struct.calcsize(fmt)
+        symbols = set()
+        for section in self.sections:
+            if section.type not in (SHT_SYMTAB, SHT_DYNSYM) or section.link >= len(self.sections):
+                continue
+            strtab_offset = self.sections[section.link].offset
+            for pos in range(section.offset, section.offset + section.size - entry_size + 1, entry_size):
+                if self.is_64:
+                    name, info, _, shndx, value, size = struct.unpack_from(fmt, self.data, pos)
+                else:
+                    name, value, size, info, _, shndx = struct.unpack_from(fmt, self.data, pos)
+                sym_type = info & 0xf
+                if sym_type not in (STT_OBJECT, STT_FUNC) or shndx in (SHN_UNDEF, SHN_ABS) or not name:
+                    continue
+                symbols.add(Symbol(self._string_at(strtab_offset, name), value, size, sym_type))
+        return sorted(symbols, key=lambda s: (s.value, s.name))
+
+    def _iter_notes(self, offset: int, size: int):
+        end = offset + size
+        while offset + 12 <= end:
+            namesz, descsz, n_type = struct.unpack_from(self.endian + 'III', self.data, offset)
+            name_start = offset + 12
+            desc_start = name_start + ((namesz + 3) & ~3)
+            name = bytes(self.data[name_start:name_start + namesz]).rstrip(b'\0')
+            desc = bytes(self.data[desc_start:desc_start + descsz])
+            yield name, n_type, desc
+            offset = desc_start + ((descsz + 3) & ~3)
+
+    def build_id(self) -> Optional[bytes]:
+        """Raw GNU build ID, from .note.gnu.build-id or any note section/segment."""
+        areas = [(s.offset, s.size) for s in self.sections if s.type == SHT_NOTE]
+        areas += [(s.offset, s.filesz) for s in self.segments_of_type(PT_NOTE)]
+        section = self.section('.note.gnu.build-id')
+        if section is not None:
+            areas.insert(0, (section.offset, section.size))
+        for offset, size in areas:
+            for name, n_type, desc in self._iter_notes(offset, size):
+                if name == b'GNU' and n_type == NT_GNU_BUILD_ID:
+                    return desc
+        return None
+
+def describe_elf(path: str) -> dict:
+    """Collect the ELF values used by the upgrade in a single read of the file."""
+    with ElfFile(path) as elf:
+        info = {'type': elf.type}
+
+        build_id = elf.build_id()
+        info['build_id'] = build_id.hex() if build_id is not None else None
+
+        for name in ('.got', '.data'):
+            section = elf.section(name)
+            info[name[1:] + '_start'] = section.addr if section is not None else None
+
+        rw_load = elf.rw_load_segment()
+        info['rw_load'] = {'vaddr': rw_load.vaddr, 'filesz': rw_load.filesz, 'memsz': rw_load.memsz} \
+            if rw_load is not None else None
+
+        dynamic = elf.segments_of_type(PT_DYNAMIC)
+        info['dynamic'] = {'vaddr': dynamic[0].vaddr, 'filesz': dynamic[0].filesz} if dynamic else None
+    return info
+
+def upgrade_variables(exe: dict, old_lib: dict, new_lib: dict) -> dict:
+    """Shell variables used by update.sh, computed from the describe_elf output of the three files."""
+    def hex_or_empty(value):
+        return hex(value) if value is not None else ''
+
+    variables = {
+        'EXE_ELF_TYPE': exe['type'],
+        'LIB_ELF_TYPE': old_lib['type'],
+        'NEW_LIB_ELF_TYPE': new_lib['type'],
+        'FIRST_PAGE_ELF_START': hex_or_empty(exe['got_start']),
+        'FIRST_PAGE_ELF_END': hex_or_empty(exe['data_start']),
+        'EXE_BUILD_ID': exe['build_id'] or '',
+        'OLD_LIB_BUILD_ID': old_lib['build_id'] or '',
+        'NEW_LIB_BUILD_ID': new_lib['build_id'] or '',
+    }
+    rw_load = old_lib['rw_load'] or {}
+    variables['SECOND_PAGE_ELF_START'] = hex_or_empty(rw_load.get('vaddr'))
+    variables['SECOND_PAGE_ELF_SIZE'] = hex_or_empty(rw_load.get('filesz'))
+    variables['SECOND_PAGE_ELF_END'] = hex_or_empty(rw_load['vaddr'] + rw_load['filesz']) if rw_load else ''
+    dynamic = old_lib['dynamic'] or {}
+    variables['DYNAMIC_ELF_START'] = hex_or_empty(dynamic.get('vaddr'))
+    variables['DYNAMIC_ELF_SIZE'] = hex_or_empty(dynamic.get('filesz'))
+    variables['DYNAMIC_ELF_END'] = hex_or_empty(dynamic['vaddr'] + dynamic['filesz']) if dynamic else ''
+    return variables
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Extract the ELF information needed by the upgrade from the executable and the libraries.')
+    parser.add_argument('exe_file', help='Executable of the process')
+    parser.add_argument('old_lib_file', help='Library currently loaded by the process')
+    parser.add_argument('new_lib_file', help='Library to upgrade to')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the information of each file as JSON instead of shell variable assignments')
+
+    args = parser.parse_args()
+
+    try:
+        exe = describe_elf(args.exe_file)
+        old_lib = describe_elf(args.old_lib_file)
+        new_lib = describe_elf(args.new_lib_file)
+    except FileNotFoundError as e:
+        print(f"Error: File not found - {e}", file=sys.stderr)
+        sys.exit(1)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    if args.json:
+        print(json.dumps({'exe': exe, 'old_lib': old_lib, 'new_lib': new_lib}, indent=4))
+    else:
+        for name, value in upgrade_variables(exe, old_lib, new_lib).items():
+            print(f"{name}={shlex.quote(value)}")
+
+if __name__ == "__main__":
+    main()
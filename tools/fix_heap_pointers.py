@@ -0,0 +1,202 @@
+import argparse
+import json
+import mmap
+import os
+import sys
+import time
+from multiprocessing import Pool
+from typing import List, Optional, Tuple
+
+from mapping_index import IntervalIndex, MemoryMapping
+from shift_addresses import parse_mappings_file
+from symbol_table import load_symbol_table, symbol_ranges
+from translate_addresses import load_pagemap_chain
+from upgrade_report import record_metrics
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Regions are split in chunks of this size to spread them across the workers
+DEFAULT_CHUNK_SIZE = 64 << 20
+
+# The scan runs while the process is frozen, on hosts running other services and possibly
+# other upgrades at the same time: a few workers by default rather than every core
+DEFAULT_JOBS = min(4, os.cpu_count() or 1)
+
+def is_scanned_region(mapping: MemoryMapping) -> bool:
+    """Writable anonymous mappings and the heap may hold pointers into the library."""
+    return 'w' in mapping.perms and (mapping.path == '' or mapping.path == '[heap]')
+
+def library_range(mappings: List[MemoryMapping], lib_file: str) -> Tuple[int, int, int]:
+    """Return (base, start, end) of the mappings of lib_file, base being the mapping of file offset 0."""
+    lib_maps = [m for m in mappings if m.path == lib_file]
+    if not lib_maps:
+        raise ValueError(f"Library {lib_file} not found in the mappings")
+    base = min((m.start for m in lib_maps if m.offset == 0), default=min(m.start for m in lib_maps))
+    return base, min(m.start for m in lib_maps), max(m.end for m in lib_maps)
+
+def build_symbol_index(mappings: List[MemoryMapping], library_pairs: List[Tuple[str, str]],
+                       symbol_cache_dir: Optional[str] = None) -> Tuple[IntervalIndex, IntervalIndex]:
+    """
+    Return the index of the old libraries address ranges and the index of their symbols,
+    each carrying (shift to the same symbol in the new library, symbol name). Symbols
+    missing from the new library are left out, so pointers to them are not rewritten.
+    """
+    lib_ranges = []
+    ranges = []
+    for old_lib_file, new_lib_file in library_pairs:
+        base, lib_start, lib_end = library_range(mappings, old_lib_file)
+        lib_ranges.append((lib_start, lib_end, old_lib_file))
+        rows, _ = load_symbol_table(old_lib_file, new_lib_file, symbol_cache_dir)
+        ranges.extend(symbol_ranges(rows, base))
+    return IntervalIndex.from_prioritized(lib_ranges), IntervalIndex.from_prioritized(ranges)
+
+def scan_chunks(regions: List[MemoryMapping], page_chain: IntervalIndex,
+                chunk_size: int) -> List[Tuple[int, str, int, int]]:
+    """
+    Intersect the scanned regions with the dumped pages, as resolved by load_pagemap_chain,
+    return (vaddr, pages image, offset in the pages image, length) chunks of at most chunk_size bytes.
+    """
+    chunks = []
+    for region in sorted(regions, key=lambda m: m.start):
+        for start, end, (pages_file, delta, _) in page_chain.overlapping(region.start, region.end):
+            for chunk_start in range(start, end, chunk_size):
+                length = min(chunk_size, end - chunk_start)
+                chunks.append((chunk_start, pages_file, chunk_start + delta, length))
+    return chunks
+
+# State shared with the workers, set by init_worker
+_worker = {}
+
+def init_worker(lib_index, symbol_index):
+    _worker['lib_index'] = lib_index
+    _worker['symbol_index'] = symbol_index
+
+def scan_chunk(chunk: Tuple[int, str, int, int]) -> List[Tuple[int, str, int, int, int, Optional[str]]]:
+    """
+    Find the 64-bit words of a chunk pointing inside the old libraries.
+    Returns (vaddr, pages image, offset in the pages image, old value, new value or -1, symbol) per slot.
+    """
+    vaddr, pages_file, offset, length = chunk
+    lib_index = _worker['lib_index']
+    lib_start, lib_end = lib_index.starts[0], lib_index.lasts[-1] + 1
+    symbol_index = _worker['symbol_index']
+
+    # mmap offsets must be page aligned, the pages image offsets always are
+    with open(pages_file, 'rb') as f, \
+         mmap.mmap(f.fileno(), length, offset=offset, access=mmap.ACCESS_READ) as data:
+        count = length // 8
+        if np is not None:
+            words = np.frombuffer(data, dtype='<u8', count=count)
+            candidates = np.nonzero((words >= lib_start) & (words < lib_end))[0]
+            if len(lib_index) > 1 and len(candidates):
+                candidates = candidates[lib_index.find_many(words[candidates]) >= 0]
+            hits = [(int(i), int(words[i])) for i in candidates]
+            del words
+        else:
+            hits = []
+            for i in range(count):
+                value = int.from_bytes(data[i * 8:i * 8 + 8], 'little')
+                if lib_start <= value < lib_end and lib_index.find(value) >= 0:
+                    hits.append((i, value))
+
+    slots = []
+    for i, value in hits:
+        found = symbol_index.lookup(value)
+        if found is None:
+            slots.append((vaddr + i * 8, pages_file, offset + i * 8, value, -1, None))
+        else:
+            shift, name = found
+            slots.append((vaddr + i * 8, pages_file, offset + i * 8, value, value + shift, name))
+    return slots
+
+def fix_heap_pointers(checkpoint_dir: str, mappings: List[MemoryMapping], library_pairs: List[Tuple[str, str]],
+                      jobs: int, chunk_size: int, dry_run: bool = False, symbol_cache_dir: Optional[str] = None):
+    """Scan the dumped anonymous and heap regions in parallel and rewrite the pointers into the old libraries."""
+    lib_index, symbols = build_symbol_index(mappings, library_pairs, symbol_cache_dir)
+
+    # Pages left unchanged since a pre-dump are stored in the parent image sets
+    page_chain = load_pagemap_chain(checkpoint_dir)
+    chunks = scan_chunks([m for m in mappings if is_scanned_region(m)], page_chain, chunk_size)
+    scanned = sum(length for _, _, _, length in chunks)
+
+    init_args = (lib_index, symbols)
+    if jobs == 1 or len(chunks) <= 1:
+        init_worker(*init_args)
+        results = [scan_chunk(chunk) for chunk in chunks]
+    else:
+        with Pool(jobs, initializer=init_worker, initargs=init_args) as pool:
+            results = pool.map(scan_chunk, chunks)
+    slots = [slot for result in results for slot in result]
+
+    rewritten = {}
+    for _, pages_file, offset, old_value, new_value, _ in slots:
+        if new_value >= 0 and new_value != old_value:
+            rewritten.setdefault(pages_file, []).append((offset, new_value))
+    if not dry_run:
+        for pages_file, values in rewritten.items():
+            with open(pages_file, 'r+b') as f, \
+                 mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE) as pages:
+                for offset, new_value in values:
+                    pages[offset:offset + 8] = new_value.to_bytes(8, 'little')
+                pages.flush()
+
+    return scanned, slots
+
+def write_heap_report(report_file: str, scanned: int, slots, dry_run: bool):
+    """Write the JSON report of every slot found, return (rewritten, unresolved) counts."""
+    rewritten = sum(1 for slot in slots if slot[4] >= 0 and slot[4] != slot[3])
+    unresolved = sum(1 for slot in slots if slot[4] < 0)
+    with open(report_file, 'w') as f:
+        json.dump({
+            'scanned_bytes': scanned,
+            'rewritten': rewritten,
+            'unresolved': unresolved,
+            'dry_run': dry_run,
+            'slots': [{'vaddr': hex(vaddr), 'old': hex(old), 'new': hex(new) if new >= 0 else None, 'symbol': name}
+                      for vaddr, _, _, old, new, name in slots],
+        }, f, indent=4)
+    return rewritten, unresolved
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Rewrite pointers into the old libraries found in the anonymous and heap regions of a checkpoint.')
+    parser.add_argument('checkpoint_directory', help='Directory containing the pagemap and pages files')
+    parser.add_argument('--maps', required=True, help='/proc/PID/maps of the process at checkpoint time')
+    parser.add_argument('--library', nargs=2, action='append', required=True, metavar=('OLD_FILE', 'NEW_FILE'),
+                        help='Library file as it appears in the mappings and the new library file, can be repeated')
+    parser.add_argument('--jobs', type=int, default=DEFAULT_JOBS,
+                        help='Number of worker processes (default: the number of cores, at most 4)')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='Size in bytes of the chunks the regions are split in, multiple of the page size')
+    parser.add_argument('--report', default='heap_pointers.json', help='Report of every slot found (default: heap_pointers.json)')
+    parser.add_argument('--dry-run', action='store_true', help='Only write the report, do not modify the pages image')
+    parser.add_argument('--symbol-cache', help='Directory of the cached symbol tables (default: see symbol_table.py)')
+
+    args = parser.parse_args()
+
+    if args.chunk_size <= 0 or args.chunk_size % mmap.ALLOCATIONGRANULARITY:
+        print(f"Error: The chunk size must be a positive multiple of {mmap.ALLOCATIONGRANULARITY}")
+        sys.exit(1)
+
+    start_wall = time.time()
+    try:
+        mappings = parse_mappings_file(args.maps)
+        scanned, slots = fix_heap_pointers(args.checkpoint_directory, mappings, args.library,
+                                           max(1, args.jobs), args.chunk_size, args.dry_run, args.symbol_cache)
+    except FileNotFoundError as e:
+        print(f"Error: File not found - {e}")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    rewritten, unresolved = write_heap_report(args.report, scanned, slots, args.dry_run)
+
+    print(f"Scanned {scanned} bytes: {rewritten} pointer(s) rewritten, {unresolved} unresolved, report written to {args.report}")
+    record_metrics('fix_heap_pointers', start_wall, bytes_translated=scanned, pointers_rewritten=rewritten)
+
+if __name__ == "__main__":
+    main()
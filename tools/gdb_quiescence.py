@@ -0,0 +1,129 @@
+# GDB extension waiting until no thread is executing inside given address ranges.
+# Load it with "source gdb_quiescence.py", then run:
+#   wait-quiescence 0x7ffff7fa0000-0x7ffff7fbe000 [START-END ...]
+# The process is resumed and stopped on every syscall, until the stack of every
+# thread is outside all the ranges, bounds included.
+# The time each thread kept the process waiting is recorded with the metrics.
+import os
+import sys
+import time
+from bisect import bisect_right
+
+import gdb
+
+# gdb does not add the directory of a sourced script to the module path
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from upgrade_report import record_metrics
+
+def parse_ranges(args):
+    """Parse START-END hex ranges, return them sorted as (starts, ends) lists."""
+    ranges = []
+    for arg in args:
+        start, sep, end = arg.partition('-')
+        if not sep:
+            raise gdb.GdbError(f"Invalid range '{arg}', expected START-END")
+        try:
+            ranges.append((int(start, 16), int(end, 16)))
+        except ValueError:
+            raise gdb.GdbError(f"Invalid hex value in range '{arg}'")
+    if not ranges:
+        raise gdb.GdbError("At least one START-END range is required")
+    ranges.sort()
+    return [start for start, _ in ranges], [end for _, end in ranges]
+
+def in_ranges(address, starts, ends):
+    pos = bisect_right(starts, address) - 1
+    return pos >= 0 and address <= ends[pos]
+
+def thread_inside_ranges(thread, starts, ends):
+    """Whether any frame of the thread has its pc inside the ranges."""
+    thread.switch()
+    frame = gdb.newest_frame()
+    while frame is not None:
+        if in_ranges(frame.pc(), starts, ends):
+            return True
+        try:
+            frame = frame.older()
+        except gdb.error:  # Unwinding failed, nothing more to check
+            break
+    return False
+
+def threads_inside_ranges(starts, ends):
+    """
+    Check every thread of the current inferior, return (LWPs of all the threads,
+    LWPs of the threads executing inside the ranges).
+    """
+    selected = gdb.selected_thread()
+    lwps = []
+    inside = []
+    try:
+        for thread in gdb.selected_inferior().threads():
+            if not thread.is_valid():
+                continue
+            lwp = thread.ptid[1]
+            lwps.append(lwp)
+            if thread_inside_ranges(thread, starts, ends):
+                inside.append(lwp)
+        return lwps, inside
+    finally:
+        if selected is not None and selected.is_valid():
+            selected.switch()
+
+class WaitQuiescence(gdb.Command):
+    """Resume the process, stopping on every syscall, until no thread has a frame inside the given ranges.
+Usage: wait-quiescence START-END [START-END ...]
+Sets $quiescence_stops and $quiescence_usecs when done."""
+
+    def __init__(self):
+        super().__init__("wait-quiescence", gdb.COMMAND_RUNNING)
+
+    def invoke(self, argument, from_tty):
+        starts, ends = parse_ranges(gdb.string_to_argv(argument))
+
+        existing = {bp.number for bp in gdb.breakpoints()}
+        gdb.execute("catch syscall", to_string=True)
+        catchpoints = [bp for bp in gdb.breakpoints() if bp.number not in existing]
+
+        # Per thread LWP: stops at which it was inside the ranges, time it was last seen inside
+        stops_inside = {}
+        last_inside = {}
+        stops = 0
+        check_time = 0.0
+        start_wall = time.time()
+        start_time = time.perf_counter()
+        try:
+            while True:
+                gdb.execute("continue", to_string=True)
+                if not gdb.selected_inferior().pid:
+                    raise gdb.GdbError("The process exited before reaching quiescence")
+                stops += 1
+                check_start = time.perf_counter()
+                lwps, inside = threads_inside_ranges(starts, ends)
+                check_time += time.perf_counter() - check_start
+                for lwp in lwps:
+                    stops_inside.setdefault(lwp, 0)
+                for lwp in inside:
+                    stops_inside[lwp] += 1
+                    last_inside[lwp] = check_start - start_time
+                if not inside:
+                    break
+        finally:
+            for bp in catchpoints:
+                bp.delete()
+
+        elapsed = time.perf_counter() - start_time
+        # A thread stopped delaying the upgrade the last time it was seen inside the ranges
+        threads = sorted(({'lwp': lwp, 'stops_inside': count, 'wait_seconds': round(last_inside.get(lwp, 0.0), 6)}
+                          for lwp, count in stops_inside.items()),
+                         key=lambda t: (-t['wait_seconds'], t['lwp']))
+        record_metrics('quiescence_wait', start_wall, stops=stops, threads=threads)
+        gdb.set_convenience_variable("quiescence_stops", stops)
+        gdb.set_convenience_variable("quiescence_usecs", int(elapsed * 1e6))
+        print(f"Quiescence reached after {stops} stop(s) in {elapsed:.6f} s "
+              f"(average check {check_time / stops * 1e6:.1f} us, {len(threads)} thread(s))")
+        for thread in threads:
+            if thread['stops_inside']:
+                print(f"  Thread {thread['lwp']}: inside for {thread['stops_inside']} stop(s), "
+                      f"last seen inside after {thread['wait_seconds']:.6f} s")
+
+WaitQuiescence()
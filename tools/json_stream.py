@@ -0,0 +1,122 @@
+import json
+from typing import Callable, Optional, TextIO, Tuple
+
+# Characters read from the input at a time, an entry larger than this grows the buffer
+READ_SIZE = 1 << 20
+
+# Separators of the compact output, as used by update_files_img.py
+COMPACT = (',', ':')
+
+WHITESPACE = ' \t\n\r'
+
+_decoder = json.JSONDecoder()
+
+class JsonReader:
+    """
+    Incremental reader of a JSON document, decoding one value at a time from a
+    buffer holding only the part of the file not consumed yet.
+    """
+
+    def __init__(self, f: TextIO, read_size: int = READ_SIZE):
+        self.f = f
+        self.read_size = read_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+
+    def _read_more(self):
+        # Drop what was consumed, then read at least as much as is buffered so
+        # that re-decoding a large value after every read stays linear overall
+        self.buffer = self.buffer[self.pos:]
+        self.pos = 0
+        data = self.f.read(max(self.read_size, len(self.buffer)))
+        if data:
+            self.buffer += data
+        else:
+            self.eof = True
+
+    def peek(self) -> str:
+        """Return the next non-whitespace character without consuming it, '' at the end of the file."""
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return ''
+            self._read_more()
+
+    def expect(self, char: str):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected '{char}' but found '{found or 'end of file'}'")
+        self.pos += 1
+
+    def value(self):
+        """Decode the next complete JSON value."""
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.pos)
+                # A number ending with the buffer may continue in the next read
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self._read_more()
+
+def rewrite_image_json(input_file: TextIO, output_file: TextIO, magic: str,
+                       transform: Callable[[dict], int], read_size: int = READ_SIZE) -> Tuple[int, int]:
+    """
+    Stream a crit-decoded image, {"magic": ..., "entries": [...]}, from input_file to
+    output_file in compact form. Only one entry is held in memory at a time; transform
+    edits it in place and returns how many changes it made.
+    Returns (number of entries, number of changes).
+    """
+    reader = JsonReader(input_file, read_size)
+    found_magic: Optional[str] = None
+    entries = 0
+    changes = 0
+
+    reader.expect('{')
+    output_file.write('{')
+    first = True
+    while reader.peek() != '}':
+        if not first:
+            reader.expect(',')
+            output_file.write(',')
+        first = False
+        key = reader.value()
+        reader.expect(':')
+        output_file.write(json.dumps(key) + ':')
+        if key != 'entries':
+            value = reader.value()
+            if key == 'magic':
+                if value != magic:
+                    raise ValueError(f"Invalid magic value {value}, expected {magic}")
+                found_magic = value
+            output_file.write(json.dumps(value, separators=COMPACT))
+            continue
+
+        reader.expect('[')
+        output_file.write('[')
+        while reader.peek() != ']':
+            if entries:
+                reader.expect(',')
+                output_file.write(',')
+            entry = reader.value()
+            changes += transform(entry)
+            output_file.write(json.dumps(entry, separators=COMPACT))
+            entries += 1
+        reader.expect(']')
+        output_file.write(']')
+    reader.expect('}')
+    output_file.write('}')
+
+    if reader.peek():
+        raise ValueError("Unexpected data after the end of the image")
+    if found_magic != magic:
+        raise ValueError(f"Invalid magic value {found_magic}, expected {magic}")
+    return entries, changes
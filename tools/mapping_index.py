@@ -0,0 +1,164 @@
+import heapq
+import re
+from array import array
+from bisect import bisect_right
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class MemoryMapping:
+    __slots__ = ('start', 'end', 'perms', 'offset', 'path', 'size')
+
+    def __init__(self, start: int, end: int, perms: str, offset: int, path: str = ""):
+        self.start = start
+        self.end = end
+        self.perms = perms
+        self.offset = offset
+        self.path = path
+        self.size = end - start
+
+    @staticmethod
+    def parse_proc_line(line: str) -> 'MemoryMapping':
+        # Example line: 7ff7bcee7000-7ff7bcee8000 r--p 00000000 08:01 2753574    /usr/lib64/ld-linux-x86-64.so.2
+        pattern = r'([0-9a-f]+)-([0-9a-f]+)\s+([rwxps-]+)\s+([0-9a-f]+)\s+([0-9a-f]+:[0-9a-f]+)\s+(\d+)\s*(.*)'
+        match = re.match(pattern, line.strip())
+        if not match:
+            raise ValueError(f"Invalid mapping line: {line}")
+
+        return MemoryMapping(
+            start=int(match.group(1), 16),
+            end=int(match.group(2), 16),
+            perms=match.group(3),
+            offset=int(match.group(4), 16),
+            path=match.group(7).strip()
+        )
+
+    @staticmethod
+    def parse_gdb_line(line: str) -> 'MemoryMapping':
+        # Example: 0x400000           0x401000     0x1000        0x0  r--p   /path/to/file
+        pattern = r'\s*0x([0-9a-f]+)\s+0x([0-9a-f]+)\s+0x[0-9a-f]+\s+0x([0-9a-f]+)\s+([rwxp-]+)\s*(.*)'
+        match = re.match(pattern, line.strip())
+        if not match:
+            raise ValueError(f"Invalid GDB mapping line: {line}")
+
+        return MemoryMapping(
+            start=int(match.group(1), 16),
+            end=int(match.group(2), 16),
+            perms=match.group(4),
+            offset=int(match.group(3), 16),
+            path=match.group(5).strip()
+        )
+
+
+    def __str__(self):
+        return f"{hex(self.start)}-{hex(self.end)} {self.perms} {hex(self.offset)} {self.path}"
+
+class IntervalIndex:
+    """
+    Sorted index of disjoint [start, end) intervals, each carrying a value.
+    Answers "which interval contains address X" with a binary search.
+    """
+    __slots__ = ('starts', 'lasts', 'values', '_np_starts', '_np_lasts')
+
+    def __init__(self, intervals: Iterable[Tuple[int, int, Any]]):
+        # Bounds are stored inclusive so that they always fit in 64 bits
+        self.starts = array('Q')
+        self.lasts = array('Q')
+        self.values = []
+        self._np_starts = None
+        self._np_lasts = None
+
+        for start, end, value in sorted((i for i in intervals if i[1] > i[0]), key=lambda i: i[0]):
+            if self.lasts and start <= self.lasts[-1]:
+                raise ValueError(f"Overlapping intervals at {hex(start)}")
+            self.starts.append(start)
+            self.lasts.append(end - 1)
+            self.values.append(value)
+
+    @classmethod
+    def from_mappings(cls, mappings: Iterable[MemoryMapping]) -> 'IntervalIndex':
+        """Index mappings by address range, the value being the mapping itself."""
+        return cls((m.start, m.end, m) for m in mappings)
+
+    @classmethod
+    def from_prioritized(cls, intervals: Iterable[Tuple[int, int, Any]]) -> 'IntervalIndex':
+        """
+        Build an index from possibly overlapping [start, end) intervals.
+        Where intervals overlap the one listed first wins; contiguous pieces
+        carrying the same value are merged.
+        """
+        intervals = list(intervals)
+        boundaries = sorted({start for start, _, _ in intervals} | {end for _, end, _ in intervals})
+        by_start = {}
+        for priority, (start, end, value) in enumerate(intervals):
+            by_start.setdefault(start, []).append((priority, end, value))
+
+        pieces = []
+        active = []  # Heap of (priority, end, value), ended entries are dropped lazily
+        for low, next_low in zip(boundaries, boundaries[1:]):
+            for item in by_start.get(low, ()):
+                heapq.heappush(active, item)
+            while active and active[0][1] <= low:
+                heapq.heappop(active)
+            if not active:
+                continue
+
+            value = active[0][2]
+            if pieces and pieces[-1][1] == low and pieces[-1][2] == value:
+                pieces[-1] = (pieces[-1][0], next_low, value)
+            else:
+                pieces.append((low, next_low, value))
+        return cls(pieces)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        for start, last, value in zip(self.starts, self.lasts, self.values):
+            yield start, last + 1, value
+
+    def find(self, address: int) -> int:
+        """Return the position of the interval containing address, or -1."""
+        pos = bisect_right(self.starts, address) - 1
+        if pos >= 0 and address <= self.lasts[pos]:
+            return pos
+        return -1
+
+    def lookup(self, address: int) -> Optional[Any]:
+        """Return the value of the interval containing address, or None."""
+        pos = self.find(address)
+        return self.values[pos] if pos >= 0 else None
+
+    def find_many(self, addresses):
+        """
+        Batch form of find. A numpy uint64 array is resolved in one vectorized
+        pass and an array of positions is returned; any other iterable gives a list.
+        """
+        if np is not None and isinstance(addresses, np.ndarray):
+            if self._np_starts is None:
+                self._np_starts = np.frombuffer(self.starts, dtype=np.uint64) if len(self) else np.zeros(0, np.uint64)
+                self._np_lasts = np.frombuffer(self.lasts, dtype=np.uint64) if len(self) else np.zeros(0, np.uint64)
+            positions = np.searchsorted(self._np_starts, addresses, side='right').astype(np.int64) - 1
+            if not len(self):
+                return positions
+            valid = positions >= 0
+            positions[~valid] = 0
+            valid &= addresses <= self._np_lasts[positions]
+            positions[~valid] = -1
+            return positions
+        return [self.find(address) for address in addresses]
+
+    def lookup_many(self, addresses) -> List[Optional[Any]]:
+        """Batch form of lookup, always returning a list."""
+        return [self.values[pos] if pos >= 0 else None for pos in self.find_many(addresses)]
+
+    def overlapping(self, start: int, end: int) -> Iterator[Tuple[int, int, Any]]:
+        """Yield the intervals overlapping [start, end), clipped to it, as (start, end, value)."""
+        pos = max(bisect_right(self.starts, start) - 1, 0)
+        while pos < len(self.starts) and self.starts[pos] < end:
+            if self.lasts[pos] >= start:
+                yield max(self.starts[pos], start), min(self.lasts[pos] + 1, end), self.values[pos]
+            pos += 1
@@ -0,0 +1,148 @@
+import argparse
+import io
+import mmap
+import os
+import sys
+import time
+
+from shift_addresses import parse_mappings_file, select_engine, translate
+from translate_addresses import load_pagemap_chain
+from upgrade_report import record_metrics
+
+def parse_patch(spec):
+    """Parse a VADDR:FILE patch specification."""
+    vaddr, sep, blob_file = spec.partition(':')
+    if not sep or not blob_file:
+        raise argparse.ArgumentTypeError(f"Invalid patch '{spec}', expected VADDR:FILE")
+    try:
+        return int(vaddr, 0), blob_file
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid virtual address in patch '{spec}'")
+
+def translate_blob(blob_file, src_mappings, dst_mappings, relocations=None, dump_start=None):
+    """
+    Translate a synthetic execution dump into an in-memory buffer, same as shift_addresses.py
+    without writing the translated file. Returns (blob, number of addresses translated).
+    """
+    engine, slots = select_engine('vectorized', blob_file, 64, relocations, dump_start)
+    output = io.BytesIO()
+    with open(blob_file, 'rb') as input_file:
+        translated = translate(input_file, output, src_mappings, dst_mappings, 64, engine, slots)
+    return output.getvalue(), translated
+
+def resolve_patches(patches, page_chain):
+    """
+    Resolve each (vaddr, blob) patch to (pages file, offset in the file, vaddr, bytes) pieces,
+    using the index built by load_pagemap_chain: a patch spanning pages stored in
+    different image sets of a pre-dump chain is split between their pages images.
+    Raises ValueError if a patch lands in pages that were not dumped or, inside an
+    image set, crosses the boundary of a pagemap entry: all the pieces of a patch
+    stored in the same pages image must belong to the same entry.
+    """
+    resolved = []
+    for vaddr, blob in patches:
+        address = vaddr
+        end = vaddr + len(blob)
+        entries = {}  # Pages file -> (start of the pagemap entry, start of the first piece in it)
+        while address < end:
+            pos = page_chain.find(address)
+            if pos < 0:
+                raise ValueError(f"Patch at {hex(vaddr)} targets pages that are not dumped in this image"
+                                 f" ({hex(address)})")
+            piece_end = min(end, page_chain.lasts[pos] + 1)
+            pages_file, delta, entry_start = page_chain.values[pos]
+            first_entry, first_address = entries.setdefault(pages_file, (entry_start, address))
+            if first_entry != entry_start:
+                raise ValueError(f"Patch {hex(vaddr)}-{hex(end - 1)} crosses the boundary of the pagemap entry "
+                                 f"at {hex(first_entry)} of {pages_file} ({hex(first_address)} and {hex(address)})")
+            resolved.append((pages_file, address + delta, address, blob[address - vaddr:piece_end - vaddr]))
+            address = piece_end
+
+    resolved.sort(key=lambda r: (r[0], r[1]))
+    for (pages_file, offset, vaddr, blob), (next_file, next_offset, next_vaddr, _) in zip(resolved, resolved[1:]):
+        if pages_file == next_file and offset + len(blob) > next_offset:
+            raise ValueError(f"Patches at {hex(vaddr)} and {hex(next_vaddr)} overlap")
+    return resolved
+
+def write_patches(resolved):
+    """Write every resolved patch into its pages image in place, in one pass per image."""
+    by_file = {}
+    for pages_file, offset, vaddr, blob in resolved:
+        by_file.setdefault(pages_file, []).append((offset, vaddr, blob))
+
+    for pages_file, pieces in by_file.items():
+        with open(pages_file, 'r+b') as f:
+            size = os.fstat(f.fileno()).st_size
+            offset, vaddr, blob = pieces[-1]
+            if offset + len(blob) > size:
+                raise ValueError(f"Patch at {hex(vaddr)} ends past the end of {pages_file}")
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE) as pages:
+                for offset, _, blob in pieces:
+                    pages[offset:offset + len(blob)] = blob
+                pages.flush()
+
+def main():
+    parser = argparse.ArgumentParser(description="Write memory blobs at virtual addresses into the pages image of a checkpoint.")
+    parser.add_argument("checkpoint_directory", help="Directory containing the pagemap and pages files")
+    parser.add_argument("patches", nargs="+", type=parse_patch,
+                        help="Patches as VADDR:FILE, the content of FILE is written at virtual address VADDR")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the cached pagemap index")
+    parser.add_argument("--translate", nargs=2, metavar=("SRC_MAPS", "DST_MAPS"),
+                        help="Translate the addresses of every FILE in memory before writing it, from the synthetic "
+                             "execution mappings (GDB format) to the process mappings (proc format)")
+    parser.add_argument("--relocations", nargs=3, action="append", default=[], metavar=("FILE", "ELF_FILE", "DUMP_START"),
+                        help="With --translate, only translate the slots of FILE relocated by the dynamic linker "
+                             "in ELF_FILE, FILE starting at ELF virtual address DUMP_START")
+
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.checkpoint_directory):
+        print("Error: Provided path is not a directory.")
+        sys.exit(1)
+
+    relocations = {}
+    for blob_file, elf_file, dump_start in args.relocations:
+        try:
+            relocations[blob_file] = (elf_file, int(dump_start, 0))
+        except ValueError:
+            parser.error(f"Invalid dump start '{dump_start}'")
+    if relocations and not args.translate:
+        parser.error("--relocations requires --translate")
+
+    start_wall = time.time()
+    try:
+        if args.translate:
+            src_mappings = parse_mappings_file(args.translate[0], gdb_format=True)
+            dst_mappings = parse_mappings_file(args.translate[1])
+
+        patches = []
+        for vaddr, blob_file in args.patches:
+            if args.translate:
+                # The translated dump goes straight from memory into the pages image
+                translate_start = time.time()
+                blob, translated = translate_blob(blob_file, src_mappings, dst_mappings, *relocations.get(blob_file, ()))
+                record_metrics('shift_addresses', translate_start, file=blob_file, in_memory=True,
+                               bytes_translated=len(blob), pointers_rewritten=translated)
+            else:
+                with open(blob_file, 'rb') as f:
+                    blob = f.read()
+            patches.append((vaddr, blob))
+
+        # Pages left unchanged since a pre-dump are patched in the parent image set holding them
+        page_chain = load_pagemap_chain(args.checkpoint_directory, not args.no_cache)
+        resolved = resolve_patches(patches, page_chain)
+        write_patches(resolved)
+    except FileNotFoundError as e:
+        print(f"Error: File not found - {e}")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    for pages_file, offset, vaddr, blob in sorted(resolved, key=lambda r: r[2]):
+        print(f"Patched {len(blob)} bytes at {hex(vaddr)} (offset {hex(offset)} in {pages_file})")
+    record_metrics('patch_pages', start_wall, patches=len(patches),
+                   bytes_patched=sum(len(blob) for _, _, _, blob in resolved))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+from criu_image import PAGEMAP_FLAG_NAMES, PE_LAZY, parse_pagemap_flags
+from mapping_index import IntervalIndex
+from patch_pages import parse_patch
+from translate_addresses import PAGE_SIZE
+from upgrade_report import record_metrics
+
+def format_pagemap_flags(flags, like):
+    """Format flags the way crit printed the original ones: a number, or names joined by ' | '."""
+    if isinstance(like, int):
+        return flags
+    return ' | '.join(name for name, value in PAGEMAP_FLAG_NAMES.items() if flags & value)
+
+def pinned_page_ranges(patches, heap_report=None):
+    """
+    Page-aligned [start, end) ranges written by the upgrade, merged and sorted: the patched
+    dumps, given as (vaddr, file), and the slots rewritten by fix_heap_pointers.py.
+    """
+    ranges = [(vaddr, vaddr + os.path.getsize(blob_file)) for vaddr, blob_file in patches]
+    if heap_report:
+        with open(heap_report, 'r') as f:
+            report = json.load(f)
+        for slot in report['slots']:
+            if slot['new'] is not None and slot['new'] != slot['old']:
+                vaddr = int(slot['vaddr'], 16)
+                ranges.append((vaddr, vaddr + 8))
+
+    merged = []
+    for start, end in sorted((start - start % PAGE_SIZE, -(-end // PAGE_SIZE) * PAGE_SIZE) for start, end in ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+def pin_entries(data, ranges):
+    """
+    Clear PE_LAZY on the pages of decoded pagemap data inside the ranges, splitting the
+    entries at the range bounds so that only those pages are restored eagerly. The
+    order of the pages in the pages image is unchanged. Returns the number of pages pinned.
+    """
+    if data.get('magic') != 'PAGEMAP':
+        raise ValueError("Invalid magic value in the pagemap JSON file")
+
+    index = IntervalIndex((start, end, True) for start, end in ranges)
+    entries = []
+    pinned = 0
+    for entry in data['entries']:
+        flags = parse_pagemap_flags(entry['flags']) if 'flags' in entry else 0
+        if 'vaddr' not in entry or not flags & PE_LAZY:
+            entries.append(entry)
+            continue
+
+        vaddr = entry['vaddr']
+        start = int(vaddr, 0) if isinstance(vaddr, str) else vaddr
+        end = start + entry['nr_pages'] * PAGE_SIZE
+
+        def piece(piece_start, piece_end, piece_flags):
+            split = dict(entry)
+            split['vaddr'] = hex(piece_start) if isinstance(vaddr, str) else piece_start
+            split['nr_pages'] = (piece_end - piece_start) // PAGE_SIZE
+            split['flags'] = format_pagemap_flags(piece_flags, entry['flags'])
+            entries.append(split)
+
+        position = start
+        for pinned_start, pinned_end, _ in index.overlapping(start, end):
+            if position < pinned_start:
+                piece(position, pinned_start, flags)
+            piece(pinned_start, pinned_end, flags & ~PE_LAZY)
+            pinned += (pinned_end - pinned_start) // PAGE_SIZE
+            position = pinned_end
+        if position == start:
+            entries.append(entry)
+        elif position < end:
+            piece(position, end, flags)
+    data['entries'] = entries
+    return pinned
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Restore the pages written by the upgrade eagerly when the other pages are restored lazily.')
+    parser.add_argument('pagemap_json', help='pagemap.json decoded from the pagemap image of the checkpoint')
+    parser.add_argument('patches', nargs='*', type=parse_patch, metavar='VADDR:FILE',
+                        help='Dump written at VADDR by patch_pages.py, only its size is read')
+    parser.add_argument('--heap-report', help='Report of fix_heap_pointers.py, the pages of its rewritten slots are pinned too')
+
+    args = parser.parse_args()
+
+    start_wall = time.time()
+    try:
+        ranges = pinned_page_ranges(args.patches, args.heap_report)
+        with open(args.pagemap_json, 'r') as f:
+            data = json.load(f)
+        pinned = pin_entries(data, ranges)
+        with open(args.pagemap_json, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+    except FileNotFoundError as e:
+        print(f"Error: File not found - {e}")
+        sys.exit(1)
+    except (KeyError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    print(f"{pinned} page(s) in {len(ranges)} range(s) will be restored eagerly")
+    record_metrics('pin_pages', start_wall, pages_pinned=pinned)
+
+if __name__ == "__main__":
+    main()
@@ -1,54 +1,110 @@
+import argparse
 import json
+import os
 import sys
+import time
+
+from json_stream import rewrite_image_json
+from upgrade_report import peak_rss_kib, record_metrics
 
 ALIVE_CODE = 1
 
-def update_json_file(json_file_path):
+def set_entry_alive(entry):
+    """
+    Set the task_state of the 'tc' of one core entry to alive, return 1 if it changed.
+    Only the core of the thread group leader has a 'tc', the other threads are left as they are.
+    """
+    tc = entry.get('tc')
+    if tc:
+        task_state = tc['task_state']
+        if (task_state != ALIVE_CODE):
+            tc['task_state'] = ALIVE_CODE
+            return 1
+    return 0
+
+def set_tasks_alive(data):
+    """
+    Set the task_state of every 'tc' entry of decoded core image data to alive.
+    Returns the number of entries updated.
+    """
+    # Check that MAGIC is "CORE"
+    if data['magic'] != "CORE":
+        raise ValueError("Invalid magic value in the JSON file")
+
+    # Update task_state for all 'tc' entries
+    return sum(set_entry_alive(entry) for entry in data['entries'])
+
+def stream_json_file(json_file_path):
     """
-    Updates the task_state in the JSON file to 'alive' for all entries of type 'tc'.
+    Same update as set_tasks_alive, streaming the entries one at a time and writing
+    the file back compact. Returns the number of entries updated.
     """
+    tmp_path = json_file_path + '.tmp'
     try:
-        with open(json_file_path, 'r') as json_file:
-            data = json.load(json_file)
-
-        # Check that MAGIC is "CORE"
-        if data['magic'] != "CORE":
-            raise ValueError("Invalid magic value in the JSON file")
-
-        # Update task_state for all 'tc' entries
-        updated_entries = 0
-        for entry in data['entries']:
-            tc = entry['tc']
-            if tc:
-                task_state = tc['task_state']
-                if (task_state != ALIVE_CODE):
-                    tc['task_state'] = ALIVE_CODE
-                    updated_entries += 1
-
-        if updated_entries == 0:
-            print("No tasks found to update")
-            return
-
-        # Write updated data back to the JSON file
-        with open(json_file_path, 'w') as json_file:
-            json.dump(data, json_file, indent=4)
-
-        print(f"Successfully updated {updated_entries} task(s) to 'Alive'")
-
-    except FileNotFoundError:
-        print(f"File {json_file_path} not found")
-        sys.exit(1)
-    except json.JSONDecodeError:
-        print(f"Invalid JSON format in {json_file_path}")
-        sys.exit(1)
-    except Exception as e:
-        print(f"An error occurred: {str(e)}")
-        sys.exit(1)
+        with open(json_file_path, 'r') as json_file, open(tmp_path, 'w') as output_file:
+            _, updated_entries = rewrite_image_json(json_file, output_file, 'CORE', set_entry_alive)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    if updated_entries == 0:
+        os.unlink(tmp_path)
+    else:
+        os.replace(tmp_path, json_file_path)
+    return updated_entries
 
-if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print("Usage: python3 update_json.py <json_file_path>")
-        sys.exit(1)
+def update_json_files(json_file_paths, stream=False):
+    """
+    Updates the task_state in the JSON files to 'alive' for all entries of type 'tc'.
+    All the core images of a checkpoint, one per thread, are handled in a single pass.
+    """
+    start_wall = time.time()
+    updated_entries = 0
+    for json_file_path in json_file_paths:
+        try:
+            if stream:
+                updated_entries += stream_json_file(json_file_path)
+                continue
+
+            with open(json_file_path, 'r') as json_file:
+                data = json.load(json_file)
+
+            updated = set_tasks_alive(data)
+            if updated == 0:
+                continue
+
+            # Write updated data back to the JSON file
+            with open(json_file_path, 'w') as json_file:
+                json.dump(data, json_file, indent=4)
+            updated_entries += updated
+
+        except FileNotFoundError:
+            print(f"File {json_file_path} not found")
+            sys.exit(1)
+        except json.JSONDecodeError:
+            print(f"Invalid JSON format in {json_file_path}")
+            sys.exit(1)
+        except Exception as e:
+            print(f"An error occurred in {json_file_path}: {str(e)}")
+            sys.exit(1)
 
-    json_file_path = sys.argv[1]
-    update_json_file(json_file_path)
+    if updated_entries == 0:
+        print("No tasks found to update")
+    else:
+        print(f"Successfully updated {updated_entries} task(s) to 'Alive' in {len(json_file_paths)} file(s)")
+    peak_rss = peak_rss_kib()
+    print(f"Peak memory: {peak_rss / 1024:.1f} MiB")
+    record_metrics('set_thread_alive', start_wall, tasks_updated=updated_entries, core_files=len(json_file_paths),
+                   stream=stream, peak_rss_kib=peak_rss)
+
+def main():
+    parser = argparse.ArgumentParser(description="Set the state of every task of CRIU core.json files to alive.")
+    parser.add_argument('json_files', nargs='+', metavar='json_file_path', help='core.json decoded from a core-TID.img')
+    parser.add_argument('--stream', action='store_true',
+                        help='Stream the entries instead of loading whole files, the files are written back compact')
+
+    args = parser.parse_args()
+    update_json_files(args.json_files, args.stream)
+
+if __name__ == "__main__":
+    main()
@@ -1,51 +1,21 @@
 import argparse
+import mmap
+import os
 import re
-from typing import BinaryIO, List
-
-class MemoryMapping:
-    def __init__(self, start: int, end: int, perms: str, offset: int, path: str = ""):
-        self.start = start
-        self.end = end
-        self.perms = perms
-        self.offset = offset
-        self.path = path
-        self.size = end - start
-
-    @staticmethod
-    def parse_proc_line(line: str) -> 'MemoryMapping':
-        # Example line: 7ff7bcee7000-7ff7bcee8000 r--p 00000000 08:01 2753574    /usr/lib64/ld-linux-x86-64.so.2
-        pattern = r'([0-9a-f]+)-([0-9a-f]+)\s+([rwxps-]+)\s+([0-9a-f]+)\s+([0-9a-f]+:[0-9a-f]+)\s+(\d+)\s*(.*)'
-        match = re.match(pattern, line.strip())
-        if not match:
-            raise ValueError(f"Invalid mapping line: {line}")
-        
-        return MemoryMapping(
-            start=int(match.group(1), 16),
-            end=int(match.group(2), 16),
-            perms=match.group(3),
-            offset=int(match.group(4), 16),
-            path=match.group(7).strip()
-        )
-
-    @staticmethod
-    def parse_gdb_line(line: str) -> 'MemoryMapping':
-        # Example: 0x400000           0x401000     0x1000        0x0  r--p   /path/to/file
-        pattern = r'\s*0x([0-9a-f]+)\s+0x([0-9a-f]+)\s+0x[0-9a-f]+\s+0x([0-9a-f]+)\s+([rwxp-]+)\s*(.*)'
-        match = re.match(pattern, line.strip())
-        if not match:
-            raise ValueError(f"Invalid GDB mapping line: {line}")
-        
-        return MemoryMapping(
-            start=int(match.group(1), 16),
-            end=int(match.group(2), 16),
-            perms=match.group(4),
-            offset=int(match.group(3), 16),
-            path=match.group(5).strip()
-        )
+import time
+from typing import BinaryIO, List, Optional, Tuple
 
+from elf_info import ElfFile
+from mapping_index import IntervalIndex, MemoryMapping
+from upgrade_report import record_metrics
 
-    def __str__(self):
-        return f"{hex(self.start)}-{hex(self.end)} {self.perms} {hex(self.offset)} {self.path}"
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Number of words translated at once by the vectorized engine
+VECTOR_CHUNK_WORDS = 1 << 22
 
 def parse_mappings_file(filename: str, gdb_format: bool = False) -> List[MemoryMapping]:
     with open(filename, 'r') as f:
@@ -145,12 +115,8 @@ def validate_grouped_mappings(src_groups: dict, dst_groups: dict):
                 else:
                     raise ValueError(msg)
 
-def process_file(input_file: BinaryIO, output_file: BinaryIO, 
-                src_mappings: List[MemoryMapping], dst_mappings: List[MemoryMapping], 
-                address_size: int):
-    """Process the binary file and translate addresses based on mappings."""
-    chunk_size = address_size // 8
-    
+def build_translations(src_mappings: List[MemoryMapping], dst_mappings: List[MemoryMapping]) -> List[Tuple[int, int, int]]:
+    """Pair source and destination regions and return the (start, end, shift) list."""
     # Group mappings by normalized path
     src_groups = group_mappings_by_path(src_mappings)
     dst_groups = group_mappings_by_path(dst_mappings)
@@ -182,6 +148,25 @@ def process_file(input_file: BinaryIO, output_file: BinaryIO,
             print(f"  Shift:       {hex(shift)}")
             print(f"  Permissions: {src.perms}")
 
+    return translations
+
+def build_translation_index(translations: List[Tuple[int, int, int]]) -> IntervalIndex:
+    """
+    Index the translations by source range, the value being the shift.
+    Bounds in the translations list are inclusive; where translations overlap
+    (e.g. adjacent regions sharing an end address) the one listed first wins,
+    the same precedence as a linear scan of the list.
+    """
+    return IntervalIndex.from_prioritized((start, end + 1, shift) for start, end, shift in translations)
+
+def process_file(input_file: BinaryIO, output_file: BinaryIO, 
+                src_mappings: List[MemoryMapping], dst_mappings: List[MemoryMapping], 
+                address_size: int):
+    """Process the binary file and translate addresses based on mappings, return the number of addresses translated."""
+    chunk_size = address_size // 8
+    index = build_translation_index(build_translations(src_mappings, dst_mappings))
+    translated = 0
+
     print("\nProcessing file...")
     while True:
         chunk = input_file.read(chunk_size)
@@ -194,18 +179,153 @@ def process_file(input_file: BinaryIO, output_file: BinaryIO,
             
         address = int.from_bytes(chunk, byteorder='little')
         
-        # Check each mapping range
-        modified = False
-        for start, end, shift in translations:
-            if start <= address <= end:
-                new_address = address + shift
-                output_file.write(new_address.to_bytes(chunk_size, byteorder='little'))
-                modified = True
-                break
-        
-        if not modified:
+        # Look up the mapping range containing the address
+        shift = index.lookup(address)
+        if shift is not None:
+            new_address = address + shift
+            output_file.write(new_address.to_bytes(chunk_size, byteorder='little'))
+            translated += 1
+        else:
             output_file.write(chunk)
 
+    return translated
+
+def process_file_vectorized(input_file: BinaryIO, output_file: BinaryIO,
+                            src_mappings: List[MemoryMapping], dst_mappings: List[MemoryMapping],
+                            address_size: int):
+    """
+    Same translation as process_file, but the input is memory-mapped and every word
+    is resolved against the sorted shift ranges in bulk with numpy.searchsorted.
+    Returns the number of addresses translated.
+    """
+    if np is None:
+        raise RuntimeError("The vectorized engine requires numpy")
+
+    chunk_size = address_size // 8
+    word_type = np.dtype('<u8') if address_size == 64 else np.dtype('<u4')
+    index = build_translation_index(build_translations(src_mappings, dst_mappings))
+
+    # Shifts are kept as uint64 in two's complement so that a wrapping
+    # addition yields the translated address
+    shifts = np.array([shift & 0xffffffffffffffff for shift in index.values], dtype=np.uint64)
+
+    # Words of each range whose translation fits in a word: the others make the
+    # legacy engine raise OverflowError, where the addition above would wrap
+    limit = (1 << address_size) - 1
+    lows = []
+    highs = []
+    for start, last, shift in zip(index.starts, index.lasts, index.values):
+        low, high = max(start, -shift), min(last, limit - shift, limit)
+        if low > high:
+            low, high = 1, 0  # No word of the range can be translated
+        lows.append(low)
+        highs.append(high)
+    lows = np.array(lows, dtype=np.uint64)
+    highs = np.array(highs, dtype=np.uint64)
+
+    print("\nProcessing file...")
+    file_size = os.fstat(input_file.fileno()).st_size
+    translated = 0
+    if file_size == 0:
+        return translated
+
+    with mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+        total_words = file_size // chunk_size
+        for first in range(0, total_words, VECTOR_CHUNK_WORDS):
+            count = min(VECTOR_CHUNK_WORDS, total_words - first)
+            words = np.frombuffer(buffer, dtype=word_type, count=count,
+                                  offset=first * chunk_size).astype(np.uint64)
+
+            positions = index.find_many(words)
+            hit = positions >= 0
+            hit_positions = positions[hit]
+            overflow = (words[hit] < lows[hit_positions]) | (words[hit] > highs[hit_positions])
+            if overflow.any():
+                address = int(words[hit][np.argmax(overflow)])
+                raise OverflowError(f"Translation of {hex(address)} does not fit in {address_size} bits")
+            words[hit] += shifts[hit_positions]
+            translated += int(np.count_nonzero(hit))
+
+            output_file.write(words.astype(word_type).tobytes())
+
+        # Trailing bytes that do not form a whole word are copied as they are
+        tail = file_size - total_words * chunk_size
+        if tail:
+            output_file.write(buffer[file_size - tail:])
+
+    return translated
+
+def load_relocation_slots(elf_file: str, dump_start: int, dump_size: int, address_size: int,
+                          pointer_slots: Optional[List[int]] = None) -> List[int]:
+    """
+    Offsets in the dump of the pointer-sized slots filled by the dynamic linker
+    (RELATIVE, GLOB_DAT, JUMP_SLOT and 64-bit absolute relocations of elf_file).
+    dump_start is the ELF virtual address the dump begins at. pointer_slots, when
+    given, are the ElfFile.pointer_slots() of elf_file already read by the caller.
+    """
+    chunk_size = address_size // 8
+    if pointer_slots is not None:
+        slots = pointer_slots
+    else:
+        with ElfFile(elf_file) as elf:
+            slots = elf.pointer_slots()
+    return [slot - dump_start for slot in slots
+            if dump_start <= slot and slot - dump_start + chunk_size <= dump_size]
+
+def process_file_relocations(input_file: BinaryIO, output_file: BinaryIO,
+                             src_mappings: List[MemoryMapping], dst_mappings: List[MemoryMapping],
+                             address_size: int, slots: List[int]) -> int:
+    """
+    Translate only the words at the given slot offsets, copying everything else
+    unchanged. Returns the number of addresses translated.
+    """
+    chunk_size = address_size // 8
+    index = build_translation_index(build_translations(src_mappings, dst_mappings))
+
+    print(f"\nProcessing {len(slots)} relocated slot(s)...")
+    data = bytearray(input_file.read())
+    translated = 0
+    for offset in slots:
+        address = int.from_bytes(data[offset:offset + chunk_size], byteorder='little')
+        shift = index.lookup(address)
+        if shift is not None:
+            new_address = address + shift
+            data[offset:offset + chunk_size] = new_address.to_bytes(chunk_size, byteorder='little')
+            translated += 1
+
+    output_file.write(data)
+    return translated
+
+def select_engine(engine: str, input_file: str, address_size: int,
+                  relocations: Optional[str] = None, dump_start: Optional[int] = None,
+                  pointer_slots: Optional[List[int]] = None):
+    """
+    Return (engine, relocated slots) for translating input_file, falling back to the
+    legacy engine without numpy and to a full scan when no relocation falls inside the dump.
+    """
+    if engine == 'vectorized' and np is None:
+        print("Warning: numpy not available, falling back to the legacy engine")
+        engine = 'legacy'
+    slots = None
+    if relocations:
+        slots = load_relocation_slots(relocations, dump_start, os.path.getsize(input_file), address_size, pointer_slots)
+        if slots:
+            engine = 'relocations'
+        else:
+            print(f"No relocation of {relocations} inside the dump, scanning every word")
+    print(f"Using {engine} engine")
+    return engine, slots
+
+def translate(input_file: BinaryIO, output_file: BinaryIO,
+              src_mappings: List[MemoryMapping], dst_mappings: List[MemoryMapping],
+              address_size: int, engine: str, slots: Optional[List[int]] = None) -> int:
+    """Run the engine chosen by select_engine, return the number of addresses translated."""
+    if engine == 'relocations':
+        return process_file_relocations(input_file, output_file, src_mappings, dst_mappings, address_size, slots)
+    if engine == 'vectorized':
+        return process_file_vectorized(input_file, output_file, src_mappings, dst_mappings, address_size)
+    return process_file(input_file, output_file, src_mappings, dst_mappings, address_size)
+
 def main():
     parser = argparse.ArgumentParser(
         description='Translate addresses in a binary file based on memory mappings.',
@@ -221,8 +341,17 @@ def main():
                         help='Parse source mapping file in GDB "info proc mappings" format')
     parser.add_argument('--dst-gdb', action='store_true',
                         help='Parse destination mapping file in GDB "info proc mappings" format')
+    parser.add_argument('--engine', choices=['vectorized', 'legacy'], default='vectorized',
+                        help='Translation engine (vectorized requires numpy, default: vectorized)')
+    parser.add_argument('--relocations', metavar='ELF_FILE',
+                        help='Only translate the slots relocated by the dynamic linker in ELF_FILE, '
+                             'scanning every word only if no relocation falls inside the dump')
+    parser.add_argument('--dump-start', type=lambda x: int(x, 0),
+                        help='ELF virtual address the input dump starts at, required with --relocations')
     
     args = parser.parse_args()
+    if args.relocations and args.dump_start is None:
+        parser.error("--dump-start is required with --relocations")
 
     try:
         # Parse mapping files
@@ -238,10 +367,21 @@ def main():
         print(f"Source mappings: {len(src_mappings)} entries")
         print(f"Destination mappings: {len(dst_mappings)} entries")
 
+        engine, slots = select_engine(args.engine, args.input_file, args.bits, args.relocations, args.dump_start)
+
         with open(args.input_file, 'rb') as input_file, \
              open(args.output_file, 'wb') as output_file:
-            process_file(input_file, output_file, src_mappings, dst_mappings, args.bits)
+            start_wall = time.time()
+            start_time = time.perf_counter()
+            translated = translate(input_file, output_file, src_mappings, dst_mappings, args.bits, engine, slots)
+            elapsed = time.perf_counter() - start_time
             print(f"\nProcessing complete. Output written to {args.output_file}")
+
+        input_size = os.path.getsize(args.input_file)
+        throughput = input_size / (1024 * 1024) / elapsed if elapsed > 0 else float('inf')
+        print(f"Translated {input_size} bytes in {elapsed:.3f} s ({throughput:.2f} MB/s), {translated} address(es) rewritten")
+        record_metrics('shift_addresses', start_wall, file=args.input_file, engine=engine,
+                       bytes_translated=input_size, pointers_rewritten=translated)
             
     except FileNotFoundError as e:
         print(f"Error: File not found - {e}")
@@ -0,0 +1,134 @@
+import argparse
+import json
+import os
+import sys
+import time
+from typing import List, Optional, Tuple
+
+from elf_info import ElfFile
+from mapping_index import IntervalIndex
+from upgrade_report import record_metrics
+
+# Tables are cached per (old build ID, new build ID) pair, so that they are built once per library pair
+CACHE_ENV = 'SYMBOL_TABLE_CACHE_DIR'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'auto_upgrade', 'symbols')
+TABLE_VERSION = 1
+
+def build_symbol_table(old_lib_file: str, new_lib_file: str) -> List[Tuple[int, int, int, str]]:
+    """
+    Old to new address table of the functions and objects defined by both libraries,
+    read from .symtab and .dynsym. Rows are (old address, length, new address, name),
+    ELF virtual addresses sorted by old address: old address + k translates to
+    new address + k for k < length, length being the part of the old symbol that
+    still exists in the new one. Symbols sharing a name (static symbols of different
+    files) are paired in address order.
+    """
+    with ElfFile(old_lib_file) as old_elf:
+        old_symbols = old_elf.symbols()
+    with ElfFile(new_lib_file) as new_elf:
+        new_by_name = {}
+        for symbol in new_elf.symbols():
+            new_by_name.setdefault(symbol.name, []).append(symbol)
+
+    rows = []
+    seen = {}
+    for symbol in old_symbols:
+        occurrence = seen.get(symbol.name, 0)
+        seen[symbol.name] = occurrence + 1
+        candidates = new_by_name.get(symbol.name, ())
+        if occurrence >= len(candidates):
+            continue
+        new_symbol = candidates[occurrence]
+        length = max(min(symbol.size, new_symbol.size), 1)
+        rows.append((symbol.value, length, new_symbol.value, symbol.name))
+    rows.sort(key=lambda r: (r[0], r[3]))
+    return rows
+
+def cache_file_name(old_lib_file: str, new_lib_file: str) -> Optional[str]:
+    """Name of the cached table of the pair, None if a library has no build ID to key it on."""
+    with ElfFile(old_lib_file) as old_elf:
+        old_build_id = old_elf.build_id()
+    with ElfFile(new_lib_file) as new_elf:
+        new_build_id = new_elf.build_id()
+    if old_build_id is None or new_build_id is None:
+        return None
+    return f"{old_build_id.hex()}-{new_build_id.hex()}.json"
+
+def load_symbol_table(old_lib_file: str, new_lib_file: str,
+                      cache_dir: Optional[str] = None) -> Tuple[List[Tuple[int, int, int, str]], bool]:
+    """Return (table, whether it came from the cache), building and caching it on a miss."""
+    cache_dir = cache_dir or os.environ.get(CACHE_ENV) or DEFAULT_CACHE_DIR
+    name = cache_file_name(old_lib_file, new_lib_file)
+    cache_file = os.path.join(cache_dir, name) if name else None
+    if cache_file:
+        try:
+            with open(cache_file, 'r') as f:
+                cached = json.load(f)
+            if cached['version'] == TABLE_VERSION:
+                return [tuple(row) for row in cached['symbols']], True
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+    rows = build_symbol_table(old_lib_file, new_lib_file)
+    if cache_file:
+        try:
+            os.makedirs(cache_dir, exist_ok=True)
+            with open(cache_file + '.tmp', 'w') as f:
+                json.dump({'version': TABLE_VERSION, 'old_lib_file': os.path.realpath(old_lib_file),
+                           'new_lib_file': os.path.realpath(new_lib_file), 'symbols': rows}, f)
+            os.replace(cache_file + '.tmp', cache_file)
+        except OSError as e:
+            print(f"Warning: could not write the symbol table cache: {e}", file=sys.stderr)
+    return rows, False
+
+def symbol_ranges(rows: List[Tuple[int, int, int, str]], base: int) -> List[Tuple[int, int, Tuple[int, str]]]:
+    """
+    Runtime address ranges of the old symbols, the library being loaded at base, each carrying
+    (shift to the same symbol of the new library loaded at the same base, symbol name).
+    """
+    return [(base + old, base + old + length, (new - old, name)) for old, length, new, name in rows]
+
+def symbol_index(rows: List[Tuple[int, int, int, str]], base: int) -> IntervalIndex:
+    """Index of symbol_ranges for O(log n) lookups, where symbols overlap (aliases) the first in the table wins."""
+    return IntervalIndex.from_prioritized(symbol_ranges(rows, base))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Build the old to new symbol address table of a library pair, cached per pair of build IDs.')
+    parser.add_argument('old_lib_file', help='Library being replaced')
+    parser.add_argument('new_lib_file', help='New library')
+    parser.add_argument('--cache-dir', help=f'Cache directory (default: ${CACHE_ENV} or {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--lookup', nargs='+', default=[], metavar='ADDRESS',
+                        help='Old library virtual addresses to translate and print')
+
+    args = parser.parse_args()
+
+    start_wall = time.time()
+    try:
+        rows, cached = load_symbol_table(args.old_lib_file, args.new_lib_file, args.cache_dir)
+        addresses = [int(address, 0) for address in args.lookup]
+    except FileNotFoundError as e:
+        print(f"Error: File not found - {e}")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    moved = sum(1 for old, _, new, _ in rows if old != new)
+    print(f"{len(rows)} symbol(s) in both libraries, {moved} moved ({'cached' if cached else 'built'})")
+    record_metrics('symbol_table', start_wall, symbols=len(rows), cached=cached)
+
+    # ELF virtual addresses, as if the library was loaded at 0
+    index = symbol_index(rows, 0)
+    symbol_starts = {(new - old, name): old for old, _, new, name in reversed(rows)}
+    for address in addresses:
+        value = index.lookup(address)
+        if value is None:
+            print(f"{hex(address)}: not inside a symbol of both libraries")
+            continue
+        shift, name = value
+        old = symbol_starts[value]
+        print(f"{hex(address)} -> {hex(address + shift)} ({name}+{hex(address - old)})")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import argparse
+import contextlib
+import errno
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from elf_info import describe_elf
+
+# Files produced by the synthetic execution of the executable with the new libraries:
+# the mappings, the dump of the executable and one dump per library
+MAPPINGS_ARTIFACT = 'synthetic_mappings.txt'
+
+META_FILE = 'meta.json'
+# Held shared while an entry is read, exclusive while entries are replaced or evicted
+LOCK_FILE = '.lock'
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'auto_upgrade', 'synthetic')
+DEFAULT_MAX_SIZE = 1 << 30
+
+def artifacts(library_count):
+    return [MAPPINGS_ARTIFACT, 'memory_dump_1.bin'] + [f'memory_dump_{i + 2}.bin' for i in range(library_count)]
+
+def cache_key(exe_file, library_pairs):
+    """
+    Content address of the synthetic execution artifacts: build IDs of the executable
+    and of the new libraries, plus the ELF layout the dumps are taken from.
+    Returns (key, description of what was hashed).
+    """
+    exe = describe_elf(exe_file)
+    libraries = []
+    for old_lib_file, new_lib_file in library_pairs:
+        old_lib = describe_elf(old_lib_file)
+        new_lib = describe_elf(new_lib_file)
+        libraries.append({
+            'new_lib_file': os.path.realpath(new_lib_file),
+            'new_lib_build_id': new_lib['build_id'],
+            'old_lib_rw_load': old_lib['rw_load'],
+        })
+    inputs = {
+        'exe_file': os.path.realpath(exe_file),
+        'exe_build_id': exe['build_id'],
+        'layout': {
+            'exe_type': exe['type'],
+            'got_start': exe['got_start'],
+            'data_start': exe['data_start'],
+        },
+        'libraries': libraries,
+    }
+    key = hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+    return key, inputs
+
+@contextlib.contextmanager
+def cache_lock(cache_dir, exclusive=False):
+    """Lock the cache directory: prepare.sh may run for several groups of processes at once."""
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(os.path.join(cache_dir, LOCK_FILE), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+        yield
+
+def entry_size(entry_dir):
+    return sum(os.path.getsize(os.path.join(entry_dir, f)) for f in os.listdir(entry_dir))
+
+def is_cached(cache_dir, key, names):
+    entry_dir = os.path.join(cache_dir, key)
+    return all(os.path.isfile(os.path.join(entry_dir, f)) for f in names)
+
+def fetch(cache_dir, key, names, dest_dir):
+    """Copy the cached artifacts into dest_dir, return False on a miss."""
+    with cache_lock(cache_dir):
+        if not is_cached(cache_dir, key, names):
+            return False
+        entry_dir = os.path.join(cache_dir, key)
+        for name in names:
+            shutil.copyfile(os.path.join(entry_dir, name), os.path.join(dest_dir, name))
+        # The entry mtime records the last use, for the LRU eviction
+        os.utime(entry_dir)
+    return True
+
+def store(cache_dir, key, inputs, names, src_dir):
+    """
+    Atomically add the artifacts found in src_dir to the cache. Returns False if a
+    complete entry was stored concurrently, the artifacts being the same for a key.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    entry_dir = os.path.join(cache_dir, key)
+    staging_dir = tempfile.mkdtemp(prefix='.staging-', dir=cache_dir)
+    stale_dir = None
+    try:
+        for name in names:
+            shutil.copyfile(os.path.join(src_dir, name), os.path.join(staging_dir, name))
+        with open(os.path.join(staging_dir, META_FILE), 'w') as f:
+            json.dump({'inputs': inputs, 'created': time.time()}, f, indent=4)
+
+        with cache_lock(cache_dir, exclusive=True):
+            if is_cached(cache_dir, key, names):
+                return False
+            # An incomplete entry is moved away first, it is removed once the new one is in place
+            if os.path.isdir(entry_dir):
+                stale_dir = tempfile.mkdtemp(prefix='.stale-', dir=cache_dir)
+                os.rename(entry_dir, os.path.join(stale_dir, key))
+            try:
+                os.rename(staging_dir, entry_dir)
+            except OSError as e:
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                    raise
+                return False
+        return True
+    finally:
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        if stale_dir:
+            shutil.rmtree(stale_dir, ignore_errors=True)
+
+def evict(cache_dir, max_size, keep=None):
+    """
+    Remove the least recently used entries until the cache fits in max_size bytes,
+    once no entry is being fetched.
+    """
+    with cache_lock(cache_dir, exclusive=True):
+        entries = []
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if os.path.isdir(path) and not name.startswith('.'):
+                entries.append((os.path.getmtime(path), entry_size(path), name))
+
+        total = sum(size for _, size, _ in entries)
+        evicted = []
+        for _, size, name in sorted(entries):
+            if total <= max_size:
+                break
+            if name == keep:
+                continue
+            shutil.rmtree(os.path.join(cache_dir, name), ignore_errors=True)
+            total -= size
+            evicted.append(name)
+    return evicted
+
+def main():
+    parser = argparse.ArgumentParser(description='Content-addressed cache of the synthetic execution artifacts.')
+    parser.add_argument('action', choices=['key', 'has', 'fetch', 'store'],
+                        help='key: print the cache key; has: exit 0 if cached, 2 otherwise; '
+                             'fetch: copy cached artifacts to DIR; store: add the artifacts in DIR')
+    parser.add_argument('exe_file', help='Executable of the process')
+    parser.add_argument('libraries', nargs='+', metavar='OLD_FILE NEW_FILE',
+                        help='Library currently loaded by the process followed by the library to upgrade to')
+    parser.add_argument('-d', '--directory', default='.', help='Destination (fetch) or source (store) directory')
+    parser.add_argument('--cache-dir', default=os.environ.get('SYNTHETIC_CACHE_DIR') or DEFAULT_CACHE_DIR,
+                        help='Cache directory (default: $SYNTHETIC_CACHE_DIR or ~/.cache/auto_upgrade/synthetic)')
+    parser.add_argument('--max-size', type=int, default=int(os.environ.get('SYNTHETIC_CACHE_MAX_SIZE') or DEFAULT_MAX_SIZE),
+                        help='Maximum cache size in bytes, least recently used entries are evicted (default: 1 GiB)')
+
+    args = parser.parse_args()
+
+    try:
+        if len(args.libraries) % 2 != 0:
+            raise ValueError("Libraries must be given as OLD_FILE NEW_FILE pairs")
+        pairs = list(zip(args.libraries[::2], args.libraries[1::2]))
+        names = artifacts(len(pairs))
+        key, inputs = cache_key(args.exe_file, pairs)
+
+        if args.action == 'key':
+            print(key)
+        elif args.action == 'has':
+            if not is_cached(args.cache_dir, key, names):
+                print(f"Cache miss for {key}")
+                sys.exit(2)
+            print(f"Cache hit for {key}")
+        elif args.action == 'fetch':
+            if not fetch(args.cache_dir, key, names, args.directory):
+                print(f"Cache miss for {key}")
+                sys.exit(2)
+            print(f"Cache hit for {key}")
+        else:
+            if store(args.cache_dir, key, inputs, names, args.directory):
+                print(f"Stored {key}")
+            else:
+                print(f"Already cached {key}")
+            for name in evict(args.cache_dir, args.max_size, keep=key):
+                print(f"Evicted {name}")
+
+    except FileNotFoundError as e:
+        print(f"Error: File not found - {e}")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
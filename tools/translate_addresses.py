@@ -4,9 +4,19 @@ import subprocess
 import json
 import argparse
 
+from criu_image import (PagemapEntry, iter_pagemap_entries, normalize_pagemap_flags,
+                        parse_pagemap_flags, read_pagemap_head)
+from mapping_index import IntervalIndex
+
 # Define the page size in bytes
 PAGE_SIZE = 4096
 
+# Suffix of the parsed pagemap index cached next to the pagemap image
+INDEX_CACHE_SUFFIX = '.index.json'
+
+# Link to the previous image set created by criu when dumping with --prev-images-dir
+PARENT_LINK = 'parent'
+
 def find_pagemap_file(directory):
     # List all files in the specified directory
     files = os.listdir(directory)
@@ -31,58 +41,183 @@ def decode_pagemap_file(filepath):
         print(f"Error decoding file with crit: {e}")
         sys.exit(1)
 
+def read_pagemap_file(filepath):
+    # Read the binary pagemap image directly, without going through crit and JSON
+    try:
+        with open(filepath, 'rb') as f:
+            pages_id = read_pagemap_head(f)
+            entries = list(iter_pagemap_entries(f))
+        return pages_id, entries
+    except ValueError as e:
+        print(f"Error reading pagemap file {filepath}: {e}")
+        sys.exit(1)
+
 def process_json_data(json_data, result_only):
+    pages_id, entries = json_pagemap_entries(json_data)
+    return pages_id, process_pagemap_entries(entries, result_only)
+
+def json_pagemap_entries(json_data):
     # Check if the JSON data contains the expected structure
     if json_data.get("magic") != "PAGEMAP":
         print("Error: Missing or incorrect 'magic' field.")
         sys.exit(1)
 
-    entries = json_data["entries"]
+    entries = []
+    pages_id = 0
+    for entry in json_data["entries"]:
+        # The head carries the id of the pages image, then come entries with 'vaddr' and 'nr_pages'
+        if 'pages_id' in entry:
+            pages_id = entry['pages_id']
+        elif 'vaddr' in entry and 'nr_pages' in entry:
+            flags = parse_pagemap_flags(entry['flags']) if 'flags' in entry else None
+            flags = normalize_pagemap_flags(flags, entry.get('in_parent', False))
+            vaddr = entry['vaddr']
+            if isinstance(vaddr, str):  # Hex string when decoded with --pretty
+                vaddr = int(vaddr, 0)
+            entries.append(PagemapEntry(vaddr, entry['nr_pages'], flags))
+
+    return pages_id, entries
+
+def parent_page_ranges(entries):
+    # Virtual address ranges of the entries whose pages are stored in the parent image set
+    return [(entry.vaddr, entry.vaddr + entry.nr_pages * PAGE_SIZE) for entry in entries if entry.in_parent]
+
+def process_pagemap_entries(entries, result_only):
     position = 0
-    address_mapping = {}
+    ranges = []
 
     for entry in entries:
-        # Check if entry contains 'vaddr' and 'nr_pages'
-        if 'vaddr' in entry and 'nr_pages' in entry:
-            vaddr = entry['vaddr']
-            nr_pages = entry['nr_pages']
+        vaddr = entry.vaddr
+        nr_pages = entry.nr_pages
+
+        # Calculate the end address
+        end_vaddr = vaddr + nr_pages * PAGE_SIZE
+
+        # Pages in the parent image set or made of zeros are not stored in this pages image
+        if not entry.has_data:
+            if not result_only:
+                reason = "in parent" if entry.in_parent else "zero pages" if entry.is_zero else "not dumped"
+                print(f"Skipped: Virtual Address Range {hex(vaddr)} - {hex(end_vaddr - 1)} ({reason})")
+            continue
+
+        # Calculate the range of addresses inside the page
+        start_address_inside_page = position * PAGE_SIZE
+        end_address_inside_page = start_address_inside_page + nr_pages * PAGE_SIZE
 
-            # Calculate the end address
-            end_vaddr = vaddr + nr_pages * PAGE_SIZE
+        # Store the mapping
+        ranges.append((vaddr, end_vaddr, start_address_inside_page))
 
-            # Calculate the range of addresses inside the page
-            start_address_inside_page = position * PAGE_SIZE
-            end_address_inside_page = start_address_inside_page + nr_pages * PAGE_SIZE
+        # Print the range of virtual addresses and their corresponding range inside the page if not in result-only mode
+        if not result_only:
+            print(f"Position {position}: Virtual Address Range {hex(vaddr)} - {hex(end_vaddr - 1)}, "
+                  f"Address Range Inside Page: {hex(start_address_inside_page)} - {hex(end_address_inside_page - 1)}")
 
-            # Store the mapping
-            address_mapping[(vaddr, end_vaddr)] = (start_address_inside_page, end_address_inside_page)
+        # Increment position by the number of pages
+        position += nr_pages
 
-            # Print the range of virtual addresses and their corresponding range inside the page if not in result-only mode
+    # Index the virtual address ranges, the value is the start address inside the page
+    return IntervalIndex(ranges)
+
+def load_cached_index(pagemap_file):
+    # Return the cached index if it was built from the current pagemap image
+    cache_file = pagemap_file + INDEX_CACHE_SUFFIX
+    try:
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+        stat = os.stat(pagemap_file)
+        if cache['size'] != stat.st_size or cache['mtime_ns'] != stat.st_mtime_ns:
+            return None
+        return (cache['pages_id'], IntervalIndex(tuple(r) for r in cache['ranges']),
+                [tuple(r) for r in cache['parent_ranges']])
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+
+def store_cached_index(pagemap_file, pages_id, address_mapping, parent_ranges):
+    # Save the index next to the pagemap image, failures only cost a decode next time
+    cache_file = pagemap_file + INDEX_CACHE_SUFFIX
+    stat = os.stat(pagemap_file)
+    cache = {
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'pages_id': pages_id,
+        'ranges': [list(r) for r in address_mapping],
+        'parent_ranges': [list(r) for r in parent_ranges],
+    }
+    try:
+        with open(cache_file + '.tmp', 'w') as f:
+            json.dump(cache, f)
+        os.replace(cache_file + '.tmp', cache_file)
+    except OSError as e:
+        print(f"Warning: could not write the pagemap index cache: {e}", file=sys.stderr)
+
+def load_pagemap(pagemap_file, result_only, use_cache=True, use_crit=False):
+    # Return (pages image id, address mapping), reading the pagemap only if there is no valid cached index
+    pages_id, address_mapping, _ = load_pagemap_index(pagemap_file, result_only, use_cache, use_crit)
+    return pages_id, address_mapping
+
+def load_pagemap_index(pagemap_file, result_only, use_cache=True, use_crit=False):
+    # Same as load_pagemap, also returning the ranges of the pages stored in the parent image set
+    if use_cache:
+        cached = load_cached_index(pagemap_file)
+        if cached is not None:
             if not result_only:
-                print(f"Position {position}: Virtual Address Range {hex(vaddr)} - {hex(end_vaddr - 1)}, "
-                      f"Address Range Inside Page: {hex(start_address_inside_page)} - {hex(end_address_inside_page - 1)}")
+                print(f"Using cached pagemap index: {pagemap_file + INDEX_CACHE_SUFFIX}")
+            return cached
+
+    if use_crit:
+        pages_id, entries = json_pagemap_entries(decode_pagemap_file(pagemap_file))
+    else:
+        pages_id, entries = read_pagemap_file(pagemap_file)
+    address_mapping = process_pagemap_entries(entries, result_only)
+    parent_ranges = parent_page_ranges(entries)
+    if use_cache:
+        store_cached_index(pagemap_file, pages_id, address_mapping, parent_ranges)
+    return pages_id, address_mapping, parent_ranges
 
-            # Increment position by the number of pages
-            position += nr_pages
+def load_pagemap_chain(checkpoint_dir, use_cache=True):
+    """
+    Resolve every dumped page of an image set to the pages image holding its data,
+    following the parent links left by pre-dumps: pages stored in this set win,
+    pages marked as in parent are resolved in the parent set, recursively.
+    Returns an IntervalIndex whose values are (pages file, offset in the file - vaddr,
+    start of the pagemap entry of that image set), so that entries are not merged.
+    """
+    pagemap_file = find_pagemap_file(checkpoint_dir)
+    pages_id, address_mapping, parent_ranges = load_pagemap_index(pagemap_file, True, use_cache)
+    pages_file = os.path.join(checkpoint_dir, f"pages-{pages_id}.img")
+    ranges = [(start, end, (pages_file, offset - start, start)) for start, end, offset in address_mapping]
 
-    return address_mapping
+    parent_dir = os.path.join(checkpoint_dir, PARENT_LINK)
+    # Without the parent image set, the pages it holds are left out as if they were not dumped
+    if parent_ranges and os.path.isdir(parent_dir):
+        parent_chain = load_pagemap_chain(parent_dir, use_cache)
+        for start, end in parent_ranges:
+            ranges.extend(parent_chain.overlapping(start, end))
+    return IntervalIndex.from_prioritized(ranges)
+
+def read_addresses(stream):
+    # Parse whitespace separated addresses, skipping empty lines
+    return [int(token, 0) for line in stream for token in line.split()]
 
 def find_address_inside_page(virtual_address, address_mapping):
     # Find the virtual address range that contains the given address
-    for (vaddr_range, addr_range_inside_page) in address_mapping.items():
-        if vaddr_range[0] <= virtual_address < vaddr_range[1]:
-            # Calculate the offset from the start of the virtual address range
-            offset = virtual_address - vaddr_range[0]
-            # Compute the address inside the page by adding the offset to the start address inside the page
-            address_inside_page = addr_range_inside_page[0] + offset
-            return address_inside_page
-    return None
+    pos = address_mapping.find(virtual_address)
+    if pos < 0:
+        return None
+    # Calculate the offset from the start of the virtual address range
+    offset = virtual_address - address_mapping.starts[pos]
+    # Compute the address inside the page by adding the offset to the start address inside the page
+    return address_mapping.values[pos] + offset
 
 def main():
-    parser = argparse.ArgumentParser(description="Translate a virtual address to an address inside a page.")
+    parser = argparse.ArgumentParser(description="Translate virtual addresses to addresses inside a page.")
     parser.add_argument("checkpoint_directory", help="Directory containing the pagemap file")
-    parser.add_argument("virtual_address", type=lambda x: int(x, 0), help="Virtual address to look up (supports hex with 0x prefix)")
-    parser.add_argument("--result-only", action="store_true", help="Only print the result of the address lookup")
+    parser.add_argument("virtual_addresses", nargs="*", type=lambda x: int(x, 0),
+                        help="Virtual addresses to look up (supports hex with 0x prefix)")
+    parser.add_argument("--stdin", action="store_true", help="Also read addresses from stdin, whitespace separated")
+    parser.add_argument("--result-only", action="store_true", help="Only print the results, one per line in input order")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the cached pagemap index")
+    parser.add_argument("--crit", action="store_true", help="Decode the pagemap through 'crit decode' instead of reading it directly")
     
     args = parser.parse_args()
 
@@ -90,23 +225,39 @@ def main():
         print("Error: Provided path is not a directory.")
         sys.exit(1)
 
+    addresses = list(args.virtual_addresses)
+    if args.stdin:
+        try:
+            addresses += read_addresses(sys.stdin)
+        except ValueError as e:
+            print(f"Error: Invalid address on stdin: {e}")
+            sys.exit(1)
+    if not addresses:
+        print("Error: No virtual address to look up.")
+        sys.exit(1)
+
     pagemap_file = find_pagemap_file(args.checkpoint_directory)
     if not args.result_only:
         print(f"Found pagemap file: {pagemap_file}")
 
-    json_data = decode_pagemap_file(pagemap_file)
-    address_mapping = process_json_data(json_data, args.result_only)
+    pages_id, address_mapping = load_pagemap(pagemap_file, args.result_only, not args.no_cache, args.crit)
+    if not args.result_only:
+        print(f"Pages image: pages-{pages_id}.img")
 
-    address_inside_page = find_address_inside_page(args.virtual_address, address_mapping)
-    if address_inside_page is not None:
-        if not args.result_only:
-            print(f"Virtual Address {hex(args.virtual_address)} maps to Address Inside Page: {hex(address_inside_page)}")
+    failed = False
+    for virtual_address in addresses:
+        address_inside_page = find_address_inside_page(virtual_address, address_mapping)
+        if address_inside_page is not None:
+            if not args.result_only:
+                print(f"Virtual Address {hex(virtual_address)} maps to Address Inside Page: {hex(address_inside_page)}")
+            else:
+                print(hex(address_inside_page))
         else:
-            print(hex(address_inside_page))
-    else:
-        print(f"Error: Virtual Address {hex(args.virtual_address)} is not within any known range.")
+            print(f"Error: Virtual Address {hex(virtual_address)} is not within any known range.")
+            failed = True
+
+    if failed:
         sys.exit(1)
 
 if __name__ == "__main__":
     main()
-
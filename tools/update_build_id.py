@@ -1,36 +1,31 @@
 import json
+import struct
 import sys
-import subprocess
+
+from elf_info import ElfFile
 
 def get_build_id(elf_file_path):
     """
     Extracts the build ID from an ELF file.
     """
     try:
-        # Use readelf or eu-readelf to extract the build ID
-        result = subprocess.run(['readelf', '-n', elf_file_path], capture_output=True, text=True, check=True)
-        for line in result.stdout.splitlines():
-            if 'Build ID:' in line:
-                build_id = line.split('Build ID:')[1].strip()
-
-                if (len(build_id) != 40):
-                    print("Wrong build id length")
-                    exit(1)
-
-                build_id_int = []
-                # Convert the hexadecimal build ID to a decimal string
-                for i in range(0, len(build_id), 8):
-                    # Reversing couple of bytes
-                    part_reversed = ''.join(reversed([build_id[i + j:i + j + 2] for j in range(0, 8, 2)]))
-                    build_id_int.append(str(int(part_reversed, 16)))
-
-                return build_id_int
-    except subprocess.CalledProcessError as e:
+        with ElfFile(elf_file_path) as elf:
+            build_id = elf.build_id()
+            endian = elf.endian
+    except (OSError, ValueError) as e:
         print(f"Error reading ELF file: {e}")
         sys.exit(1)
-    
-    print("Build ID not found in the ELF file.")
-    sys.exit(1)
+
+    if build_id is None:
+        print("Build ID not found in the ELF file.")
+        sys.exit(1)
+
+    if (len(build_id) != 20):
+        print("Wrong build id length")
+        exit(1)
+
+    # CRIU stores the build ID as 32-bit words, in the byte order of the file
+    return [str(word) for word in struct.unpack(endian + '5I', build_id)]
 
 def update_criu_checkpoint(json_file_path, library_filename, new_build_id):
     """
@@ -59,7 +54,7 @@ def update_criu_checkpoint(json_file_path, library_filename, new_build_id):
     with open(json_file_path, 'w') as json_file:
         json.dump(data, json_file, indent=4)
 
-    print(f"Updated build ID to {build_id}.")
+    print(f"Updated build ID to {new_build_id}.")
 
 if __name__ == "__main__":
     if len(sys.argv) != 3:
@@ -0,0 +1,139 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+from json_stream import rewrite_image_json
+from update_build_id import get_build_id
+from upgrade_report import peak_rss_kib, record_metrics
+
+def index_reg_entries(data):
+    """
+    Index the REG entries of the CRIU files.json data by file name.
+    """
+    if data['magic'] != 'FILES':
+        raise ValueError("Invalid magic value in the CRIU files.json file")
+
+    index = {}
+    for entry in data['entries']:
+        if entry['type'] == 'REG':
+            index.setdefault(entry['reg']['name'], []).append(entry)
+    return index
+
+def update_library_entries(index, old_name, new_file):
+    """
+    Point the REG entries of old_name to new_file, updating name, size and build ID.
+    Returns the number of entries updated.
+    """
+    entries = index.pop(old_name, None)
+    if not entries:
+        raise ValueError(f"No entry found for {old_name} in the CRIU files.json file")
+
+    fields = new_library_fields(new_file)
+    for entry in entries:
+        entry['reg'].update(fields)
+    index.setdefault(new_file, []).extend(entries)
+    return len(entries)
+
+def new_library_fields(new_file):
+    """The name, size and build ID of new_file, as stored in a REG entry."""
+    return {'name': new_file, 'size': os.stat(new_file).st_size, 'build_id': get_build_id(new_file)}
+
+def update_files_data(data, pairs):
+    """
+    Point every old library of decoded files.img data to its new file.
+    Returns the (old name, new file, entries updated) list.
+    """
+    index = index_reg_entries(data)
+    return [(old_name, new_file, update_library_entries(index, old_name, new_file)) for old_name, new_file in pairs]
+
+def stream_update_files(json_file_path, pairs):
+    """
+    Same update as update_files_data, streaming the entries one at a time: only the
+    entry being rewritten is held in memory and the file is written back compact.
+    Returns the (old name, new file, entries updated) list.
+    """
+    fields = [(old_name, new_library_fields(new_file)) for old_name, new_file in pairs]
+    counts = [0] * len(fields)
+
+    def update_entry(entry):
+        if entry['type'] != 'REG':
+            return 0
+        # Pairs apply in order, a later pair can rename the file given by an earlier one
+        updated = 0
+        for i, (old_name, new_fields) in enumerate(fields):
+            if entry['reg']['name'] == old_name:
+                entry['reg'].update(new_fields)
+                counts[i] += 1
+                updated = 1
+        return updated
+
+    tmp_path = json_file_path + '.tmp'
+    try:
+        with open(json_file_path, 'r') as json_file, open(tmp_path, 'w') as output_file:
+            rewrite_image_json(json_file, output_file, 'FILES', update_entry)
+        for (old_name, _), count in zip(fields, counts):
+            if not count:
+                raise ValueError(f"No entry found for {old_name} in the CRIU files.json file")
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    os.replace(tmp_path, json_file_path)
+    return [(old_name, new_file, count) for (old_name, new_file), count in zip(pairs, counts)]
+
+def parse_library_pairs(values):
+    """Split the OLD_FILE NEW_FILE list into pairs."""
+    if len(values) % 2 != 0:
+        raise ValueError("Libraries must be given as OLD_FILE NEW_FILE pairs")
+    return list(zip(values[::2], values[1::2]))
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Update name, size and build ID of libraries in a CRIU files.json file, in a single pass.')
+    parser.add_argument('json_file', help='files.json decoded from files.img')
+    parser.add_argument('libraries', nargs='+', metavar='OLD_FILE NEW_FILE',
+                        help='Path of the library in the checkpoint followed by the path of the new library')
+    parser.add_argument('--stream', action='store_true',
+                        help='Stream the entries instead of loading the whole file, bounding the memory used')
+
+    args = parser.parse_args()
+
+    start_wall = time.time()
+    try:
+        pairs = parse_library_pairs(args.libraries)
+        total_updated = 0
+
+        if args.stream:
+            updated_libraries = stream_update_files(args.json_file, pairs)
+        else:
+            with open(args.json_file, 'r') as json_file:
+                data = json.load(json_file)
+
+            updated_libraries = update_files_data(data, pairs)
+
+            with open(args.json_file, 'w') as json_file:
+                json.dump(data, json_file, separators=(',', ':'))
+
+        for old_name, new_file, updated in updated_libraries:
+            print(f"Updated {updated} entry(ies): {old_name} -> {new_file}")
+            total_updated += updated
+
+        peak_rss = peak_rss_kib()
+        print(f"Peak memory: {peak_rss / 1024:.1f} MiB")
+        record_metrics('update_files_img', start_wall, entries_updated=total_updated,
+                       stream=args.stream, peak_rss_kib=peak_rss)
+
+    except FileNotFoundError as e:
+        print(f"File not found: {e}")
+        sys.exit(1)
+    except json.JSONDecodeError:
+        print(f"Invalid JSON format in {args.json_file}")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
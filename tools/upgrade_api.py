@@ -0,0 +1,163 @@
+"""
+Importable entry point of the upgrade tools. Every step of the pipeline that update.sh
+runs as a separate interpreter is available here as a function, plus rewrite_checkpoint
+running all the steps between the dump and the restore in-process. StateCache keeps the
+parsed mappings and ELF data warm across calls, see upgrade_daemon.py.
+"""
+import glob
+import io
+import json
+import os
+import subprocess
+import time
+from typing import Dict, List, Optional, Tuple
+
+from elf_info import ElfFile, describe_elf, upgrade_variables
+from fix_heap_pointers import DEFAULT_JOBS as DEFAULT_HEAP_JOBS, fix_heap_pointers, write_heap_report
+from mapping_index import IntervalIndex, MemoryMapping
+from patch_pages import resolve_patches, write_patches
+from set_thread_alive import set_tasks_alive
+from shift_addresses import parse_mappings_file, select_engine, translate
+from translate_addresses import load_pagemap, load_pagemap_chain
+from update_files_img import update_files_data
+from upgrade_report import record_metrics
+
+try:
+    import pycriu
+except ImportError:
+    pycriu = None
+
+__all__ = [
+    'ElfFile', 'IntervalIndex', 'MemoryMapping', 'StateCache',
+    'describe_elf', 'upgrade_variables', 'parse_mappings_file',
+    'load_pagemap', 'load_pagemap_chain', 'select_engine', 'translate',
+    'resolve_patches', 'write_patches', 'fix_heap_pointers', 'set_tasks_alive', 'update_files_data',
+    'load_image', 'dump_image', 'translate_dump', 'rewrite_checkpoint', 'DEFAULT_HEAP_JOBS',
+]
+
+class StateCache:
+    """
+    Values computed from files, reused as long as the file is unchanged
+    (same path, size and modification time).
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, kind: str, path: str, compute):
+        stat = os.stat(path)
+        key = (kind, os.path.realpath(path))
+        version = (stat.st_size, stat.st_mtime_ns)
+        cached = self._entries.get(key)
+        if cached is not None and cached[0] == version:
+            self.hits += 1
+            return cached[1]
+        self.misses += 1
+        value = compute(path)
+        self._entries[key] = (version, value)
+        return value
+
+    def mappings(self, path: str, gdb_format: bool = False) -> List[MemoryMapping]:
+        return self.get('gdb_mappings' if gdb_format else 'mappings', path,
+                        lambda p: parse_mappings_file(p, gdb_format))
+
+    def pointer_slots(self, elf_file: str) -> List[int]:
+        def read(path):
+            with ElfFile(path) as elf:
+                return elf.pointer_slots()
+        return self.get('pointer_slots', elf_file, read)
+
+    def elf(self, path: str) -> dict:
+        return self.get('elf', path, describe_elf)
+
+    def stats(self) -> dict:
+        return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+def load_image(path: str, crit: str = 'crit') -> dict:
+    """Decode a CRIU image like 'crit decode', in-process when pycriu is available."""
+    if pycriu is not None:
+        with open(path, 'rb') as f:
+            return pycriu.images.load(f)
+    result = subprocess.run([crit, 'decode', '-i', path], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)
+
+def dump_image(data: dict, path: str, crit: str = 'crit'):
+    """Encode a CRIU image like 'crit encode', in-process when pycriu is available."""
+    if pycriu is not None:
+        with open(path, 'wb') as f:
+            pycriu.images.dump(data, f)
+        return
+    subprocess.run([crit, 'encode', '-o', path], input=json.dumps(data), text=True, check=True)
+
+def translate_dump(cache: StateCache, dump_file: str, src_mappings: List[MemoryMapping],
+                   dst_mappings: List[MemoryMapping], relocations: Optional[Tuple[str, int]] = None) -> bytes:
+    """Translate a synthetic execution dump into an in-memory buffer, same as patch_pages.py --translate."""
+    start_wall = time.time()
+    elf_file, dump_start = relocations or (None, None)
+    pointer_slots = cache.pointer_slots(elf_file) if elf_file else None
+    engine, slots = select_engine('vectorized', dump_file, 64, elf_file, dump_start, pointer_slots)
+    output = io.BytesIO()
+    with open(dump_file, 'rb') as input_file:
+        translated = translate(input_file, output, src_mappings, dst_mappings, 64, engine, slots)
+    record_metrics('shift_addresses', start_wall, file=dump_file, in_memory=True,
+                   bytes_translated=output.tell(), pointers_rewritten=translated)
+    return output.getvalue()
+
+def rewrite_checkpoint(cache: StateCache, checkpoint_dir: str, src_maps: str, dst_maps: str,
+                       patches: List[Tuple[int, str]], library_pairs: List[Tuple[str, str]],
+                       relocations: Optional[Dict[str, Tuple[str, int]]] = None, heap_fixup: bool = False,
+                       heap_jobs: int = 1, heap_chunk_size: int = 64 << 20,
+                       heap_report: str = 'heap_pointers.json', crit: str = 'crit') -> dict:
+    """
+    Every step between the dump and the restore, in-process: translate the synthetic dumps
+    and write them into the pages images, optionally fix the heap pointers, then point
+    files.img to the new libraries and mark the tasks of every core image alive.
+    Returns a summary of what was rewritten.
+    """
+    relocations = relocations or {}
+    src_mappings = cache.mappings(src_maps, gdb_format=True)
+    dst_mappings = parse_mappings_file(dst_maps)
+    summary = {}
+
+    start_wall = time.time()
+    blobs = [(vaddr, translate_dump(cache, dump_file, src_mappings, dst_mappings, relocations.get(dump_file)))
+             for vaddr, dump_file in patches]
+    page_chain = load_pagemap_chain(checkpoint_dir)
+    resolved = resolve_patches(blobs, page_chain)
+    write_patches(resolved)
+    summary['bytes_patched'] = sum(len(blob) for _, _, _, blob in resolved)
+    record_metrics('patch_pages', start_wall, patches=len(blobs), bytes_patched=summary['bytes_patched'])
+
+    if heap_fixup:
+        start_wall = time.time()
+        scanned, slots = fix_heap_pointers(checkpoint_dir, dst_mappings, library_pairs,
+                                           max(1, heap_jobs), heap_chunk_size)
+        rewritten, unresolved = write_heap_report(heap_report, scanned, slots, False)
+        summary['heap_pointers_rewritten'] = rewritten
+        summary['heap_pointers_unresolved'] = unresolved
+        record_metrics('fix_heap_pointers', start_wall, bytes_translated=scanned, pointers_rewritten=rewritten)
+
+    start_wall = time.time()
+    files_img = os.path.join(checkpoint_dir, 'files.img')
+    data = load_image(files_img, crit)
+    updated = update_files_data(data, library_pairs)
+    dump_image(data, files_img, crit)
+    summary['files_entries_updated'] = sum(count for _, _, count in updated)
+    record_metrics('update_files_img', start_wall, entries_updated=summary['files_entries_updated'])
+
+    start_wall = time.time()
+    tasks_updated = 0
+    core_files = sorted(glob.glob(os.path.join(checkpoint_dir, 'core-*.img')))
+    for core_img in core_files:
+        data = load_image(core_img, crit)
+        # The images of the threads other than the leader have no 'tc' and are left unchanged
+        updated = set_tasks_alive(data)
+        if updated:
+            tasks_updated += updated
+            dump_image(data, core_img, crit)
+    summary['tasks_updated'] = tasks_updated
+    summary['core_files'] = len(core_files)
+    record_metrics('set_thread_alive', start_wall, tasks_updated=tasks_updated, core_files=len(core_files))
+    return summary
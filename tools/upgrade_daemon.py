@@ -0,0 +1,187 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import socket
+import socketserver
+import sys
+import threading
+import time
+
+# Only the standard library is imported at the top: the client side must start fast,
+# the server imports upgrade_api (numpy, ELF and image parsing) once when it starts.
+
+METRICS_ENV = 'UPGRADE_METRICS_FILE'
+
+def send_request(socket_path, request):
+    """Send one JSON request to the daemon and return its JSON response."""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+        sock.sendall(json.dumps(request).encode() + b'\n')
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    if not line:
+        raise ConnectionError("The daemon closed the connection without answering")
+    return json.loads(line)
+
+class UpgradeServer(socketserver.UnixStreamServer):
+    """
+    Requests are served one at a time: each one runs in the working directory and with
+    the metrics file of its client, both process-wide.
+    """
+
+    def __init__(self, socket_path):
+        import upgrade_api
+        self.api = upgrade_api
+        self.cache = upgrade_api.StateCache()
+        self.started = time.time()
+        self.requests = 0
+        super().__init__(socket_path, UpgradeRequestHandler)
+
+    def run(self, request):
+        action = request.get('action')
+        if action == 'ping':
+            return {'uptime': time.time() - self.started, 'requests': self.requests, 'cache': self.cache.stats()}
+        if action == 'stop':
+            # shutdown() waits for serve_forever to return, it cannot be called from the serving thread
+            threading.Thread(target=self.shutdown).start()
+            return {}
+        if action == 'describe_elf':
+            return {'elf': self.cache.elf(request['file'])}
+        if action == 'rewrite_checkpoint':
+            return self.api.rewrite_checkpoint(
+                self.cache, request['checkpoint'], request['src_maps'], request['dst_maps'],
+                [(int(vaddr, 0), dump_file) for vaddr, dump_file in request['patches']],
+                [tuple(pair) for pair in request['libraries']],
+                relocations={dump_file: (elf_file, int(dump_start, 0))
+                             for dump_file, elf_file, dump_start in request.get('relocations', [])},
+                heap_fixup=request.get('heap_fixup', False),
+                heap_jobs=request.get('heap_jobs') or self.api.DEFAULT_HEAP_JOBS,
+                crit=request.get('crit', 'crit'))
+        raise ValueError(f"Unknown action '{action}'")
+
+class UpgradeRequestHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            return
+        server = self.server
+        server.requests += 1
+        output = io.StringIO()
+        previous_dir = os.getcwd()
+        previous_metrics = os.environ.get(METRICS_ENV)
+        try:
+            request = json.loads(line)
+            os.chdir(request.get('cwd', previous_dir))
+            if request.get('metrics_file'):
+                os.environ[METRICS_ENV] = request['metrics_file']
+            else:
+                os.environ.pop(METRICS_ENV, None)
+            with contextlib.redirect_stdout(output):
+                result = server.run(request)
+            response = {'ok': True, 'result': result}
+        except SystemExit as e:  # The tools exit on some errors, after printing them
+            response = {'ok': False, 'error': f"Exited with status {e.code}"}
+        except Exception as e:
+            response = {'ok': False, 'error': f"{type(e).__name__}: {e}"}
+        finally:
+            os.chdir(previous_dir)
+            if previous_metrics is None:
+                os.environ.pop(METRICS_ENV, None)
+            else:
+                os.environ[METRICS_ENV] = previous_metrics
+        response['output'] = output.getvalue()
+        self.wfile.write(json.dumps(response).encode() + b'\n')
+
+def serve(socket_path):
+    if os.path.exists(socket_path):
+        try:
+            send_request(socket_path, {'action': 'ping'})
+            print(f"Error: A daemon is already listening on {socket_path}")
+            sys.exit(1)
+        except OSError:
+            os.unlink(socket_path)  # Left by a daemon that did not exit cleanly
+    with UpgradeServer(socket_path) as server:
+        os.chmod(socket_path, 0o600)
+        print(f"Listening on {socket_path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.unlink(socket_path)
+
+def parse_patch(spec):
+    vaddr, sep, dump_file = spec.partition(':')
+    if not sep or not dump_file:
+        raise argparse.ArgumentTypeError(f"Invalid patch '{spec}', expected VADDR:FILE")
+    return [vaddr, os.path.abspath(dump_file)]
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Daemon running the upgrade steps in-process, keeping parsed state between upgrades.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve', help='Run the daemon')
+    serve_parser.add_argument('socket', help='Unix socket to listen on')
+
+    for command, help_text in [('ping', 'Check that the daemon is running and print its statistics'),
+                               ('stop', 'Stop the daemon')]:
+        subparsers.add_parser(command, help=help_text).add_argument('socket', help='Unix socket of the daemon')
+
+    rewrite_parser = subparsers.add_parser(
+        'rewrite', help='Patch the pages, fix the heap pointers, rewrite files.img and the core images of a checkpoint')
+    rewrite_parser.add_argument('socket', help='Unix socket of the daemon')
+    rewrite_parser.add_argument('checkpoint_directory', help='Directory containing the checkpoint images')
+    rewrite_parser.add_argument('--src-maps', required=True, help='Synthetic execution mappings (GDB format)')
+    rewrite_parser.add_argument('--dst-maps', required=True, help='Process mappings (proc format)')
+    rewrite_parser.add_argument('--patch', type=parse_patch, action='append', default=[], metavar='VADDR:FILE',
+                                help='Synthetic dump to translate and write at VADDR, can be repeated')
+    rewrite_parser.add_argument('--relocations', nargs=3, action='append', default=[],
+                                metavar=('FILE', 'ELF_FILE', 'DUMP_START'),
+                                help='Only translate the slots of FILE relocated in ELF_FILE, FILE starting at DUMP_START')
+    rewrite_parser.add_argument('--library', nargs=2, action='append', required=True, metavar=('OLD_FILE', 'NEW_FILE'),
+                                help='Library file in the checkpoint and new library file, can be repeated')
+    rewrite_parser.add_argument('--heap-fixup', action='store_true', help='Also rewrite the heap pointers into the old libraries')
+    rewrite_parser.add_argument('--heap-jobs', type=int,
+                                help='Worker processes of the heap fixup (default: the fix_heap_pointers.py default)')
+    rewrite_parser.add_argument('--crit', default='crit', help='crit executable, used when pycriu is not importable')
+
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.socket)
+        return
+
+    request = {'action': args.command, 'cwd': os.getcwd(), 'metrics_file': os.environ.get(METRICS_ENV)}
+    if args.command == 'rewrite':
+        request.update({
+            'action': 'rewrite_checkpoint',
+            'checkpoint': os.path.abspath(args.checkpoint_directory),
+            'src_maps': os.path.abspath(args.src_maps),
+            'dst_maps': os.path.abspath(args.dst_maps),
+            'patches': args.patch,
+            'relocations': [[os.path.abspath(dump_file), elf_file, dump_start]
+                            for dump_file, elf_file, dump_start in args.relocations],
+            'libraries': args.library,
+            'heap_fixup': args.heap_fixup,
+            'heap_jobs': args.heap_jobs,
+            'crit': args.crit,
+        })
+
+    try:
+        response = send_request(args.socket, request)
+    except (OSError, ValueError) as e:
+        print(f"Error: Could not reach the daemon on {args.socket}: {e}")
+        sys.exit(1)
+
+    sys.stdout.write(response.get('output', ''))
+    if not response['ok']:
+        print(f"Error: {response['error']}")
+        sys.exit(1)
+    print(json.dumps(response['result'], indent=4))
+
+if __name__ == "__main__":
+    main()
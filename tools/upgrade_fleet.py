@@ -0,0 +1,260 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+from elf_info import describe_elf
+from shift_addresses import parse_mappings_file
+
+# Files written by update.sh in the working directory of every upgrade
+REPORT_FILE = 'upgrade_report.json'
+LOG_FILE = 'update.log'
+MANIFEST_FILE = 'libraries.manifest'
+
+# Exit status of update.sh when the upgrade failed and the original version was restored
+ROLLED_BACK_STATUS = 3
+
+def select_pids(pids: List[int], name: Optional[str]) -> List[int]:
+    """Return the given PIDs plus every process whose command name is exactly name."""
+    selected = list(pids)
+    if name:
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit() or int(entry) == os.getpid():
+                continue
+            try:
+                with open(f'/proc/{entry}/comm', 'r') as f:
+                    if f.read().strip() == name:
+                        selected.append(int(entry))
+            except OSError:  # The process exited meanwhile
+                continue
+    return sorted(set(selected))
+
+def parse_manifest(manifest_file: str) -> List[Tuple[str, str]]:
+    """
+    Read the <old_lib_name> <new_lib_file> pairs of a manifest, same format as update.sh --manifest.
+    Relative new library files are resolved against the directory of the manifest, as update.sh does.
+    """
+    manifest_dir = os.path.dirname(os.path.abspath(manifest_file))
+    libraries = []
+    with open(manifest_file, 'r') as f:
+        for line in f:
+            fields = line.split()
+            if not fields or fields[0].startswith('#'):
+                continue
+            if len(fields) != 2:
+                raise ValueError(f"Invalid manifest line, expected <old_lib_name> <new_lib_file>: {line.strip()}")
+            libraries.append((fields[0], os.path.abspath(os.path.join(manifest_dir, fields[1]))))
+    return libraries
+
+def resolve_process(pid: int, libraries: List[Tuple[str, str]]) -> Tuple[str, Tuple[str, ...]]:
+    """
+    Return the executable of the process and the files of the old libraries it has loaded,
+    picked like update.sh does: the first mapping whose path contains the library name.
+    """
+    exe_file = os.path.realpath(f'/proc/{pid}/exe')
+    mappings = parse_mappings_file(f'/proc/{pid}/maps')
+    old_lib_files = []
+    for old_lib_name, _ in libraries:
+        old_lib_file = next((m.path for m in mappings if old_lib_name in m.path), None)
+        if old_lib_file is None:
+            raise ValueError(f"Library {old_lib_name} not found in process {pid}")
+        old_lib_files.append(old_lib_file)
+    return exe_file, tuple(old_lib_files)
+
+def group_processes(pids: List[int], libraries: List[Tuple[str, str]]):
+    """
+    Group the processes by (executable, old library files): every process of a group
+    shares the same ELF analysis and synthetic execution artifacts.
+    Returns ({group: [pid, ...]}, {pid: error}).
+    """
+    groups: Dict[Tuple[str, Tuple[str, ...]], List[int]] = {}
+    errors = {}
+    for pid in pids:
+        try:
+            groups.setdefault(resolve_process(pid, libraries), []).append(pid)
+        except (OSError, ValueError) as e:
+            errors[pid] = str(e)
+    return groups, errors
+
+def check_group(group, libraries: List[Tuple[str, str]]):
+    """ELF checks done once per group, raise ValueError if the group cannot be upgraded."""
+    exe_file, old_lib_files = group
+    if describe_elf(exe_file)['type'] not in ('EXEC', 'DYN'):
+        raise ValueError(f"{exe_file} is not an ELF executable")
+    for old_lib_file, (_, new_lib_file) in zip(old_lib_files, libraries):
+        for lib_file in (old_lib_file, new_lib_file):
+            if describe_elf(lib_file)['type'] != 'DYN':
+                raise ValueError(f"{lib_file} is not an ELF DYN object")
+
+def prepare_group(prepare_script: str, group, libraries: List[Tuple[str, str]]) -> float:
+    """Run the synthetic execution of the group once, update.sh then finds it in the cache."""
+    exe_file, old_lib_files = group
+    command = [prepare_script, exe_file]
+    for old_lib_file, (_, new_lib_file) in zip(old_lib_files, libraries):
+        command += [old_lib_file, new_lib_file]
+    start = time.perf_counter()
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    if result.returncode != 0:
+        raise ValueError(f"Preparation failed with exit code {result.returncode}: {result.stdout.strip()}")
+    return time.perf_counter() - start
+
+def upgrade_process(update_script: str, pid: int, libraries: List[Tuple[str, str]], work_root: str) -> dict:
+    """Run update.sh for one process in its own working directory, return the result of the upgrade."""
+    work_dir = os.path.join(work_root, str(pid))
+    os.makedirs(work_dir, exist_ok=True)
+    manifest_file = os.path.join(work_dir, MANIFEST_FILE)
+    with open(manifest_file, 'w') as f:
+        for old_lib_name, new_lib_file in libraries:
+            f.write(f"{old_lib_name} {new_lib_file}\n")
+
+    report_file = os.path.join(work_dir, REPORT_FILE)
+    env = dict(os.environ)
+    env.pop('UPGRADE_METRICS_FILE', None)
+    env['UPGRADE_REPORT_FILE'] = report_file
+
+    start = time.time()
+    with open(os.path.join(work_dir, LOG_FILE), 'w') as log:
+        returncode = subprocess.run([os.path.abspath(update_script), str(pid), '--manifest', manifest_file],
+                                    cwd=work_dir, env=env, stdout=log, stderr=subprocess.STDOUT).returncode
+    end = time.time()
+
+    result = {
+        'pid': pid,
+        'status': 'ok' if returncode == 0 else 'rolled_back' if returncode == ROLLED_BACK_STATUS else 'failed',
+        'returncode': returncode,
+        'start': start,
+        'end': end,
+        'seconds': round(end - start, 6),
+        'downtime_seconds': None,
+        'work_dir': work_dir,
+    }
+    try:
+        with open(report_file, 'r') as f:
+            result['downtime_seconds'] = json.load(f).get('downtime_seconds')
+    except (OSError, ValueError):
+        pass
+    return result
+
+def run_fleet(update_script: str, pids: List[int], libraries: List[Tuple[str, str]], jobs: int,
+              canaries: int, work_root: str) -> dict:
+    """
+    Upgrade the processes group by group. The first canaries processes of every group are
+    upgraded first, the rest of a group is skipped if any of its canaries fails.
+    At most jobs upgrades run at the same time.
+    """
+    prepare_script = os.path.join(os.path.dirname(os.path.abspath(update_script)), 'prepare.sh')
+    groups, errors = group_processes(pids, libraries)
+    results = {pid: {'pid': pid, 'status': 'skipped', 'error': error} for pid, error in errors.items()}
+    group_summaries = []
+
+    ready = []
+    for group, group_pids in groups.items():
+        summary = {'exe': group[0], 'old_libs': list(group[1]), 'pids': group_pids, 'prepare_seconds': None}
+        group_summaries.append(summary)
+        try:
+            check_group(group, libraries)
+            summary['prepare_seconds'] = round(prepare_group(prepare_script, group, libraries), 6)
+        except (OSError, ValueError) as e:
+            summary['error'] = str(e)
+            print(f"Error: Group {group[0]} skipped: {e}", file=sys.stderr)
+            for pid in group_pids:
+                results[pid] = {'pid': pid, 'status': 'skipped', 'error': str(e)}
+            continue
+        ready.append((group_pids[:canaries], group_pids[canaries:]))
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        def upgrade_all(batch):
+            for result in executor.map(lambda pid: upgrade_process(update_script, pid, libraries, work_root), batch):
+                results[result['pid']] = result
+                print(f"PID {result['pid']}: {result['status']} in {result['seconds']:.3f} s")
+
+        # Canary phase
+        upgrade_all([pid for canary_pids, _ in ready for pid in canary_pids])
+
+        # Rollout phase, only for the groups whose canaries all succeeded
+        rollout = []
+        for canary_pids, rest in ready:
+            if all(results[pid]['status'] == 'ok' for pid in canary_pids):
+                rollout.extend(rest)
+            else:
+                for pid in rest:
+                    results[pid] = {'pid': pid, 'status': 'skipped', 'error': 'Canary upgrade failed'}
+        upgrade_all(rollout)
+
+    ordered = [results[pid] for pid in sorted(results)]
+    downtimes = [r['downtime_seconds'] for r in ordered if r.get('downtime_seconds') is not None]
+    return {
+        'libraries': [{'old_lib_name': old, 'new_lib_file': new} for old, new in libraries],
+        'jobs': jobs,
+        'canaries': canaries,
+        'total': len(ordered),
+        'ok': sum(1 for r in ordered if r['status'] == 'ok'),
+        'failed': sum(1 for r in ordered if r['status'] == 'failed'),
+        'rolled_back': sum(1 for r in ordered if r['status'] == 'rolled_back'),
+        'skipped': sum(1 for r in ordered if r['status'] == 'skipped'),
+        'max_downtime_seconds': max(downtimes, default=None),
+        'groups': group_summaries,
+        'processes': ordered,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Upgrade the libraries of many processes, sharing the preparation of processes running the same binaries.')
+    parser.add_argument('pids', nargs='*', type=int, help='PIDs of the processes to upgrade')
+    parser.add_argument('--name', help='Also upgrade every process with this command name')
+    parser.add_argument('--library', nargs=2, action='append', default=[], metavar=('OLD_NAME', 'NEW_FILE'),
+                        help='Name of the library as it appears in /proc/PID/maps and new library file, can be repeated')
+    parser.add_argument('--manifest', help='File with one <old_lib_name> <new_lib_file> pair per line')
+    parser.add_argument('--update-script', default=os.environ.get('UPDATE_SCRIPT'),
+                        help='Path to update.sh (default: $UPDATE_SCRIPT)')
+    parser.add_argument('--jobs', type=int, default=4, help='Maximum number of concurrent upgrades (default: 4)')
+    parser.add_argument('--canary', type=int, default=1,
+                        help='Processes of every group upgraded before the others (default: 1)')
+    parser.add_argument('--work-dir', default='fleet', help='Directory holding one working directory per PID (default: fleet)')
+    parser.add_argument('--summary', default='fleet_summary.json', help='Summary file (default: fleet_summary.json)')
+
+    args = parser.parse_args()
+
+    try:
+        # update.sh runs in the work directory of each process, the new library files must not be relative
+        libraries = [(old_name, os.path.abspath(new_file)) for old_name, new_file in args.library]
+        if args.manifest:
+            libraries += parse_manifest(args.manifest)
+    except FileNotFoundError as e:
+        print(f"Error: File not found - {e}")
+        sys.exit(1)
+    except ValueError as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    if not libraries:
+        print("Error: At least one library must be given with --library or --manifest")
+        sys.exit(1)
+    if not args.update_script or not os.path.isfile(args.update_script):
+        print("Error: update.sh not found, use --update-script or set UPDATE_SCRIPT")
+        sys.exit(1)
+    if args.jobs < 1 or args.canary < 0:
+        print("Error: --jobs must be positive and --canary not negative")
+        sys.exit(1)
+
+    pids = select_pids(args.pids, args.name)
+    if not pids:
+        print("Error: No process selected")
+        sys.exit(1)
+
+    os.makedirs(args.work_dir, exist_ok=True)
+    summary = run_fleet(args.update_script, pids, libraries, args.jobs, args.canary, os.path.abspath(args.work_dir))
+    with open(args.summary, 'w') as f:
+        json.dump(summary, f, indent=4)
+
+    print(f"Upgraded {summary['ok']}/{summary['total']} process(es): {summary['failed']} failed, "
+          f"{summary['rolled_back']} rolled back, {summary['skipped']} skipped, summary written to {args.summary}")
+    if summary['ok'] != summary['total']:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
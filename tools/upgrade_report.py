@@ -0,0 +1,156 @@
+import argparse
+import json
+import os
+import resource
+import sys
+import time
+
+# Environment variable naming the JSON lines file the metrics of an upgrade are appended to
+METRICS_ENV = 'UPGRADE_METRICS_FILE'
+
+# Phase whose end marks the moment the process is stopped, and phases ending the downtime:
+# resume is recorded by the criu post-resume action script, restore by update.sh
+STOP_PHASE = 'quiescence_wait'
+FIRST_STOPPED_PHASE = 'dump'
+RESUME_PHASE = 'resume'
+RESTORE_PHASE = 'restore'
+
+# Phase of the pre-dump iterations, each recording the pages it transferred
+PRE_DUMP_PHASE = 'pre_dump'
+
+# Phase ending when the lazy-pages daemon has copied every page into the restored process
+LAZY_PAGES_PHASE = 'lazy_pages'
+
+# Counters summed over all the records of an upgrade
+SUMMED_COUNTERS = ['bytes_translated', 'pointers_rewritten', 'bytes_patched']
+
+def record_metrics(phase, start, end=None, **counters):
+    """
+    Append the timing of a phase and its counters to the metrics file of the
+    current upgrade. Does nothing when no upgrade is being measured.
+    """
+    metrics_file = os.environ.get(METRICS_ENV)
+    if not metrics_file:
+        return
+    record = {'phase': phase, 'start': start, 'end': end if end is not None else time.time()}
+    record.update(counters)
+    try:
+        with open(metrics_file, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+    except OSError as e:
+        print(f"Warning: could not record metrics: {e}", file=sys.stderr)
+
+def peak_rss_kib():
+    """
+    Peak resident set size of the current process in KiB. VmHWM is preferred to getrusage,
+    whose maximum survives exec and so includes the process the interpreter was started from.
+    """
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def read_metrics(metrics_file):
+    records = []
+    with open(metrics_file, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except json.JSONDecodeError:
+                print(f"Warning: Skipping invalid metrics line: {line}", file=sys.stderr)
+    return records
+
+def build_report(records, **info):
+    """Aggregate the metric records of an upgrade into the downtime report."""
+    phases = []
+    for record in sorted(records, key=lambda r: r['start']):
+        phase = dict(record)
+        phase['seconds'] = round(record['end'] - record['start'], 6)
+        phases.append(phase)
+
+    report = dict(info)
+    if phases:
+        report['start'] = phases[0]['start']
+        report['end'] = max(p['end'] for p in phases)
+        report['total_seconds'] = round(report['end'] - report['start'], 6)
+
+    # Downtime goes from the moment the process is stopped to the moment it is resumed
+    by_name = {p['phase']: p for p in phases}
+    if STOP_PHASE in by_name:
+        stopped = by_name[STOP_PHASE]['end']
+    elif FIRST_STOPPED_PHASE in by_name:
+        stopped = by_name[FIRST_STOPPED_PHASE]['start']
+    else:
+        stopped = None
+    resumed = by_name.get(RESUME_PHASE, by_name.get(RESTORE_PHASE))
+    if stopped is not None and resumed is not None:
+        report['downtime_seconds'] = round(resumed['end'] - stopped, 6)
+    else:
+        report['downtime_seconds'] = None
+
+    # With a lazy restore the process runs again before all of its memory is loaded
+    report['time_to_first_instruction_seconds'] = report['downtime_seconds']
+    if stopped is not None and LAZY_PAGES_PHASE in by_name:
+        report['time_to_fully_resident_seconds'] = round(by_name[LAZY_PAGES_PHASE]['end'] - stopped, 6)
+    else:
+        report['time_to_fully_resident_seconds'] = report['downtime_seconds']
+
+    for counter in SUMMED_COUNTERS:
+        report[counter] = sum(p.get(counter, 0) for p in phases)
+
+    # Pages transferred while the process was running, then by the final dump
+    report['pre_dump_pages'] = [p.get('pages') for p in phases if p['phase'] == PRE_DUMP_PHASE]
+    report['dump_pages'] = by_name.get(FIRST_STOPPED_PHASE, {}).get('pages')
+    # Threads that delayed quiescence, slowest first
+    report['quiescence_threads'] = by_name.get(STOP_PHASE, {}).get('threads', [])
+    report['phases'] = phases
+    return report
+
+def parse_info(values):
+    """Parse KEY=VALUE pairs, values that look like integers are stored as such."""
+    info = {}
+    for value in values:
+        key, sep, val = value.partition('=')
+        if not sep:
+            raise ValueError(f"Invalid info '{value}', expected KEY=VALUE")
+        try:
+            info[key] = int(val)
+        except ValueError:
+            info[key] = val
+    return info
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the JSON latency and downtime report of an upgrade.')
+    parser.add_argument('metrics_file', help='JSON lines file with the metrics recorded during the upgrade')
+    parser.add_argument('-o', '--output', help='Report file (default: standard output)')
+    parser.add_argument('--info', nargs='*', default=[], metavar='KEY=VALUE',
+                        help='Additional fields stored in the report, e.g. pid=1234')
+
+    args = parser.parse_args()
+
+    try:
+        report = build_report(read_metrics(args.metrics_file), **parse_info(args.info))
+    except FileNotFoundError as e:
+        print(f"Error: File not found - {e}")
+        sys.exit(1)
+    except (KeyError, TypeError, ValueError) as e:
+        print(f"Error: Invalid metrics: {e}")
+        sys.exit(1)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=4)
+        if report['downtime_seconds'] is not None:
+            print(f"Downtime: {report['downtime_seconds']:.3f} s, report written to {args.output}")
+    else:
+        print(json.dumps(report, indent=4))
+
+if __name__ == "__main__":
+    main()
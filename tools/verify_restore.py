@@ -0,0 +1,208 @@
+import argparse
+import ctypes
+import errno
+import json
+import os
+import sys
+import time
+
+from mapping_index import IntervalIndex
+from patch_pages import parse_patch, translate_blob
+from shift_addresses import parse_mappings_file
+from upgrade_report import record_metrics
+
+# Remote ranges per process_vm_readv call, the kernel rejects more than IOV_MAX
+IOV_MAX = 1024
+
+WORD_SIZE = 8
+
+class IoVec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p), ('iov_len', ctypes.c_size_t)]
+
+_libc = ctypes.CDLL(None, use_errno=True)
+_process_vm_readv = _libc.process_vm_readv
+_process_vm_readv.restype = ctypes.c_ssize_t
+_process_vm_readv.argtypes = [ctypes.c_int, ctypes.POINTER(IoVec), ctypes.c_ulong,
+                              ctypes.POINTER(IoVec), ctypes.c_ulong, ctypes.c_ulong]
+
+def read_process_memory(pid, ranges):
+    """
+    Read the (vaddr, size) ranges of the memory of process pid into one buffer, with one
+    process_vm_readv call per IOV_MAX ranges. Returns a memoryview of every range, None
+    for the ranges that could not be read entirely (not mapped, or not readable).
+    """
+    sizes = [size for _, size in ranges]
+    offsets = [0]
+    for size in sizes:
+        offsets.append(offsets[-1] + size)
+    buffer = bytearray(offsets[-1])
+    view = memoryview(buffer)
+    base = ctypes.addressof((ctypes.c_char * len(buffer)).from_buffer(buffer)) if buffer else 0
+
+    results = [None] * len(ranges)
+    i = 0
+    while i < len(ranges):
+        count = min(IOV_MAX, len(ranges) - i)
+        remote = (IoVec * count)(*[IoVec(vaddr, size) for vaddr, size in ranges[i:i + count]])
+        local = IoVec(base + offsets[i], offsets[i + count] - offsets[i])
+        read = _process_vm_readv(pid, ctypes.byref(local), 1, remote, count, 0)
+        if read < 0:
+            error = ctypes.get_errno()
+            if error != errno.EFAULT:
+                raise OSError(error, f"process_vm_readv on process {pid}: {os.strerror(error)}")
+            read = 0  # Nothing could be read from the first range of the batch
+
+        # The transfer stops at the first range that cannot be read entirely, which is skipped
+        end = offsets[i] + read
+        last = i + count
+        while i < last and offsets[i + 1] <= end:
+            results[i] = view[offsets[i]:offsets[i + 1]]
+            i += 1
+        if i < last:
+            i += 1
+    return results
+
+def load_heap_slots(heap_report):
+    """(vaddr, expected bytes, label) of the slots rewritten by fix_heap_pointers.py."""
+    with open(heap_report, 'r') as f:
+        report = json.load(f)
+    return [(int(slot['vaddr'], 16), int(slot['new'], 16).to_bytes(WORD_SIZE, 'little'), f"heap slot ({slot['symbol']})")
+            for slot in report['slots'] if slot['new'] is not None and slot['new'] != slot['old']]
+
+def mismatched_words(vaddr, expected, actual):
+    """Addresses of the words of actual differing from expected, compared a page at a time first."""
+    for page in range(0, len(expected), 4096):
+        if expected[page:page + 4096] == actual[page:page + 4096]:
+            continue
+        for offset in range(page, min(page + 4096, len(expected)), WORD_SIZE):
+            if expected[offset:offset + WORD_SIZE] != actual[offset:offset + WORD_SIZE]:
+                yield vaddr + offset
+
+def check_library_mappings(mappings, libraries):
+    """
+    Problems with the library mappings of the restored process: every new library must be
+    mapped at the base of the library it replaces, which must not be mapped anymore.
+    """
+    problems = []
+    for old_file, new_file, base in libraries:
+        new_paths = {new_file, os.path.realpath(new_file)}
+        old_paths = {old_file, os.path.realpath(old_file)} - new_paths
+        new_starts = [m.start for m in mappings if m.path in new_paths]
+        if not new_starts:
+            problems.append(f"{new_file} is not mapped")
+        elif min(new_starts) != base:
+            problems.append(f"{new_file} is mapped at {hex(min(new_starts))} instead of {hex(base)}")
+        if any(m.path in old_paths for m in mappings):
+            problems.append(f"{old_file} is still mapped")
+    return problems
+
+def verify_memory(pid, expectations, mappings, tolerate_writes=False):
+    """
+    Compare the memory of process pid with the (vaddr, expected bytes, label) expectations.
+    Words changed in writable mappings may have been written by the process since it was
+    resumed: with tolerate_writes they are only reported. Returns (problems, warnings, bytes compared).
+    """
+    maps_index = IntervalIndex.from_mappings(mappings)
+    actual = read_process_memory(pid, [(vaddr, len(expected)) for vaddr, expected, _ in expectations])
+    problems = []
+    warnings = []
+    compared = 0
+    for (vaddr, expected, label), data in zip(expectations, actual):
+        if data is None:
+            problems.append(f"{label} at {hex(vaddr)}: {len(expected)} bytes could not be read")
+            continue
+        compared += len(expected)
+        if data == expected:
+            continue
+        read_only = []
+        writable = []
+        for address in mismatched_words(vaddr, expected, data):
+            mapping = maps_index.lookup(address)
+            (writable if mapping is not None and 'w' in mapping.perms else read_only).append(address)
+        for addresses, kind, severe in [(read_only, 'read-only', True), (writable, 'writable', not tolerate_writes)]:
+            if addresses:
+                message = (f"{label} at {hex(vaddr)}: {len(addresses)} {kind} word(s) differ,"
+                           f" the first at {hex(addresses[0])}")
+                (problems if severe else warnings).append(message)
+    return problems, warnings, compared
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Check that a restored process holds the memory written by the upgrade and maps the new libraries.')
+    parser.add_argument('pid', type=int, help='PID of the restored process')
+    parser.add_argument('patches', nargs='*', type=parse_patch, metavar='VADDR:FILE',
+                        help='Memory expected at VADDR: the dump written into the pages image, or with --translate '
+                             'the synthetic execution dump')
+    parser.add_argument('--translate', nargs=2, metavar=('SRC_MAPS', 'DST_MAPS'),
+                        help='Translate every FILE in memory first, as patch_pages.py --translate did, from the synthetic '
+                             'execution mappings (GDB format) to the process mappings (proc format)')
+    parser.add_argument('--relocations', nargs=3, action='append', default=[], metavar=('FILE', 'ELF_FILE', 'DUMP_START'),
+                        help='With --translate, only translate the slots of FILE relocated by the dynamic linker '
+                             'in ELF_FILE, FILE starting at ELF virtual address DUMP_START')
+    parser.add_argument('--heap-report', help='Report of fix_heap_pointers.py, its rewritten slots are checked too')
+    parser.add_argument('--library', nargs=3, action='append', default=[], metavar=('OLD_FILE', 'NEW_FILE', 'BASE'),
+                        help='NEW_FILE must be mapped at BASE in place of OLD_FILE, can be repeated')
+    parser.add_argument('--tolerate-writes', action='store_true',
+                        help='Only warn about differences in writable mappings, the process runs since it was restored')
+
+    args = parser.parse_args()
+
+    relocations = {}
+    for blob_file, elf_file, dump_start in args.relocations:
+        try:
+            relocations[blob_file] = (elf_file, int(dump_start, 0))
+        except ValueError:
+            parser.error(f"Invalid dump start '{dump_start}'")
+    if relocations and not args.translate:
+        parser.error("--relocations requires --translate")
+    libraries = []
+    for old_file, new_file, base in args.library:
+        try:
+            libraries.append((old_file, new_file, int(base, 0)))
+        except ValueError:
+            parser.error(f"Invalid base address '{base}'")
+
+    start_wall = time.time()
+    try:
+        expectations = []
+        if args.translate:
+            src_mappings = parse_mappings_file(args.translate[0], gdb_format=True)
+            dst_mappings = parse_mappings_file(args.translate[1])
+        for vaddr, blob_file in args.patches:
+            if args.translate:
+                blob, _ = translate_blob(blob_file, src_mappings, dst_mappings, *relocations.get(blob_file, ()))
+            else:
+                with open(blob_file, 'rb') as f:
+                    blob = f.read()
+            expectations.append((vaddr, blob, blob_file))
+        if args.heap_report:
+            expectations.extend(load_heap_slots(args.heap_report))
+        expectations = [e for e in expectations if e[1]]
+
+        # The mappings are read before the memory, a library mapped elsewhere makes the comparison meaningless
+        read_start = time.time()
+        mappings = parse_mappings_file(f"/proc/{args.pid}/maps")
+        problems = check_library_mappings(mappings, libraries)
+        memory_problems, warnings, compared = verify_memory(args.pid, expectations, mappings, args.tolerate_writes)
+        problems.extend(memory_problems)
+        read_seconds = time.time() - read_start
+    except FileNotFoundError as e:
+        print(f"Error: File not found - {e}")
+        sys.exit(1)
+    except (KeyError, OSError, ValueError) as e:
+        print(f"Error: {e}")
+        sys.exit(1)
+
+    for warning in warnings:
+        print(f"Warning: {warning}")
+    for problem in problems:
+        print(f"Error: {problem}")
+    print(f"Compared {compared} bytes in {len(expectations)} range(s) and {len(libraries)} library mapping(s)"
+          f" of process {args.pid} in {read_seconds * 1000:.2f} ms: {len(problems)} problem(s)")
+    record_metrics('verify_restore', start_wall, ranges=len(expectations), bytes_compared=compared,
+                   problems=len(problems), warnings=len(warnings), read_seconds=round(read_seconds, 6))
+    if problems:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
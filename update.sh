@@ -16,36 +16,58 @@ fi
 EXE_NAME=$(ps -p $PID -o comm=)
 EXE_FILE=$(readlink -f /proc/$PID/exe)
 
-OLD_LIB_NAME=$2  # e.g., "libz.so.1.2.12", must be the name of the library as it appears in /proc/PID/maps
-if [ -z "$OLD_LIB_NAME" ]; then
-  echo "Usage: $0 <PID> <old_lib_name>"
-  exit 1
-fi
-
-cat /proc/$PID/maps | grep -q "$OLD_LIB_NAME" > /dev/null
-retval=$?
-if [ $retval -ne 0 ]; then
-  echo "Error: Library $OLD_LIB_NAME not found in process $PID." >&2
-  exit $retval
+# Libraries to be upgraded, all of them in the same checkpoint/restore cycle:
+# either a single pair on the command line or a manifest with one pair per line
+#   old_lib_name, e.g., "libz.so.1.2.12", must be the name of the library as it appears in /proc/PID/maps
+#   new_lib_file, e.g., "/home/user/zlib-1.3.1/libz.so.1.3.1", path to the new library, relative paths
+#   in a manifest are relative to the directory of the manifest (as in upgrade_fleet.py)
+OLD_LIB_NAMES=()
+NEW_LIB_FILES=()
+if [ "$2" == "--manifest" ]; then
+  MANIFEST_FILE=$3
+  if [ ! -f "$MANIFEST_FILE" ]; then
+    echo "Manifest file does not exist: $MANIFEST_FILE" >&2
+    exit 1
+  fi
+  while read -r old_lib_name new_lib_file; do
+    if [ -z "$old_lib_name" ] || [[ "$old_lib_name" == \#* ]]; then
+      continue
+    fi
+    if [ -z "$new_lib_file" ]; then
+      echo "Error: Invalid manifest line, expected <old_lib_name> <new_lib_file>: $old_lib_name" >&2
+      exit 1
+    fi
+    if [[ "$new_lib_file" != /* ]]; then
+      new_lib_file="$(dirname "$MANIFEST_FILE")/$new_lib_file"
+    fi
+    OLD_LIB_NAMES+=("$old_lib_name")
+    NEW_LIB_FILES+=("$new_lib_file")
+  done < "$MANIFEST_FILE"
+elif [ -n "$2" ] && [ -n "$3" ]; then
+  OLD_LIB_NAMES=("$2")
+  NEW_LIB_FILES=("$3")
 fi
 
-NEW_LIB_FILE=$3  # e.g., "/home/user/zlib-1.3.1/libz.so.1.3.1", must be the full path to the new library
-if [ -z "$NEW_LIB_FILE" ]; then
+if [ ${#OLD_LIB_NAMES[@]} -eq 0 ]; then
   echo "Usage: $0 <PID> <old_lib_name> <new_lib_file>" >&2
+  echo "       $0 <PID> --manifest <manifest_file>" >&2
   exit 1
 fi
 
-if [ ! -f "$NEW_LIB_FILE" ]; then
-  echo "New library file does not exist: $NEW_LIB_FILE" >&2
-  exit 1
-fi
+for i in "${!OLD_LIB_NAMES[@]}"; do
+  cat /proc/$PID/maps | grep -q "${OLD_LIB_NAMES[i]}" > /dev/null
+  retval=$?
+  if [ $retval -ne 0 ]; then
+    echo "Error: Library ${OLD_LIB_NAMES[i]} not found in process $PID." >&2
+    exit $retval
+  fi
 
-NEW_LIB_FOLDER_TO_PRELOAD=$(dirname "$NEW_LIB_FILE")
-retval=$?
-if [ $retval -ne 0 ]; then
-  echo "Error: Could not determine the folder to preload the new library." >&2
-  exit $retval
-fi
+  if [ ! -f "${NEW_LIB_FILES[i]}" ]; then
+    echo "New library file does not exist: ${NEW_LIB_FILES[i]}" >&2
+    exit 1
+  fi
+  NEW_LIB_FILES[i]=$(readlink -f "${NEW_LIB_FILES[i]}")
+done
 
 CLEANUP=0
 
@@ -58,104 +80,261 @@ if [ ! -f "$UPDATE_CONFIG_FILE" ]; then
   exit 1
 fi
 source "$UPDATE_CONFIG_FILE"
+export SYNTHETIC_CACHE_DIR SYNTHETIC_CACHE_MAX_SIZE SYMBOL_TABLE_CACHE_DIR
+
+PREPARE_SCRIPT="$(dirname "$(readlink -f "$0")")/prepare.sh"
 
 CRIU_OPTS="-j -v4 --skip-file-rwx-check --timeout 60"
 
+# Recording the duration of every phase, the JSON report is built when the script exits
+LC_NUMERIC=C  # $EPOCHREALTIME must use a dot as decimal separator
+UPGRADE_METRICS_FILE=${UPGRADE_METRICS_FILE:-$(pwd)/upgrade_metrics.jsonl}
+UPGRADE_REPORT_FILE=${UPGRADE_REPORT_FILE:-$(pwd)/upgrade_report.json}
+export UPGRADE_METRICS_FILE
+: > "$UPGRADE_METRICS_FILE"
+
+phase_begin() {
+  PHASE_NAME=$1
+  PHASE_START=$EPOCHREALTIME
+}
+
+# Start a phase at an earlier moment, a value of $EPOCHREALTIME saved then
+phase_begin_at() {
+  PHASE_NAME=$1
+  PHASE_START=$2
+}
+
+phase_end() {
+  # Optional argument: additional JSON fields of the record, e.g. '"pages": 42'
+  printf '{"phase": "%s", "start": %s, "end": %s%s}\n' "$PHASE_NAME" "$PHASE_START" "$EPOCHREALTIME" "${1:+, $1}" >> "$UPGRADE_METRICS_FILE"
+}
+
+# Number of pages stored in the pages images of an image set
+dumped_pages() {
+  stat -c %s "$1"/pages-*.img 2>/dev/null | awk '{ size += $1 } END { print int(size / 4096) }'
+}
+
+write_report() {
+  python3 $UPGRADE_REPORT "$UPGRADE_METRICS_FILE" -o "$UPGRADE_REPORT_FILE" \
+    --info pid=$PID status=$1 old_lib="$(IFS=,; echo "${OLD_LIB_FILES[*]}")" new_lib="$(IFS=,; echo "${NEW_LIB_FILES[*]}")"
+}
+
+# Removing the tmpfs staging directory, the criu logs are kept in the directory update.sh was started from
+RESULT_DIR=$(pwd)
+cleanup_staging() {
+  if [ -n "$STAGING_DIR" ]; then
+    sudo cp "$STAGING_DIR"/checkpoint/*.log "$RESULT_DIR" 2>/dev/null && sudo chown $(id -u):$(id -g) "$RESULT_DIR"/*.log
+    sudo rm -rf "$STAGING_DIR"
+  fi
+}
+
+# Exit status of an upgrade that failed after the dump, and whose original version was restored
+ROLLED_BACK_STATUS=3
+
+# Health of the restored process: alive during the whole window and, if set, HEALTH_CHECK_COMMAND
+# succeeding at every probe (run with the PID in the environment)
+health_check() {
+  local deadline=$(( ${EPOCHREALTIME/./} + HEALTH_CHECK_SECONDS * 1000000 ))
+  while (( ${EPOCHREALTIME/./} < deadline )); do
+    local state=$(ps -p $PID -o stat=)
+    if [[ -z "$state" || "$state" == Z* ]]; then
+      echo "Health check: process $PID is not running" >&2
+      return 1
+    fi
+    if [ -n "$HEALTH_CHECK_COMMAND" ] && ! PID=$PID bash -c "$HEALTH_CHECK_COMMAND"; then
+      echo "Health check: probe failed for process $PID" >&2
+      return 1
+    fi
+    sleep $HEALTH_CHECK_INTERVAL
+  done
+  return 0
+}
+
+# Restoring the untouched copy of the images taken right after the dump
+rollback_upgrade() {
+  echo "Rolling back process $PID to the original version" >&2
+  phase_begin rollback
+  sudo kill -9 $PID 2>/dev/null
+  while [[ -n "$(ps -p $PID -o stat=)" && "$(ps -p $PID -o stat=)" != Z* ]]; do
+    sleep 0.05
+  done
+  sudo $CRIU restore -D "$ROLLBACK_IMAGES" $CRIU_OPTS --restore-detached -o restore.log --action-script "$RESUME_ACTION_SCRIPT"
+  local retcode=$?
+  phase_end
+  if [ $retcode -ne 0 ]; then
+    echo "Error during the rollback restore" >&2
+    sudo tail "$ROLLBACK_IMAGES/restore.log" >&2
+    return $retcode
+  fi
+  # The tasks were stopped by SIGSTOP before the dump, the original images restore them stopped
+  sudo kill -SIGCONT $PID
+}
+
+on_exit() {
+  local status=$1
+  if [[ $status -ne 0 && -n "$ROLLBACK_IMAGES" ]]; then
+    rollback_upgrade && status=$ROLLED_BACK_STATUS
+  fi
+  write_report $status
+  cleanup_staging
+  exit $status
+}
+trap 'on_exit $?' EXIT
+
+# Run by criu after the restored process is resumed, marking the end of the downtime
+RESUME_ACTION_SCRIPT="[ \"\$CRTOOLS_SCRIPT_ACTION\" = post-resume ] && date +'{\"phase\": \"resume\", \"start\": %s.%N, \"end\": %s.%N}' >> $UPGRADE_METRICS_FILE || true"
+
 ###############################################
 
 echo 0 | sudo tee /proc/sys/kernel/yama/ptrace_scope   # TODO 
 echo 1 | sudo tee /proc/sys/kernel/randomize_va_space
-mkdir -p checkpoint; rm -f checkpoint/*;
-
-# Getting information about the old library
-OLD_LIB_FILE=$(cat /proc/$PID/maps | grep -m 1 "$OLD_LIB_NAME" | awk '{print $6}')
-OLD_LIB_FOLDER_TO_PRELOAD=$(dirname "$OLD_LIB_FILE")
-
-FIRST_PAGE_ELF_START=0x$(readelf -SW "$EXE_FILE" | grep " .got " | awk '{print $4}')
-FIRST_PAGE_ELF_END=0x$(readelf -SW "$EXE_FILE" | grep " .data " | awk '{print $4}')
-
-SECOND_PAGE_ELF_START=$(readelf -lW "$OLD_LIB_FILE" | grep " LOAD " | grep " RW " | awk '{print $3}')
-SECOND_PAGE_ELF_SIZE=$(readelf -lW "$OLD_LIB_FILE" | grep " LOAD " | grep " RW " | awk '{print $5}')
-SECOND_PAGE_ELF_END=$(python3 -c "print(hex(int('$SECOND_PAGE_ELF_START', 16) + int('$SECOND_PAGE_ELF_SIZE', 16)))")
 
-DYNAMIC_ELF_START=$(readelf -lW "$OLD_LIB_FILE" | grep " DYNAMIC " | awk '{print $3}')
-DYNAMIC_ELF_SIZE=$(readelf -lW "$OLD_LIB_FILE" | grep " DYNAMIC " | awk '{print $5}')
-DYNAMIC_ELF_END=$(python3 -c "print(hex(int('$DYNAMIC_ELF_START', 16) + int('$DYNAMIC_ELF_SIZE', 16)))")
-
-# Ensure that the DYNAMIC section is inside the LOAD RW segment
-if [[ $(python3 -c "print(int('$DYNAMIC_ELF_START', 16) >= int('$SECOND_PAGE_ELF_START', 16) and int('$DYNAMIC_ELF_END', 16) <= int('$SECOND_PAGE_ELF_END', 16))") == "False" ]]; then
-    echo "DYNAMIC section is not inside the LOAD RW segment" >&2
-    exit 1
+# Staging the checkpoint and the intermediate files in memory, when the tmpfs can hold the process
+if [[ "$CHECKPOINT_STAGING" == "tmpfs" ]]; then
+  PROCESS_RSS=$(( $(awk '/^VmRSS:/ {print $2}' /proc/$PID/status) * 1024 ))
+  STAGING_REQUIRED=$(( PROCESS_RSS + PROCESS_RSS / 4 ))  # Pages image, the other images and the dumps
+  if [[ "$PRE_DUMP" == "1" ]]; then
+    STAGING_REQUIRED=$(( STAGING_REQUIRED + PROCESS_RSS ))  # Pages dirtied again after the first pre-dump
+  fi
+  if [[ "$ROLLBACK" == "1" ]]; then
+    STAGING_REQUIRED=$(( STAGING_REQUIRED + PROCESS_RSS ))  # tmpfs has no reflinks, the pages images are copied
+  fi
+  STAGING_AVAILABLE=$(df --output=avail -B1 "$STAGING_TMPFS_DIR" | tail -n 1)
+  if (( STAGING_AVAILABLE < STAGING_REQUIRED )); then
+    echo "Warning: $STAGING_TMPFS_DIR has $STAGING_AVAILABLE bytes available, $STAGING_REQUIRED needed, staging on disk" >&2
+  else
+    STAGING_DIR=$(mktemp -d "$STAGING_TMPFS_DIR/auto_upgrade.XXXXXX")
+    cd "$STAGING_DIR" || exit 1
+    echo "Staging the checkpoint in $STAGING_DIR"
+  fi
 fi
+mkdir -p checkpoint; rm -f checkpoint/*;
 
-# Ensure that the executable and the library are valid ELF files
-readelf -h $EXE_FILE > /dev/null
-if [[ $? -ne 0 ]]; then
-    echo "Executable file is not an ELF file" >&2
-    exit 1
-fi
-readelf -h $OLD_LIB_FILE > /dev/null
-if [[ $? -ne 0 ]]; then
-    echo "Old library file is not an ELF file" >&2
-    exit 1
-fi
-readelf -h $NEW_LIB_FILE > /dev/null
-if [[ $? -ne 0 ]]; then
-    echo "New library file is not an ELF file" >&2
-    exit 1
-fi
+OLD_LIB_FILES=()
+OLD_LIB_FOLDERS_TO_PRELOAD=""
+LIB_PAIRS=()
+SECOND_PAGE_ELF_STARTS=()
+SECOND_PAGE_ELF_SIZES=()
+for i in "${!OLD_LIB_NAMES[@]}"; do
+  # Getting information about the old library
+  OLD_LIB_FILES[i]=$(cat /proc/$PID/maps | grep -m 1 "${OLD_LIB_NAMES[i]}" | awk '{print $6}')
+  OLD_LIB_FOLDERS_TO_PRELOAD+=$(dirname "${OLD_LIB_FILES[i]}"):
+  LIB_PAIRS+=("${OLD_LIB_FILES[i]}" "${NEW_LIB_FILES[i]}")
+
+  # Reading every ELF value needed by the upgrade in a single pass over the three files
+  ELF_VARIABLES=$(python3 $ELF_INFO "$EXE_FILE" "${OLD_LIB_FILES[i]}" "${NEW_LIB_FILES[i]}")
+  if [[ $? -ne 0 ]]; then
+      echo "Could not read the ELF information of the executable and the libraries" >&2
+      exit 1
+  fi
+  eval "$ELF_VARIABLES"
+
+  # Ensure that the DYNAMIC section is inside the LOAD RW segment
+  if (( DYNAMIC_ELF_START < SECOND_PAGE_ELF_START || DYNAMIC_ELF_END > SECOND_PAGE_ELF_END )); then
+      echo "DYNAMIC section of ${OLD_LIB_FILES[i]} is not inside the LOAD RW segment" >&2
+      exit 1
+  fi
+
+  if [[ "$LIB_ELF_TYPE" != "DYN" ]]; then
+      echo "Library file ${OLD_LIB_FILES[i]} is not an ELF DYN object" >&2
+      exit 1
+  fi
+
+  SECOND_PAGE_ELF_STARTS[i]=$SECOND_PAGE_ELF_START
+  SECOND_PAGE_ELF_SIZES[i]=$SECOND_PAGE_ELF_SIZE
+done
 
-EXE_ELF_TYPE="$(readelf -h $EXE_FILE | grep 'Type:' | awk '{print $2}')"
 if [[ "$EXE_ELF_TYPE" != "EXEC" && "$EXE_ELF_TYPE" != "DYN" ]]; then
     echo "Executable file is not an ELF executable" >&2
     exit 1
 fi
 
-LIB_ELF_TYPE="$(readelf -h $OLD_LIB_FILE | grep 'Type:' | awk '{print $2}')"
-if [[ "$LIB_ELF_TYPE" != "DYN" ]]; then
-    echo "Library file is not an ELF DYN object" >&2
+# Getting the artifacts of the synthetic execution with the new libraries, before stopping the process.
+# They only depend on the executable and the libraries, the synthetic run is done once and cached.
+phase_begin synthetic
+python3 $SYNTHETIC_CACHE fetch "$EXE_FILE" "${LIB_PAIRS[@]}"
+if [ $? -ne 0 ]; then
+  $PREPARE_SCRIPT "$EXE_FILE" "${LIB_PAIRS[@]}" --force && \
+  python3 $SYNTHETIC_CACHE fetch "$EXE_FILE" "${LIB_PAIRS[@]}"
+  if [ $? -ne 0 ]; then
+    echo "Error preparing the synthetic execution" >&2
     exit 1
+  fi
 fi
+phase_end
 
 # Gather information about the current execution
-LIB_BASE_ADDR=0x$(cat /proc/$PID/maps | grep -m 1 "$OLD_LIB_FILE" | awk '{print $1}' | awk -F '-' '{print $1}')
 cat /proc/$PID/maps > real_mappings.txt
 
 
 if [[ "$EXE_ELF_TYPE" == "EXEC" ]]; then
   EXE_BASE_ADDR="0x0"
-  EXE_BASE_TO_ADD=""
 else  # DYN
   EXE_BASE_ADDR=0x$(cat /proc/$PID/maps | grep -m 1 "$EXE_NAME" | awk '{print $1}' | awk -F '-' '{print $1}')
-  EXE_BASE_TO_ADD="\$exe_base_addr +"
-fi
-
-# Getting the range of addresses of the library
-LIB_START_ADDR=$LIB_BASE_ADDR
-LIB_END_ADDR=0x$(cat /proc/$PID/maps | grep "$OLD_LIB_FILE" | tail -n 1 | awk '{print $1}' | awk -F '-' '{print $2}')
-
-# Using gdb to wait until the execution is outside the library we want to upgrade
-echo "set \$outside_lib = 0" > .gdbtmp
-echo "catch syscall" >> .gdbtmp
-echo "continue" >> .gdbtmp
-echo "while ( \$outside_lib == 0 )" >> .gdbtmp
-echo "  pipe info stack | awk '{print \$2}' | python3 $CHECK_HEX_RANGE $LIB_START_ADDR $LIB_END_ADDR" >> .gdbtmp 
-echo "  if ( \$_shell_exitcode == 0 && (\$pc < $LIB_START_ADDR || \$pc > $LIB_END_ADDR ) )" >> .gdbtmp
-echo "    set \$outside_lib = 1" >> .gdbtmp
-echo "  else" >> .gdbtmp
-echo "    continue" >> .gdbtmp
-echo "  end" >> .gdbtmp
-echo "end" >> .gdbtmp
-LD_LIBRARY_PATH=$OLD_LIB_FOLDER_TO_PRELOAD:$LD_LIBRARY_PATH gdb -p $PID -batch \
--ex "pipe p \$pc | cat > initial_pc.txt" \
--ex "source .gdbtmp" \
+fi
+
+# Getting the range of addresses of every library
+LIB_BASE_ADDRS=()
+QUIESCENCE_RANGES=""
+for i in "${!OLD_LIB_FILES[@]}"; do
+  LIB_BASE_ADDRS[i]=0x$(cat /proc/$PID/maps | grep -m 1 "${OLD_LIB_FILES[i]}" | awk '{print $1}' | awk -F '-' '{print $1}')
+  LIB_END_ADDR=0x$(cat /proc/$PID/maps | grep "${OLD_LIB_FILES[i]}" | tail -n 1 | awk '{print $1}' | awk -F '-' '{print $2}')
+  QUIESCENCE_RANGES+="${LIB_BASE_ADDRS[i]}-$LIB_END_ADDR "
+done
+
+# Copying the memory while the process keeps running, until the pages dirtied between two
+# iterations are few enough: the final dump then only transfers those, shrinking the freeze window
+LAST_PRE_DUMP=""
+if [[ "$PRE_DUMP" == "1" ]]; then
+  rm -rf predump
+  rm -rf rollback
+  for (( iteration = 1; iteration <= PRE_DUMP_MAX_ITERATIONS; iteration++ )); do
+    PRE_DUMP_OPTS=""
+    if [ -n "$LAST_PRE_DUMP" ]; then
+      PRE_DUMP_OPTS="--prev-images-dir ../$LAST_PRE_DUMP"  # Relative to the directory of the new image set
+    fi
+
+    phase_begin pre_dump
+    mkdir -p predump/$iteration
+    sudo $CRIU pre-dump -D predump/$iteration -t $PID $CRIU_OPTS --track-mem $PRE_DUMP_OPTS -o pre-dump.log
+    retcode=$?
+    if [ $retcode -ne 0 ]; then
+      echo "Error during pre-dump iteration $iteration" >&2
+      sudo tail predump/$iteration/pre-dump.log >&2
+      exit $retcode
+    fi
+    sudo chown $(id -u):$(id -g) -R predump/$iteration
+    PRE_DUMP_PAGES=$(dumped_pages predump/$iteration)
+    phase_end "\"iteration\": $iteration, \"pages\": $PRE_DUMP_PAGES"
+    echo "Pre-dump iteration $iteration: $PRE_DUMP_PAGES page(s) transferred"
+
+    LAST_PRE_DUMP=$iteration
+    if (( PRE_DUMP_PAGES < PRE_DUMP_THRESHOLD_PAGES )); then
+      break
+    fi
+  done
+fi
+
+# Using gdb to wait until no thread is executing inside any of the libraries we want to upgrade,
+# the stack of every thread is checked and the pc of every thread saved
+phase_begin quiescence
+LD_LIBRARY_PATH=$OLD_LIB_FOLDERS_TO_PRELOAD$LD_LIBRARY_PATH gdb -p $PID -batch \
+-ex "pipe thread apply all p \$pc | cat > initial_pc.txt" \
+-ex "source $GDB_QUIESCENCE" \
+-ex "wait-quiescence $QUIESCENCE_RANGES" \
 -ex "!kill -SIGSTOP $PID" \
--ex "pipe p \$pc | cat > final_pc.txt" \
+-ex "pipe thread apply all p \$pc | cat > final_pc.txt" \
 -ex "detach" \
 -ex "quit" 2>&1
+phase_end
 
 # Perform the checkpoint
-sudo $CRIU dump -D checkpoint -t $PID $CRIU_OPTS -o dump.log
+phase_begin dump
+if [ -n "$LAST_PRE_DUMP" ]; then
+  # Only the pages dirtied since the last pre-dump are written, the others stay in the parent image sets
+  FINAL_DUMP_OPTS="--track-mem --prev-images-dir ../predump/$LAST_PRE_DUMP"
+fi
+sudo $CRIU dump -D checkpoint -t $PID $CRIU_OPTS $FINAL_DUMP_OPTS -o dump.log
 retcode=$?
 if [ $retcode -ne 0 ]; then
   echo "Error during checkpointing" >&2
@@ -164,86 +343,307 @@ if [ $retcode -ne 0 ]; then
 fi
 
 sudo chown $(id -u):$(id -g) -R checkpoint
-
-# Performing the upgrade
-
-# Gathering information for the new execution, starting a new process with GDB to dump the memory
-printf 'set $exe_base_addr = ' > .gdbtmp1
-printf 'set $lib_base_addr = ' > .gdbtmp2
-LD_LIBRARY_PATH=$NEW_LIB_FOLDER_TO_PRELOAD:$LD_LIBRARY_PATH gdb "$EXE_FILE" -batch \
--ex "break main" -ex "run" \
--ex "pipe info proc mappings | tail -n +5 | head -n -1 > synthetic_mappings.txt" \
--ex "pipe info proc mappings | grep -m 1 $EXE_NAME | awk '{print \$1 }' >> .gdbtmp1" \
--ex "source .gdbtmp1" \
--ex "set \$first_page_elf_start = $FIRST_PAGE_ELF_START" \
--ex "set \$first_page_start = $EXE_BASE_TO_ADD \$first_page_elf_start" \
--ex "set \$first_page_elf_end = $FIRST_PAGE_ELF_END" \
--ex "set \$first_page_end = $EXE_BASE_TO_ADD \$first_page_elf_end" \
--ex "dump binary memory memory_dump_1.bin \$first_page_start \$first_page_end" \
--ex "pipe info proc mappings | grep -m 1 $NEW_LIB_FILE | awk '{print \$1 }' >> .gdbtmp2" \
--ex "source .gdbtmp2" \
--ex "set \$second_page_elf_start = $SECOND_PAGE_ELF_START" \
--ex "set \$second_page_start = \$lib_base_addr + \$second_page_elf_start" \
--ex "set \$second_page_elf_size = $SECOND_PAGE_ELF_SIZE" \
--ex "set \$second_page_end = \$second_page_start + \$second_page_elf_size" \
--ex "dump binary memory memory_dump_2.bin \$second_page_start \$second_page_end" \
--ex "quit"
-
-python3 $SHIFT_ADDRESSES memory_dump_1.bin memory_dump_1_translated.bin --src-gdb --src-maps synthetic_mappings.txt --dst-maps real_mappings.txt
-if [ $? -ne 0 ]; then
-  echo "Error during address translation" >&2
-  exit 1
+phase_end "\"pages\": $(dumped_pages checkpoint)"
+
+# Keeping a restorable copy of the original images: everything is hardlinked, except the images
+# rewritten in place by the upgrade, which are copied (sharing their blocks on reflink filesystems)
+if [[ "$ROLLBACK" == "1" ]]; then
+  phase_begin rollback_snapshot
+  rm -rf rollback; mkdir rollback
+  cp -al checkpoint rollback/checkpoint
+  if [ -d predump ]; then
+    cp -al predump rollback/predump  # Keeps the relative parent links of the image sets valid
+  fi
+  for file in checkpoint/pages-*.img checkpoint/pagemap-*.img checkpoint/files.img checkpoint/core-*.img predump/*/pages-*.img; do
+    if [ -f "$file" ]; then
+      cp --reflink=auto "$file" "$file.tmp" && mv "$file.tmp" "$file"
+    fi
+  done
+  ROLLBACK_IMAGES=rollback/checkpoint
+  phase_end
 fi
 
-python3 $SHIFT_ADDRESSES memory_dump_2.bin memory_dump_2_translated.bin --src-gdb --src-maps synthetic_mappings.txt --dst-maps real_mappings.txt
-if [ $? -ne 0 ]; then
-  echo "Error during address translation" >&2
-  exit 1
+# Performing the upgrade, the dump of the i-th library is memory_dump_<i+2>.bin
+FIRST_PAGE_START=$(printf '0x%x' $(( EXE_BASE_ADDR + FIRST_PAGE_ELF_START )))
+DUMP_FILES=(memory_dump_1.bin)
+DUMP_STARTS=("$FIRST_PAGE_START")
+DUMP_OPTS=()
+if [[ "$TRANSLATION_MODE" == "relocations" ]]; then
+  # Only the slots filled by the dynamic linker are translated
+  DUMP_OPTS+=("--relocations $EXE_FILE --dump-start $FIRST_PAGE_ELF_START")
+fi
+for i in "${!NEW_LIB_FILES[@]}"; do
+  DUMP_FILES+=(memory_dump_$(( i + 2 )).bin)
+  DUMP_STARTS+=("$(printf '0x%x' $(( LIB_BASE_ADDRS[i] + SECOND_PAGE_ELF_STARTS[i] )))")
+  if [[ "$TRANSLATION_MODE" == "relocations" ]]; then
+    DUMP_OPTS+=("--relocations ${NEW_LIB_FILES[i]} --dump-start ${SECOND_PAGE_ELF_STARTS[i]}")
+  fi
+done
+
+if [ -n "$UPGRADE_DAEMON_SOCKET" ] && [ -S "$UPGRADE_DAEMON_SOCKET" ]; then
+  # Every step up to the restore runs in the daemon, which keeps the parsed ELF files and mappings between upgrades
+  REWRITE_OPTS=()
+  for i in "${!DUMP_FILES[@]}"; do
+    REWRITE_OPTS+=(--patch "${DUMP_STARTS[i]}:${DUMP_FILES[i]}")
+    if [ -n "${DUMP_OPTS[i]}" ]; then
+      read -r _ elf_file _ dump_start <<< "${DUMP_OPTS[i]}"
+      REWRITE_OPTS+=(--relocations "${DUMP_FILES[i]}" "$elf_file" "$dump_start")
+    fi
+  done
+  for i in "${!OLD_LIB_FILES[@]}"; do
+    REWRITE_OPTS+=(--library "${OLD_LIB_FILES[i]}" "${NEW_LIB_FILES[i]}")
+  done
+  if [[ "$HEAP_POINTER_FIXUP" == "1" ]]; then
+    REWRITE_OPTS+=(--heap-fixup --heap-jobs $HEAP_FIXUP_JOBS)
+  fi
+
+  phase_begin checkpoint_rewrite
+  python3 $UPGRADE_DAEMON rewrite "$UPGRADE_DAEMON_SOCKET" checkpoint --src-maps synthetic_mappings.txt --dst-maps real_mappings.txt "${REWRITE_OPTS[@]}" --crit "$CRIT"
+  if [ $? -ne 0 ]; then
+    echo "Error while rewriting the checkpoint in the upgrade daemon" >&2
+    exit 1
+  fi
+  phase_end
+else
+  if [ -n "$STAGING_DIR" ]; then
+    # The dumps are translated in memory and written straight into the pages image
+    PATCHES=()
+    PATCH_OPTS=()
+    for i in "${!DUMP_FILES[@]}"; do
+      PATCHES+=("${DUMP_STARTS[i]}:${DUMP_FILES[i]}")
+      if [ -n "${DUMP_OPTS[i]}" ]; then
+        read -r _ elf_file _ dump_start <<< "${DUMP_OPTS[i]}"
+        PATCH_OPTS+=(--relocations "${DUMP_FILES[i]}" "$elf_file" "$dump_start")
+      fi
+    done
+
+    phase_begin page_patching
+    python3 $PATCH_PAGES checkpoint "${PATCHES[@]}" --translate synthetic_mappings.txt real_mappings.txt "${PATCH_OPTS[@]}"
+    if [ $? -ne 0 ]; then
+      echo "Error while translating the dumps into the pages image" >&2
+      exit 1
+    fi
+    phase_end
+  else
+    phase_begin translation
+    PATCHES=()
+    for i in "${!DUMP_FILES[@]}"; do
+      python3 $SHIFT_ADDRESSES ${DUMP_FILES[i]} ${DUMP_FILES[i]%.bin}_translated.bin --src-gdb --src-maps synthetic_mappings.txt --dst-maps real_mappings.txt ${DUMP_OPTS[i]}
+      if [ $? -ne 0 ]; then
+        echo "Error during address translation" >&2
+        exit 1
+      fi
+      PATCHES+=("${DUMP_STARTS[i]}:${DUMP_FILES[i]%.bin}_translated.bin")
+    done
+    DUMPS_TRANSLATED=1
+    phase_end
+
+    # Updating the memory with data from the synthetic execution, all the dumps are written in one pass
+    phase_begin page_patching
+    python3 $PATCH_PAGES checkpoint "${PATCHES[@]}"
+    if [ $? -ne 0 ]; then
+      echo "Error while patching the pages image" >&2
+      exit 1
+    fi
+    phase_end
+  fi
+
+  # Rewriting the pointers into the old libraries held by anonymous mappings and the heap
+  if [[ "$HEAP_POINTER_FIXUP" == "1" ]]; then
+    phase_begin heap_fixup
+    HEAP_LIB_OPTS=()
+    for i in "${!OLD_LIB_FILES[@]}"; do
+      HEAP_LIB_OPTS+=(--library "${OLD_LIB_FILES[i]}" "${NEW_LIB_FILES[i]}")
+    done
+    python3 $FIX_HEAP_POINTERS checkpoint --maps real_mappings.txt "${HEAP_LIB_OPTS[@]}" --jobs $HEAP_FIXUP_JOBS
+    if [ $? -ne 0 ]; then
+      echo "Error while fixing the heap pointers" >&2
+      exit 1
+    fi
+    phase_end
+  fi
+
+  # Decoded images are streamed entry by entry when they may not fit comfortably in memory
+  if [[ "$STREAM_IMAGE_JSON" == "1" ]]; then
+    IMAGE_JSON_OPTS="--stream"
+  fi
+
+  # Updating criu information stored in files.img
+  phase_begin files_rewrite
+  for i in "${!OLD_LIB_FILES[@]}"; do
+    echo "Changing library file name, size and build id: from ${OLD_LIB_FILES[i]} to ${NEW_LIB_FILES[i]}"
+  done
+  $CRIT decode -i checkpoint/files.img -o checkpoint/files.json
+  python3 $UPDATE_FILES_IMG checkpoint/files.json "${LIB_PAIRS[@]}" $IMAGE_JSON_OPTS
+  if [ $? -ne 0 ]; then
+    echo "Error while updating files.img" >&2
+    exit 1
+  fi
+  $CRIT encode -o checkpoint/files.img -i checkpoint/files.json
+  phase_end
+
+  # Updating criu information stored in core-TID.img, one image per thread, all marked alive in one pass
+  phase_begin core_rewrite
+  CORE_JSON_FILES=()
+  for core_file in checkpoint/core-*.img; do
+    $CRIT decode -i $core_file -o ${core_file%.img}.json
+    CORE_JSON_FILES+=(${core_file%.img}.json)
+  done
+  python3 $SET_THREAD_ALIVE "${CORE_JSON_FILES[@]}" $IMAGE_JSON_OPTS
+  if [ $? -ne 0 ]; then
+    echo "Error while updating the core images" >&2
+    exit 1
+  fi
+  for core_json in "${CORE_JSON_FILES[@]}"; do
+    $CRIT encode -o ${core_json%.json}.img -i $core_json
+  done
+  phase_end "\"core_files\": ${#CORE_JSON_FILES[@]}"
 fi
-
-FIRST_PAGE_START=$(python3 -c "print(hex(int('$EXE_BASE_ADDR', 16) + int('$FIRST_PAGE_ELF_START', 16)))")
-SECOND_PAGE_START=$(python3 -c "print(hex(int('$LIB_BASE_ADDR', 16) + int('$SECOND_PAGE_ELF_START', 16)))")
-
-# Updating the memory with data from the synthetic execution
-$CRIT edit -b memory_dump_1_translated.bin checkpoint/pages-1.img "$(python3 $TRANSLATE_ADDRESSES checkpoint "$FIRST_PAGE_START" --result-only)"
-$CRIT edit -b memory_dump_2_translated.bin checkpoint/pages-1.img "$(python3 $TRANSLATE_ADDRESSES checkpoint "$SECOND_PAGE_START" --result-only)"
-
-# Updating criu information stored in files.img
-echo "Changing library file name, size and build id: from $OLD_LIB_FILE to $NEW_LIB_FILE"
-$CRIT decode -i checkpoint/files.img -o checkpoint/files.json
-python3 $UPDATE_FILE_NAME checkpoint/files.json $OLD_LIB_FILE $NEW_LIB_FILE
-python3 $UPDATE_LIB_SIZE checkpoint/files.json $NEW_LIB_FILE $(stat --format="%s" $NEW_LIB_FILE)
-python3 $UPDATE_BUILD_ID checkpoint/files.json $NEW_LIB_FILE
-$CRIT encode -o checkpoint/files.img -i checkpoint/files.json
-
-# Updating criu information stored in core-PID.img
-checkpoint_core_file=$(ls checkpoint/core-*.img)
-$CRIT decode -i $checkpoint_core_file -o checkpoint/core.json
-python3 $SET_THREAD_ALIVE checkpoint/core.json
-$CRIT encode -o $checkpoint_core_file -i checkpoint/core.json; # rm checkpoint/core.json
 
 # Printing some debug information
-FIRST_PAGE_END=$(python3 -c "print(hex(int('$EXE_BASE_ADDR', 16) + int('$FIRST_PAGE_ELF_END', 16)))")
+FIRST_PAGE_END=$(printf '0x%x' $(( EXE_BASE_ADDR + FIRST_PAGE_ELF_END )))
 echo "First page: $FIRST_PAGE_START - $FIRST_PAGE_END"
-SECOND_PAGE_END=$(python3 -c "print(hex(int('$SECOND_PAGE_START', 16) + int('$SECOND_PAGE_ELF_SIZE', 16)))")
-echo "Second page: $SECOND_PAGE_START - $SECOND_PAGE_END"
+for i in "${!NEW_LIB_FILES[@]}"; do
+  SECOND_PAGE_START=$(printf '0x%x' $(( LIB_BASE_ADDRS[i] + SECOND_PAGE_ELF_STARTS[i] )))
+  SECOND_PAGE_END=$(printf '0x%x' $(( SECOND_PAGE_START + SECOND_PAGE_ELF_SIZES[i] )))
+  echo "Second page of ${NEW_LIB_FILES[i]}: $SECOND_PAGE_START - $SECOND_PAGE_END"
+done
+
+# Restoring the process, detached from criu when it is checked afterwards: without --restore-detached
+# criu only returns once the restored process exits, and the verification and the health check need it alive,
+# as does the lazy restore to measure the time until the process is fully resident
+if [[ "$ROLLBACK" == "1" || "$VERIFY_RESTORED_MEMORY" == "1" || "$LAZY_RESTORE" == "1" ]]; then
+  RESTORE_OPTS="--restore-detached"
+fi
+
+# With lazy restore, the process resumes as soon as its non-lazy pages are in place: the pages written
+# by the upgrade are pinned so that they are restored eagerly, the other anonymous pages are served on
+# fault from the images by the local lazy-pages daemon
+if [[ "$LAZY_RESTORE" == "1" ]]; then
+  phase_begin pin_pages
+  PIN_PATCHES=()
+  for i in "${!DUMP_FILES[@]}"; do
+    PIN_PATCHES+=("${DUMP_STARTS[i]}:${DUMP_FILES[i]}")
+  done
+  if [[ "$HEAP_POINTER_FIXUP" == "1" ]]; then
+    PIN_PATCHES+=(--heap-report heap_pointers.json)
+  fi
+  checkpoint_pagemap_file=$(ls checkpoint/pagemap-*.img)
+  $CRIT decode -i $checkpoint_pagemap_file -o checkpoint/pagemap.json
+  python3 $PIN_PAGES checkpoint/pagemap.json "${PIN_PATCHES[@]}"
+  if [ $? -ne 0 ]; then
+    echo "Error while pinning the patched pages" >&2
+    exit 1
+  fi
+  $CRIT encode -o $checkpoint_pagemap_file -i checkpoint/pagemap.json
+  phase_end
+
+  sudo $CRIU lazy-pages -D checkpoint $CRIU_OPTS -o lazy-pages.log &
+  LAZY_PAGES_PID=$!
+  # The restore connects to the socket of the daemon, it must be listening first
+  for (( i = 0; i < LAZY_PAGES_START_TIMEOUT * 20; i++ )); do
+    if [ -S checkpoint/lazy-pages.socket ] || ! kill -0 $LAZY_PAGES_PID 2>/dev/null; then
+      break
+    fi
+    sleep 0.05
+  done
+  if [ ! -S checkpoint/lazy-pages.socket ]; then
+    echo "Error: the lazy-pages daemon did not start" >&2
+    sudo tail checkpoint/lazy-pages.log >&2
+    sudo kill $LAZY_PAGES_PID 2>/dev/null
+    exit 1
+  fi
+  RESTORE_OPTS="$RESTORE_OPTS --lazy-pages"
+fi
 
-# Restoring the process
-sudo $CRIU restore -D checkpoint $CRIU_OPTS -o restore.log
+phase_begin restore
+RESTORE_START=$PHASE_START
+sudo $CRIU restore -D checkpoint $CRIU_OPTS $RESTORE_OPTS -o restore.log --action-script "$RESUME_ACTION_SCRIPT"
 
 retcode=$?
+phase_end
 if [ $retcode -ne 0 ]; then
   echo "Error during restore" >&2
   sudo tail checkpoint/restore.log >&2
+  if [ -n "$LAZY_PAGES_PID" ]; then
+    sudo kill $LAZY_PAGES_PID 2>/dev/null
+  fi
   exit $retcode
 fi
 
+# The daemon exits once every lazy page has been copied into the process: from the start of the
+# restore to that moment, recorded as the lazy_pages phase, the process becomes fully resident
+if [ -n "$LAZY_PAGES_PID" ]; then
+  wait $LAZY_PAGES_PID
+  retcode=$?
+  phase_begin_at lazy_pages $RESTORE_START
+  phase_end
+  if [ $retcode -ne 0 ]; then
+    echo "Error in the lazy-pages daemon" >&2
+    sudo tail checkpoint/lazy-pages.log >&2
+    exit $retcode
+  fi
+fi
+
+# Reading the memory written by the upgrade back from the restored process, and checking that the new
+# libraries are mapped where the old ones were: any difference fails the upgrade
+if [[ "$VERIFY_RESTORED_MEMORY" == "1" ]]; then
+  phase_begin verify_restore
+  VERIFY_PATCHES=()
+  VERIFY_OPTS=()
+  for i in "${!DUMP_FILES[@]}"; do
+    if [[ "$DUMPS_TRANSLATED" == "1" ]]; then
+      VERIFY_PATCHES+=("${DUMP_STARTS[i]}:${DUMP_FILES[i]%.bin}_translated.bin")
+    else
+      # Translated in memory by patch_pages.py or the daemon, the translation is done again
+      VERIFY_PATCHES+=("${DUMP_STARTS[i]}:${DUMP_FILES[i]}")
+      if [ -n "${DUMP_OPTS[i]}" ]; then
+        read -r _ elf_file _ dump_start <<< "${DUMP_OPTS[i]}"
+        VERIFY_OPTS+=(--relocations "${DUMP_FILES[i]}" "$elf_file" "$dump_start")
+      fi
+    fi
+  done
+  if [[ "$DUMPS_TRANSLATED" != "1" ]]; then
+    VERIFY_OPTS+=(--translate synthetic_mappings.txt real_mappings.txt)
+  fi
+  for i in "${!OLD_LIB_FILES[@]}"; do
+    VERIFY_OPTS+=(--library "${OLD_LIB_FILES[i]}" "${NEW_LIB_FILES[i]}" "${LIB_BASE_ADDRS[i]}")
+  done
+  if [[ "$HEAP_POINTER_FIXUP" == "1" ]]; then
+    VERIFY_OPTS+=(--heap-report heap_pointers.json)
+  fi
+  if [[ "$VERIFY_RESTORE_STRICT" != "1" ]]; then
+    VERIFY_OPTS+=(--tolerate-writes)
+  fi
+  python3 $VERIFY_RESTORE $PID "${VERIFY_PATCHES[@]}" "${VERIFY_OPTS[@]}"
+  retcode=$?
+  phase_end
+  if [ $retcode -ne 0 ]; then
+    echo "Error: the restored process does not hold the upgraded memory" >&2
+    exit 1
+  fi
+fi
+
+# Any failure from here on restores the original version, see on_exit
+if [[ "$ROLLBACK" == "1" ]]; then
+  phase_begin health_check
+  health_check
+  retcode=$?
+  phase_end
+  if [ $retcode -ne 0 ]; then
+    exit 1
+  fi
+  ROLLBACK_IMAGES=""
+  rm -rf rollback
+fi
+
 if [ $CLEANUP -eq 1 ]; then
   rm -rf checkpoint
-  rm -f .gdbtmp*
+  rm -rf predump
   rm -f synthetic_mappings.txt
   rm -f real_mappings.txt
   rm -f memory_dump_*.bin
   rm -f initial_pc.txt
   rm -f final_pc.txt
+  rm -f heap_pointers.json
 fi